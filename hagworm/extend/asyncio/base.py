@@ -379,6 +379,7 @@ class FutureWithTask(asyncio.Future, RunnableInterface):
         self._task = None
         self._callable = func
         self._build_time = Utils.loop_time()
+        self._run_time = None
 
     @property
     def name(self):
@@ -395,9 +396,15 @@ class FutureWithTask(asyncio.Future, RunnableInterface):
 
         return self._build_time
 
+    @property
+    def run_time(self):
+
+        return self._run_time
+
     def run(self):
 
         if self._task is None:
+            self._run_time = Utils.loop_time()
             self._task = asyncio.create_task(self._run())
 
         return self
@@ -410,11 +417,14 @@ class FutureWithTask(asyncio.Future, RunnableInterface):
 
             result = await self._callable()
 
-            self.set_result(result)
+            # 执行期间Future可能已被调用方取消
+            if not self.done():
+                self.set_result(result)
 
         except Exception as err:
 
-            self.set_exception(err)
+            if not self.done():
+                self.set_exception(err)
 
         return result
 
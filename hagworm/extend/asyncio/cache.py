@@ -1,1052 +1,2820 @@
 # -*- coding: utf-8 -*-
 
+import zlib
+import pickle
+import fnmatch
+import asyncio
 import aioredis
 
 from aioredis.util import _NOTSET
+from aioredis.pool import ConnectionsPool
 from aioredis.commands.string import StringCommandsMixin
 from aioredis.commands.transaction import Pipeline, MultiExec
 from aioredis.errors import ReplyError, MaxClientsError, AuthError, ReadOnlyError
 
-from .base import Utils, WeakContextVar, AsyncContextManager, AsyncCirculator
+from hagworm.extend.cache import StackCache
+from hagworm.extend.error import PoolOverloadError, CrossShardError
+from hagworm.extend.metrics import PoolMetrics, PoolSizer
+from hagworm.extend.struct import ConsistentHash
+
+from .base import Utils, WeakContextVar, AsyncContextManager, MultiTasks
+from .retry import RetryPolicy, CircuitBreaker
 from .event import DistributedEvent
 from .ntp import NTPClient
+from .task import IntervalTask
 from .transaction import Transaction
 
 
-REDIS_ERROR_RETRY_COUNT = 0x1f
-REDIS_POOL_WATER_LEVEL_WARNING_LINE = 0x08
+try:
+    import msgpack
+except ModuleNotFoundError:
+    msgpack = None
 
+try:
+    import lz4.block
+except ModuleNotFoundError:
+    lz4 = None
 
-class RedisPool:
-    """Redis连接管理
-    """
 
-    def __init__(self, address, password=None, *, minsize=8, maxsize=32, db=0, expire=0, key_prefix=None, **settings):
+REDIS_ERROR_RETRY_COUNT = 0x05
+REDIS_POOL_WATER_LEVEL_WARNING_LINE = 0x08
+REDIS_SCAN_COUNT = 0x400
+REDIS_AUTO_PIPELINE_TIMEOUT = 0x0a
 
-        self._pool = None
-        self._expire = expire
-        self._key_prefix = key_prefix
 
-        self._settings = settings
+class CacheCodec:
+    """缓存数据编解码器
 
-        self._settings[r'address'] = address
-        self._settings[r'password'] = password
+    编码结果首字节为格式标识(低4位为序列化方式，高4位为压缩方式)，超过压缩阈值的数据才会被压缩
+    解码时根据首字节自动识别格式，兼容旧版本zlib+pickle格式的数据，便于滚动发布期间新旧格式并存
 
-        self._settings[r'minsize'] = minsize
-        self._settings[r'maxsize'] = maxsize
+    """
 
-        self._settings[r'db'] = db
+    SERIALIZER_PICKLE = 0x01
+    SERIALIZER_MSGPACK = 0x02
 
-    def __await__(self):
+    COMPRESSOR_NONE = 0x00
+    COMPRESSOR_ZLIB = 0x10
+    COMPRESSOR_LZ4 = 0x20
 
-        self._pool = yield from aioredis.create_pool(**self._settings).__await__()
+    # 旧版本数据为zlib压缩流，首字节固定为0x78
+    LEGACY_HEADER = 0x78
 
-        Utils.log.info(f"Redis {self._settings[r'address']} initialized: {self._pool.size}/{self._pool.maxsize}")
+    _SERIALIZERS = {
+        r'pickle': SERIALIZER_PICKLE,
+        r'msgpack': SERIALIZER_MSGPACK,
+    }
 
-        return self
+    _COMPRESSORS = {
+        None: COMPRESSOR_NONE,
+        r'zlib': COMPRESSOR_ZLIB,
+        r'lz4': COMPRESSOR_LZ4,
+    }
 
-    def get_client(self):
+    def __init__(self, serializer=r'pickle', compressor=None, compress_threshold=0x400, compress_level=6):
 
-        client = None
+        if serializer not in self._SERIALIZERS:
+            raise ValueError(f'Unsupported serializer: {serializer}')
 
-        if self._pool is not None:
-            client = CacheClient(self._pool, self._expire, self._key_prefix)
+        if compressor not in self._COMPRESSORS:
+            raise ValueError(f'Unsupported compressor: {compressor}')
 
-        return client
+        if serializer == r'msgpack' and msgpack is None:
+            raise ModuleNotFoundError(r'msgpack is not installed')
 
+        if compressor == r'lz4' and lz4 is None:
+            raise ModuleNotFoundError(r'lz4 is not installed')
 
-class RedisDelegate:
-    """Redis功能组件
-    """
+        self._serializer = self._SERIALIZERS[serializer]
+        self._compressor = self._COMPRESSORS[compressor]
 
-    def __init__(self):
+        self._compress_threshold = compress_threshold
+        self._compress_level = compress_level
 
-        self._redis_pool = None
+    def _serialize(self, val):
 
-        self._cache_client_context = WeakContextVar(f'cache_client_{Utils.uuid1()}')
+        if self._serializer == self.SERIALIZER_MSGPACK:
+            return msgpack.packb(val, use_bin_type=True)
+        else:
+            return pickle.dumps(val, pickle.HIGHEST_PROTOCOL)
 
-    @property
-    def redis_pool(self):
+    def _compress(self, stream):
 
-        return self._redis_pool
+        if self._compressor == self.COMPRESSOR_ZLIB:
+            return zlib.compress(stream, self._compress_level)
+        elif self._compressor == self.COMPRESSOR_LZ4:
+            return lz4.block.compress(stream)
+        else:
+            return stream
 
-    async def async_init_redis(self, *args, **kwargs):
+    def encode(self, val):
 
-        self._redis_pool = await RedisPool(*args, **kwargs)
+        stream = self._serialize(val)
 
-    async def cache_health(self):
+        header = self._serializer
 
-        result = False
+        if self._compressor != self.COMPRESSOR_NONE and len(stream) > self._compress_threshold:
+            stream = self._compress(stream)
+            header |= self._compressor
 
-        async with self.get_cache_client() as cache:
-            result = bool(await cache.time())
+        return bytes((header,)) + stream
 
-        return result
+    def decode(self, val):
 
-    def get_cache_client(self, *, alone=False):
+        header = val[0]
 
-        client = None
+        if header == self.LEGACY_HEADER:
+            return Utils.pickle_loads(val)
 
-        if alone:
+        stream = memoryview(val)[1:]
 
-            client = self._redis_pool.get_client()
+        compressor = header & 0xf0
+        serializer = header & 0x0f
 
-        else:
+        if compressor == self.COMPRESSOR_ZLIB:
+            stream = zlib.decompress(stream)
+        elif compressor == self.COMPRESSOR_LZ4:
+            stream = lz4.block.decompress(stream)
+        elif compressor != self.COMPRESSOR_NONE:
+            raise ValueError(f'Unknown cache codec header: {header}')
 
-            client = self._cache_client_context.get()
+        if serializer == self.SERIALIZER_PICKLE:
+            return pickle.loads(stream)
+        elif serializer == self.SERIALIZER_MSGPACK:
+            return msgpack.unpackb(stream, raw=False)
+        else:
+            raise ValueError(f'Unknown cache codec header: {header}')
 
-            if client is None:
 
-                client = self._redis_pool.get_client()
+class LegacyCacheCodec(CacheCodec):
+    """旧版本缓存数据编解码器
 
-                if client:
-                    self._cache_client_context.set(client)
+    编码保持zlib+pickle格式，解码兼容所有格式，适用于滚动发布期间仍有旧版本节点读取数据的场景
 
-        return client
+    """
 
-    def share_cache(self, cache, ckey):
+    def encode(self, val):
 
-        return ShareCache(cache, ckey)
+        return Utils.pickle_dumps(val)
 
-    def event_dispatcher(self, channel_name, channel_count):
 
-        return DistributedEvent(self._redis_pool, channel_name, channel_count)
+class _CommandPipeline(Pipeline):
+    """支持按命令名追加原始命令的管道
+    """
 
-    def period_counter(self, time_slice: int, key_prefix: str = r'', ntp_client: NTPClient = None):
+    def execute_command(self, command, *args, **kwargs):
 
-        return PeriodCounter(self._redis_pool, time_slice, key_prefix, ntp_client)
+        return Pipeline.__getattr__(self, r'execute')(command, *args, **kwargs)
 
 
-class CacheClient(aioredis.Redis, AsyncContextManager):
-    """Redis客户端对象，使用with进行上下文管理
+class AutoPipeline:
+    """自动管道
 
-    将连接委托给客户端对象管理，提高了整体连接的使用率
+    同一事件循环帧内发起的命令会被合并为一个管道，获取一个连接后一次写入，回复按顺序分发给各调用方的Future
+    管道执行超过timeout秒时关闭该连接使其不再被复用，未完成的命令以asyncio.TimeoutError结束
 
     """
 
-    def __init__(self, pool, expire, key_prefix):
+    # 阻塞、事务和订阅类命令需要独占连接，不能进入自动管道
+    EXCLUSIVE_COMMANDS = {
+        r'BLPOP', r'BRPOP', r'BRPOPLPUSH', r'BZPOPMIN', r'BZPOPMAX', r'XREAD', r'XREADGROUP',
+        r'WATCH', r'UNWATCH', r'MULTI', r'EXEC', r'DISCARD',
+        r'SUBSCRIBE', r'UNSUBSCRIBE', r'PSUBSCRIBE', r'PUNSUBSCRIBE',
+        r'MONITOR', r'SELECT', r'AUTH',
+    }
 
-        super().__init__(None)
+    @classmethod
+    def is_exclusive(cls, command):
+
+        return Utils.basestring(command).upper() in cls.EXCLUSIVE_COMMANDS
+
+    def __init__(self, pool, timeout=REDIS_AUTO_PIPELINE_TIMEOUT):
 
         self._pool = pool
+        self._timeout = timeout
 
-        self._expire = expire
+        self._commands = []
 
-        self._key_prefix = key_prefix
+        self._flush_tasks = set()
+        self._flush_count = 0
 
-    async def _init_conn(self):
+        self._closed = False
 
-        global REDIS_POOL_WATER_LEVEL_WARNING_LINE
+    @property
+    def closed(self):
 
-        if self._pool_or_conn is None and self._pool:
+        return self._closed
 
-            if (self._pool.maxsize - self._pool.size + self._pool.freesize) < REDIS_POOL_WATER_LEVEL_WARNING_LINE:
-                Utils.log.warning(
-                    f'Redis connection pool not enough: '
-                    f'{self._pool.freesize}({self._pool.size}/{self._pool.maxsize})'
-                )
-            else:
-                Utils.log.debug(
-                    f'Redis connection pool info: '
-                    f'{self._pool.freesize}({self._pool.size}/{self._pool.maxsize})'
-                )
+    @property
+    def flush_count(self):
 
-            self._pool_or_conn = await self._pool.acquire()
+        return self._flush_count
 
-    async def _close_conn(self, discard=False):
+    async def _flush(self):
 
-        if self._pool and self._pool_or_conn:
+        commands, self._commands = self._commands, []
 
-            connection, self._pool_or_conn = self._pool_or_conn, None
+        self._flush_count += 1
 
-            if discard:
-                connection.close()
-                await connection.wait_closed()
+        conn = None
 
-            self._pool.release(connection)
+        try:
 
-    async def _context_release(self):
+            conn = await self._pool.acquire()
 
-        await self._close_conn()
+            pipeline = _CommandPipeline(conn, aioredis.Redis)
 
-    async def release(self):
+            for command, args, kwargs, future in commands:
+                if not future.done():
+                    pipeline.execute_command(command, *args, **kwargs).add_done_callback(
+                        Utils.func_partial(self._reply_callback, future)
+                    )
 
-        await self._close_conn()
+            if self._timeout > 0:
+                await asyncio.wait_for(pipeline.execute(return_exceptions=True), self._timeout)
+            else:
+                await pipeline.execute(return_exceptions=True)
 
-    async def _safe_execute(self, func, *args, **kwargs):
+        except Exception as err:
 
-        global REDIS_ERROR_RETRY_COUNT
+            if conn is not None and isinstance(err, asyncio.TimeoutError):
+                Utils.log.warning(f'Redis auto pipeline timeout, connection closed: {conn.address}')
+                conn.close()
 
-        result = None
+            for _, _, _, future in commands:
+                if not future.done():
+                    future.set_exception(err)
 
-        async for times in AsyncCirculator(max_times=REDIS_ERROR_RETRY_COUNT):
+        finally:
 
-            try:
+            if conn is not None:
+                self._pool.release(conn)
 
-                await self._init_conn()
+    @staticmethod
+    def _reply_callback(future, waiter):
 
-                result = await func(*args, **kwargs)
+        if future.done():
+            return
 
-            except (ReplyError, MaxClientsError, AuthError, ReadOnlyError) as err:
+        if waiter.cancelled():
+            future.cancel()
+        elif waiter.exception() is not None:
+            future.set_exception(waiter.exception())
+        else:
+            future.set_result(waiter.result())
 
-                await self._close_conn(True)
+    def _flush_soon(self):
 
-                raise err
+        task = Utils.create_task(self._flush())
 
-            except Exception as err:
+        self._flush_tasks.add(task)
 
-                await self._close_conn(True)
+        task.add_done_callback(self._flush_tasks.discard)
 
-                if times < REDIS_ERROR_RETRY_COUNT:
-                    Utils.log.exception(err)
-                else:
-                    raise err
+    def execute(self, command, *args, **kwargs):
 
-            else:
+        if self._closed:
+            raise aioredis.PoolClosedError(r'Auto pipeline is closed')
 
-                break
+        future = asyncio.Future()
 
-        return result
+        # 刷新任务在下一帧才开始执行，当前帧内追加的命令都会进入同一批次
+        if not self._commands:
+            self._flush_soon()
 
-    async def execute(self, command, *args, **kwargs):
+        self._commands.append((command, args, kwargs, future))
 
-        return await self._safe_execute(super().execute, command, *args, **kwargs)
+        return future
 
-    def _val_encode(self, val):
+    async def close(self):
+        """停止接收新命令，并等待已提交的命令执行完毕
+        """
 
-        return Utils.pickle_dumps(val)
+        self._closed = True
 
-    def _val_decode(self, val):
+        if self._commands:
+            self._flush_soon()
 
-        return Utils.pickle_loads(val)
+        if self._flush_tasks:
+            await asyncio.wait(list(self._flush_tasks))
 
-    def key(self, key, *args, **kwargs):
 
-        if self._key_prefix:
-            key = f'{self._key_prefix}_{key}'
+class RedisScript:
+    """Redis Lua脚本
 
-        if not args and not kwargs:
-            return key
+    配合CacheClient.run_script使用，脚本通过SCRIPT LOAD加载一次后以EVALSHA调用，减少传输和服务端解析开销
 
-        sign = Utils.params_sign(*args, **kwargs)
+    """
 
-        return f'{key}_{sign}'
+    def __init__(self, source):
 
-    def allocate_lock(self, key, expire=60):
+        self._source = source
+        self._sha1 = Utils.sha1(source)
 
-        return MLock(self, key, expire)
+    @property
+    def source(self):
 
-    # TRANSACTION COMMANDS
+        return self._source
 
-    async def unwatch(self):
+    @property
+    def sha1(self):
 
-        return await self._safe_execute(super().unwatch)
+        return self._sha1
 
-    async def watch(self, key, *keys):
 
-        return await self._safe_execute(super().watch, key, *keys)
+class _ConnectionsPool(ConnectionsPool):
+    """带新建连接计数和获取保护的aioredis连接池
 
-    def multi_exec(self):
+    获取连接超过acquire_timeout秒，或连接数已满、没有空闲连接且等待数已达到max_waiting时抛出PoolOverloadError
+    预热、保活和自适应调节对连接池内部状态的访问都集中在本类中，依赖setup.py中固定的aioredis版本
 
-        return MultiExec(self._pool, aioredis.Redis)
+    """
 
-    def pipeline(self):
+    name = None
+    metrics = None
 
-        return Pipeline(self._pool, aioredis.Redis)
+    acquire_timeout = 0
+    max_waiting = 0
 
-    # PUB/SUB COMMANDS
+    _waiting = 0
 
-    async def subscribe(self, channel, *channels):
+    @property
+    def waiting(self):
 
-        return await self._safe_execute(super().subscribe, channel, *channels)
+        return self._waiting
 
-    async def unsubscribe(self, channel, *channels):
+    @property
+    def usedsize(self):
 
-        return await self._safe_execute(super().unsubscribe, channel, *channels)
+        return len(self._used)
 
-    async def psubscribe(self, pattern, *patterns):
+    def set_minsize(self, minsize):
 
-        return await self._safe_execute(super().psubscribe, pattern, *patterns)
+        self._minsize = minsize
 
-    async def punsubscribe(self, pattern, *patterns):
+    def free_connections(self):
 
-        return await self._safe_execute(super().punsubscribe, pattern, *patterns)
+        return list(self._pool)
 
-    @property
-    def channels(self):
+    def take_free(self, conn):
+        """从空闲队列中取出指定连接并计入acquiring，连接已不在空闲队列中时返回False
+        """
 
-        if self._pool_or_conn is None:
-            return None
+        if conn not in self._pool:
+            return False
 
-        return self._pool_or_conn.pubsub_channels
+        self._pool.remove(conn)
+        self._acquiring += 1
 
-    @property
-    def patterns(self):
+        return True
 
-        if self._pool_or_conn is None:
-            return None
+    def reserve(self, count=1):
 
-        return self._pool_or_conn.pubsub_patterns
+        self._acquiring += count
 
-    @property
-    def in_pubsub(self):
+    def unreserve(self, count=1):
 
-        if self._pool_or_conn is None:
-            return None
+        self._acquiring -= count
 
-        return self._pool_or_conn.in_pubsub
+    async def put_free(self, conn=None):
 
-    # GENERIC COMMANDS
+        async with self._cond:
 
-    async def delete(self, *keys):
+            if conn is not None:
+                self._pool.append(conn)
 
-        _keys = []
+            self._cond.notify()
 
-        for key in keys:
+    def close_free(self, count):
 
-            if key.find(r'*') < 0:
-                _keys.append(key)
-            else:
-                _keys.extend((await self.keys(key)))
+        while count > 0 and self._pool:
+            self._pool.popleft().close()
+            count -= 1
 
-        result = (await super().delete(*_keys)) if len(_keys) > 0 else 0
+    async def fill_free(self):
 
-        return result
+        async with self._cond:
+            await self._fill_free(override_min=False)
 
-    def _delete(self, key, *keys):
+    async def create_connection(self):
 
-        return super().delete(key, *keys)
+        return await self._create_new_connection(self.address)
 
-    async def keys(self, pattern):
+    async def _create_new_connection(self, address):
 
-        result = await super().keys(pattern)
+        conn = await super()._create_new_connection(address)
 
-        if result is not None:
-            result = [Utils.basestring(key) for key in result]
+        if self.metrics is not None:
+            self.metrics.incr_conn_created()
 
-        return result
+        return conn
 
-    def _keys(self, pattern, *, encoding=_NOTSET):
+    async def acquire(self, command=None, args=()):
 
-        return super().keys(pattern, encoding=encoding)
+        # 连接池未满时可以新建连接，不会排队等待
+        saturated = self.freesize == 0 and self.size >= self.maxsize
 
-    async def randomkey(self):
+        if self.max_waiting > 0 and self._waiting >= self.max_waiting and saturated:
 
-        result = await super().randomkey()
+            if self.metrics is not None:
+                self.metrics.incr_acquire_rejected()
 
-        if result is not None:
-            result = Utils.basestring(result)
+            raise PoolOverloadError(f'Redis connection pool ({self.name}) waiting queue full: {self._waiting}')
 
-        return result
+        self._waiting += 1
 
-    def _randomkey(self, *, encoding=_NOTSET):
+        try:
 
-        return super().randomkey(encoding=encoding)
+            if self.acquire_timeout > 0:
+                return await asyncio.wait_for(super().acquire(command, args), self.acquire_timeout)
+            else:
+                return await super().acquire(command, args)
 
-    async def scan(self, cursor=0, match=None, count=None):
+        except asyncio.TimeoutError:
 
-        result = await super().scan(cursor, match, count)
+            if self.metrics is not None:
+                self.metrics.incr_acquire_timeout()
 
-        if result is not None:
-            result = (result[0], [Utils.basestring(val) for val in result[1]])
+            raise PoolOverloadError(f'Redis connection pool ({self.name}) acquire timeout: {self.acquire_timeout}s')
 
-        return result
+        finally:
 
-    def _scan(self, cursor=0, match=None, count=None):
+            self._waiting -= 1
 
-        return super().scan(cursor, match, count)
 
-    # STRING COMMANDS
+class RedisPool:
+    """Redis连接管理
 
-    async def get(self, key):
+    adaptive为True时，每adaptive_interval秒根据获取连接的等待耗时在minsize与maxsize之间调整连接池的最小连接数
+    warmup为True时，初始化时并发建立最小连接数的连接并逐个ping校验
+    keepalive_interval大于0时，定期ping空闲连接，避免连接被服务端或中间网络设备的空闲超时断开
+    命令失败时按retry_policy退避重试，连续失败时由连接池独立的circuit_breaker熔断
+    获取连接超过acquire_timeout秒，或连接数已满、没有空闲连接且等待数已达到max_waiting(为0时不限)时抛出PoolOverloadError
 
-        result = await super().get(key)
+    """
 
-        if result is not None:
-            result = self._val_decode(result)
+    def __init__(
+            self, address, password=None, *, minsize=8, maxsize=32, db=0, expire=0, key_prefix=None, codec=None,
+            auto_pipeline=False, lock_notify=False, name=None, adaptive=False, adaptive_interval=10,
+            retry_policy=None, circuit_breaker=None, warmup=True, keepalive_interval=60,
+            acquire_timeout=10, max_waiting=0,
+            **settings
+    ):
 
-        return result
+        self._name = name if name is not None else str(address)
 
-    def _get(self, key, *, encoding=_NOTSET):
+        self._pool = None
+        self._expire = expire
+        self._key_prefix = key_prefix
+        self._codec = codec if codec is not None else LegacyCacheCodec()
 
-        return super().get(key, encoding=encoding)
+        self._auto_pipeline = None
+        self._auto_pipeline_enabled = auto_pipeline
 
-    async def getset(self, key, value):
+        # 已加载到服务端的脚本sha1集合
+        self._script_registry = set()
 
-        _value = self._val_encode(value)
+        self._lock_dispatcher = None
+        self._lock_notify_enabled = lock_notify
 
-        result = await super().getset(key, _value)
+        self._metrics = PoolMetrics(self._name)
 
-        if result is not None:
-            result = self._val_decode(result)
+        self._retry_policy = retry_policy if retry_policy is not None else RetryPolicy(REDIS_ERROR_RETRY_COUNT)
+        self._circuit_breaker = circuit_breaker if circuit_breaker is not None else CircuitBreaker(self._name)
 
-        return result
+        self._pool_sizer = PoolSizer(minsize, maxsize) if adaptive else None
+        self._adaptive_task = None
+        self._adaptive_interval = adaptive_interval
 
-    def _getset(self, key, value, *, encoding=_NOTSET):
+        self._warmup = warmup
+        self._warmup_time = 0
 
-        return super().getset(key, value, encoding=encoding)
+        self._keepalive_task = None
+        self._keepalive_interval = keepalive_interval
 
-    async def mget(self, key, *keys):
+        self._acquire_timeout = acquire_timeout
+        self._max_waiting = max_waiting
 
-        result = await super().mget(key, *keys)
+        self._settings = settings
 
-        if result is not None:
-            result = [self._val_decode(val) for val in result]
+        self._settings[r'address'] = address
+        self._settings[r'password'] = password
 
-        return result
+        self._settings[r'minsize'] = minsize
+        self._settings[r'maxsize'] = maxsize
 
-    def _mget(self, key, *keys, encoding=_NOTSET):
+        self._settings[r'db'] = db
 
-        return super().mget(key, *keys, encoding=encoding)
+    @property
+    def expire(self):
 
-    async def set(self, key, value, expire=0):
+        return self._expire
 
-        _value = self._val_encode(value)
-        _expire = expire if expire > 0 else self._expire
+    @property
+    def key_prefix(self):
 
-        result = await super().set(key, _value, expire=_expire)
+        return self._key_prefix
 
-        return result
+    @property
+    def codec(self):
 
-    def _set(self, key, value, *, expire=0, pexpire=0, exist=None):
+        return self._codec
 
-        return super().set(key, value, expire=expire, pexpire=pexpire, exist=exist)
+    @property
+    def lock_dispatcher(self):
 
-    async def mset(self, key, value, *pairs):
+        return self._lock_dispatcher
 
-        _value = self._val_encode(value)
-        _pairs = [item if index % 2 == 0 else self._val_encode(item) for index, item in enumerate(pairs)]
+    @property
+    def metrics(self):
 
-        result = await super().mset(key, _value, *_pairs)
+        return self._metrics
 
-        return result
+    @property
+    def retry_policy(self):
 
-    def _mset(self, key, value, *pairs):
+        return self._retry_policy
 
-        return super().mset(key, value, *pairs)
+    @property
+    def circuit_breaker(self):
 
-    async def msetnx(self, key, value, *pairs):
+        return self._circuit_breaker
 
-        _value = self._val_encode(value)
-        _pairs = [item if index % 2 == 0 else self._val_encode(item) for index, item in enumerate(pairs)]
+    def __await__(self):
 
-        result = await super().msetnx(key, _value, *_pairs)
+        if self._warmup:
+            # 连接池从空池创建，最小连接数由预热并发建立
+            self._pool = yield from aioredis.create_pool(
+                pool_cls=_ConnectionsPool, **dict(self._settings, minsize=0)
+            ).__await__()
+            self._pool.set_minsize(self._settings[r'minsize'])
+        else:
+            self._pool = yield from aioredis.create_pool(pool_cls=_ConnectionsPool, **self._settings).__await__()
 
-        return result
+        self._pool.name = self._name
+        self._pool.metrics = self._metrics
+        self._pool.acquire_timeout = self._acquire_timeout
+        self._pool.max_waiting = self._max_waiting
 
-    def _msetnx(self, key, value, *pairs):
+        self._metrics.incr_conn_created(self._pool.size)
 
-        return super().msetnx(key, value, *pairs)
+        if self._warmup:
+            yield from self.warm_up().__await__()
 
-    async def psetex(self, key, milliseconds, value):
+        if self._pool_sizer is not None:
+            self._adaptive_task = IntervalTask.create(self._adaptive_interval, False, self._adjust_pool_size)
 
+        if self._keepalive_interval > 0:
+            self._keepalive_task = IntervalTask.create(self._keepalive_interval, False, self._keep_alive)
+
+        if self._auto_pipeline_enabled:
+            self._auto_pipeline = AutoPipeline(self._pool)
+
+        if self._lock_notify_enabled:
+            self._lock_dispatcher = DistributedEvent(self, r'mlock_notify', 1)
+
+        Utils.log.info(f"Redis {self._settings[r'address']} initialized: {self._pool.size}/{self._pool.maxsize}")
+
+        return self
+
+    async def _create_conn(self):
+
+        pool = self._pool
+
+        conn = await pool.create_connection()
+
+        try:
+            await conn.execute(b'PING')
+        except Exception as err:
+            conn.close()
+            raise err
+
+        return conn
+
+    async def warm_up(self):
+        """预热连接池
+
+        并发建立连接直至达到最小连接数，ping校验通过后放入空闲队列，返回预热耗时(秒)
+        全部连接失败时抛出异常，部分失败时只记录日志，缺少的连接在获取时按需补充
+
+        """
+
+        pool = self._pool
+
+        begin_time = Utils.loop_time()
+
+        count = pool.minsize - pool.size
+
+        if count > 0:
+
+            pool.reserve(count)
+
+            try:
+                results = await asyncio.gather(*(self._create_conn() for _ in range(count)), return_exceptions=True)
+            finally:
+                pool.unreserve(count)
+
+            errors = [result for result in results if isinstance(result, Exception)]
+
+            for result in results:
+                if not isinstance(result, Exception):
+                    await pool.put_free(result)
+
+            if len(errors) == count:
+                raise errors[0]
+            elif errors:
+                Utils.log.error(f'Redis connection pool warm up ({self._name}) failed {len(errors)}: {errors[0]!r}')
+
+        self._warmup_time = Utils.loop_time() - begin_time
+
+        Utils.log.info(
+            f'Redis connection pool warmed up ({self._name}): '
+            f'{pool.size}/{pool.maxsize} in {self._warmup_time:.3f}s'
+        )
+
+        return self._warmup_time
+
+    async def _keep_alive(self):
+
+        pool = self._pool
+
+        if pool is None or pool.closed:
+            return
+
+        for conn in pool.free_connections():
+
+            # 检测期间从空闲队列中取出，计入acquiring以保持连接池大小不变
+            if not pool.take_free(conn):
+                continue
+
+            try:
+                await conn.execute(b'PING')
+            except Exception as err:
+                conn.close()
+                conn = None
+                Utils.log.warning(f'Redis connection keep alive ({self._name}) failed: {err!r}')
+            finally:
+                pool.unreserve()
+
+            await pool.put_free(conn)
+
+        if pool.size < pool.minsize:
+            await pool.fill_free()
+
+    async def _adjust_pool_size(self):
+
+        pool = self._pool
+
+        minsize = self._pool_sizer.calculate(pool.minsize, pool.usedsize, self._metrics.recent_acquire_wait)
+
+        self._metrics.recent_acquire_wait.reset()
+
+        if minsize == pool.minsize:
+            return
+
+        Utils.log.info(f'Redis connection pool resize ({self._name}): minsize {pool.minsize} => {minsize}')
+
+        pool.set_minsize(minsize)
+
+        if pool.size > minsize:
+            pool.close_free(pool.size - minsize)
+        else:
+            await pool.fill_free()
+
+    async def close(self):
+        """停止后台任务，等待自动管道中已提交的命令完成后关闭连接池
+        """
+
+        if self._adaptive_task is not None:
+            self._adaptive_task.stop()
+            self._adaptive_task = None
+
+        if self._keepalive_task is not None:
+            self._keepalive_task.stop()
+            self._keepalive_task = None
+
+        if self._auto_pipeline is not None:
+            await self._auto_pipeline.close()
+
+        if self._lock_dispatcher is not None:
+            await self._lock_dispatcher.close()
+
+        if self._pool is not None and not self._pool.closed:
+            self._pool.close()
+            await self._pool.wait_closed()
+
+    def get_metrics(self):
+
+        result = None
+
+        if self._pool is not None:
+            result = self._metrics.snapshot(
+                size=self._pool.size, free=self._pool.freesize, used=self._pool.usedsize,
+                minsize=self._pool.minsize, maxsize=self._pool.maxsize
+            )
+
+            result[r'circuit_breaker'] = self._circuit_breaker.snapshot()
+            result[r'warmup_time'] = round(self._warmup_time, 3)
+
+        return result
+
+    def get_client(self):
+
+        client = None
+
+        if self._pool is not None:
+            client = CacheClient(
+                self._pool, self._expire, self._key_prefix,
+                self._codec, self._auto_pipeline, self._script_registry, self._lock_dispatcher, self._metrics,
+                self._retry_policy, self._circuit_breaker
+            )
+
+        return client
+
+
+class ShardedRedisPool:
+    """分片Redis连接管理
+
+    每个地址对应一个独立的RedisPool，键通过一致性哈希路由到分片，键中包含{...}时按hash tag路由
+
+    """
+
+    def __init__(self, addresses, password=None, *, virtual_nodes=0xa0, **settings):
+
+        self._shards = [RedisPool(address, password, **settings) for address in addresses]
+
+        self._hash_ring = ConsistentHash([str(address) for address in addresses], virtual_nodes)
+
+        self._initialized = False
+
+    @property
+    def shards(self):
+
+        return self._shards
+
+    def __await__(self):
+
+        yield from asyncio.gather(*self._shards).__await__()
+
+        self._initialized = True
+
+        return self
+
+    async def close(self):
+
+        await asyncio.gather(*(shard.close() for shard in self._shards))
+
+    def get_shard_index(self, key):
+
+        return self._hash_ring.get_node_index(key)
+
+    def get_shard(self, key):
+
+        return self._shards[self._hash_ring.get_node_index(key)]
+
+    def get_metrics(self):
+
+        return [shard.get_metrics() for shard in self._shards]
+
+    def get_client(self):
+
+        client = None
+
+        if self._initialized:
+            client = ShardedCacheClient(self)
+
+        return client
+
+
+class RedisDelegate:
+    """Redis功能组件
+    """
+
+    def __init__(self):
+
+        self._redis_pool = None
+
+        self._cache_client_context = WeakContextVar(f'cache_client_{Utils.uuid1()}')
+
+    @property
+    def redis_pool(self):
+
+        return self._redis_pool
+
+    async def async_init_redis(self, *args, **kwargs):
+
+        self._redis_pool = await RedisPool(*args, **kwargs)
+
+    async def async_init_sharded_redis(self, *args, **kwargs):
+
+        self._redis_pool = await ShardedRedisPool(*args, **kwargs)
+
+    def redis_metrics(self):
+
+        return self._redis_pool.get_metrics()
+
+    async def cache_health(self):
+
+        result = False
+
+        async with self.get_cache_client() as cache:
+            result = bool(await cache.time())
+
+        return result
+
+    def get_cache_client(self, *, alone=False):
+
+        client = None
+
+        if alone:
+
+            client = self._redis_pool.get_client()
+
+        else:
+
+            client = self._cache_client_context.get()
+
+            if client is None:
+
+                client = self._redis_pool.get_client()
+
+                if client:
+                    self._cache_client_context.set(client)
+
+        return client
+
+    def share_cache(self, cache, ckey, *, stale_expire=0, beta=0):
+
+        return ShareCache(cache, ckey, stale_expire=stale_expire, beta=beta)
+
+    def near_cache(self, channel_name, *, maxsize=0xff, ttl=60, expire=0, channel_count=1):
+
+        return NearCache(
+            self._redis_pool, channel_name,
+            maxsize=maxsize, ttl=ttl, expire=expire, channel_count=channel_count
+        )
+
+    def event_dispatcher(self, channel_name, channel_count):
+
+        return DistributedEvent(self._redis_pool, channel_name, channel_count)
+
+    def period_counter(self, time_slice: int, key_prefix: str = r'', ntp_client: NTPClient = None):
+
+        return PeriodCounter(self._redis_pool, time_slice, key_prefix, ntp_client)
+
+
+class CacheClient(aioredis.Redis, AsyncContextManager):
+    """Redis客户端对象，使用with进行上下文管理
+
+    将连接委托给客户端对象管理，提高了整体连接的使用率
+
+    """
+
+    def __init__(
+            self, pool, expire, key_prefix,
+            codec=None, auto_pipeline=None, script_registry=None, lock_dispatcher=None, metrics=None,
+            retry_policy=None, circuit_breaker=None
+    ):
+
+        super().__init__(None)
+
+        self._pool = pool
+
+        self._auto_pipeline = auto_pipeline
+
+        self._script_registry = script_registry if script_registry is not None else set()
+
+        self._lock_dispatcher = lock_dispatcher
+
+        self._metrics = metrics
+
+        self._retry_policy = retry_policy if retry_policy is not None else RetryPolicy(REDIS_ERROR_RETRY_COUNT)
+        self._circuit_breaker = circuit_breaker
+
+        self._expire = expire
+
+        self._key_prefix = key_prefix
+
+        self._codec = codec if codec is not None else LegacyCacheCodec()
+
+    async def _init_conn(self):
+
+        global REDIS_POOL_WATER_LEVEL_WARNING_LINE
+
+        if self._pool_or_conn is None and self._pool:
+
+            if (self._pool.maxsize - self._pool.size + self._pool.freesize) < REDIS_POOL_WATER_LEVEL_WARNING_LINE:
+                Utils.log.warning(
+                    f'Redis connection pool not enough: '
+                    f'{self._pool.freesize}({self._pool.size}/{self._pool.maxsize})'
+                )
+            else:
+                Utils.log.debug(
+                    f'Redis connection pool info: '
+                    f'{self._pool.freesize}({self._pool.size}/{self._pool.maxsize})'
+                )
+
+            begin_time = Utils.loop_time()
+
+            self._pool_or_conn = await self._pool.acquire()
+
+            if self._metrics is not None:
+                self._metrics.observe_acquire(Utils.loop_time() - begin_time)
+
+    async def _close_conn(self, discard=False):
+
+        if self._pool and self._pool_or_conn:
+
+            connection, self._pool_or_conn = self._pool_or_conn, None
+
+            if discard:
+                connection.close()
+                await connection.wait_closed()
+
+            self._pool.release(connection)
+
+    async def _context_release(self):
+
+        await self._close_conn()
+
+    async def release(self):
+
+        await self._close_conn()
+
+    async def _safe_execute(self, func, *args, **kwargs):
+
+        return await self._retry_execute(True, func, *args, **kwargs)
+
+    async def _retry_execute(self, exclusive, func, *args, **kwargs):
+
+        async def _execute():
+
+            if exclusive:
+                await self._init_conn()
+
+            return await func(*args, **kwargs)
+
+        return await self._retry_policy.execute(
+            _execute, breaker=self._circuit_breaker,
+            fatal_errors=(ReplyError, AuthError, ReadOnlyError), failure_errors=(MaxClientsError,),
+            on_error=self._on_execute_error
+        )
+
+    async def _on_execute_error(self, err, retries):
+
+        await self._close_conn(True)
+
+    async def execute(self, command, *args, **kwargs):
+
+        begin_time = Utils.loop_time()
+
+        try:
+
+            # 未持有独占连接时，非独占命令交由自动管道合并发送
+            pipelined = self._auto_pipeline is not None and self._pool_or_conn is None
+
+            if pipelined and not AutoPipeline.is_exclusive(command):
+                return await self._retry_execute(False, self._auto_pipeline.execute, command, *args, **kwargs)
+            else:
+                return await self._safe_execute(super().execute, command, *args, **kwargs)
+
+        finally:
+
+            if self._metrics is not None:
+                self._metrics.observe_command(Utils.loop_time() - begin_time)
+
+    def _val_encode(self, val):
+
+        return self._codec.encode(val)
+
+    def _val_decode(self, val):
+
+        return self._codec.decode(val)
+
+    def key(self, key, *args, **kwargs):
+
+        if self._key_prefix:
+            key = f'{self._key_prefix}_{key}'
+
+        if not args and not kwargs:
+            return key
+
+        sign = Utils.params_sign(*args, **kwargs)
+
+        return f'{key}_{sign}'
+
+    @property
+    def expire(self):
+
+        return self._expire
+
+    def clone(self):
+
+        return type(self)(
+            self._pool, self._expire, self._key_prefix,
+            self._codec, self._auto_pipeline, self._script_registry, self._lock_dispatcher, self._metrics,
+            self._retry_policy, self._circuit_breaker
+        )
+
+    def allocate_lock(self, key, expire=60, *, fair=False, auto_renew=False):
+
+        return MLock(self, key, expire, event_dispatcher=self._lock_dispatcher, fair=fair, auto_renew=auto_renew)
+
+    # SCRIPTING COMMANDS
+
+    async def run_script(self, script, keys=[], args=[]):
+        """执行已注册的Lua脚本
+
+        首次执行时通过SCRIPT LOAD加载脚本，之后使用EVALSHA调用，服务端返回NOSCRIPT时重新加载后重试
+
+        """
+
+        if script.sha1 not in self._script_registry:
+            await self.script_load(script.source)
+            self._script_registry.add(script.sha1)
+
+        try:
+
+            return await self.evalsha(script.sha1, keys, args)
+
+        except ReplyError as err:
+
+            if not str(err).startswith(r'NOSCRIPT'):
+                raise err
+
+        await self.script_load(script.source)
+
+        return await self.evalsha(script.sha1, keys, args)
+
+    async def run_script_many(self, script, params):
+        """通过管道批量执行已注册的Lua脚本
+
+        params为[(keys, args), ...]，返回结果与params顺序一致，返回NOSCRIPT的项会单独重试
+
+        """
+
+        if script.sha1 not in self._script_registry:
+            await self.script_load(script.source)
+            self._script_registry.add(script.sha1)
+
+        pipeline = self.pipeline()
+
+        for keys, args in params:
+            pipeline.evalsha(script.sha1, keys, args)
+
+        result = await pipeline.execute(return_exceptions=True)
+
+        for index, val in enumerate(result):
+
+            if isinstance(val, ReplyError) and str(val).startswith(r'NOSCRIPT'):
+                result[index] = await self.run_script(script, *params[index])
+            elif isinstance(val, Exception):
+                raise val
+
+        return result
+
+    # TRANSACTION COMMANDS
+
+    async def unwatch(self):
+
+        return await self._safe_execute(super().unwatch)
+
+    async def watch(self, key, *keys):
+
+        return await self._safe_execute(super().watch, key, *keys)
+
+    def multi_exec(self):
+
+        return MultiExec(self._pool, aioredis.Redis)
+
+    def pipeline(self):
+
+        return Pipeline(self._pool, aioredis.Redis)
+
+    # PUB/SUB COMMANDS
+
+    async def subscribe(self, channel, *channels):
+
+        return await self._safe_execute(super().subscribe, channel, *channels)
+
+    async def unsubscribe(self, channel, *channels):
+
+        return await self._safe_execute(super().unsubscribe, channel, *channels)
+
+    async def psubscribe(self, pattern, *patterns):
+
+        return await self._safe_execute(super().psubscribe, pattern, *patterns)
+
+    async def punsubscribe(self, pattern, *patterns):
+
+        return await self._safe_execute(super().punsubscribe, pattern, *patterns)
+
+    @property
+    def channels(self):
+
+        if self._pool_or_conn is None:
+            return None
+
+        return self._pool_or_conn.pubsub_channels
+
+    @property
+    def patterns(self):
+
+        if self._pool_or_conn is None:
+            return None
+
+        return self._pool_or_conn.pubsub_patterns
+
+    @property
+    def in_pubsub(self):
+
+        if self._pool_or_conn is None:
+            return None
+
+        return self._pool_or_conn.in_pubsub
+
+    # GENERIC COMMANDS
+
+    async def delete(self, *keys):
+
+        result = 0
+
+        _keys = []
+
+        for key in keys:
+
+            if key.find(r'*') < 0:
+                _keys.append(key)
+            else:
+                async for deleted in self.delete_pattern(key):
+                    result += deleted
+
+        if len(_keys) > 0:
+            result += await super().delete(*_keys)
+
+        return result
+
+    async def delete_pattern(self, pattern, count=REDIS_SCAN_COUNT, batch_size=REDIS_SCAN_COUNT):
+        """基于SCAN的非阻塞模式删除
+
+        按批次通过管道发送UNLINK命令，每完成一批即产出该批次删除的数量，避免KEYS命令阻塞服务端
+
+        """
+
+        cursor = 0
+
+        while True:
+
+            cursor, keys = await self._scan(cursor, pattern, count)
+
+            if keys:
+
+                pipeline = self.pipeline()
+
+                for index in range(0, len(keys), batch_size):
+                    pipeline.unlink(*keys[index:index + batch_size])
+
+                yield sum(await pipeline.execute())
+
+            if cursor == 0:
+                break
+
+    def _delete(self, key, *keys):
+
+        return super().delete(key, *keys)
+
+    async def keys(self, pattern):
+
+        result = await super().keys(pattern)
+
+        if result is not None:
+            result = [Utils.basestring(key) for key in result]
+
+        return result
+
+    def _keys(self, pattern, *, encoding=_NOTSET):
+
+        return super().keys(pattern, encoding=encoding)
+
+    async def randomkey(self):
+
+        result = await super().randomkey()
+
+        if result is not None:
+            result = Utils.basestring(result)
+
+        return result
+
+    def _randomkey(self, *, encoding=_NOTSET):
+
+        return super().randomkey(encoding=encoding)
+
+    async def scan(self, cursor=0, match=None, count=None):
+
+        result = await super().scan(cursor, match, count)
+
+        if result is not None:
+            result = (result[0], [Utils.basestring(val) for val in result[1]])
+
+        return result
+
+    def _scan(self, cursor=0, match=None, count=None):
+
+        return super().scan(cursor, match, count)
+
+    async def scan_iter(self, match=None, count=None):
+
+        cursor = 0
+
+        while True:
+
+            cursor, keys = await self.scan(cursor, match, count)
+
+            for key in keys:
+                yield key
+
+            if cursor == 0:
+                break
+
+    # STRING COMMANDS
+
+    async def get(self, key):
+
+        result = await super().get(key)
+
+        if result is not None:
+            result = self._val_decode(result)
+
+        return result
+
+    def _get(self, key, *, encoding=_NOTSET):
+
+        return super().get(key, encoding=encoding)
+
+    async def getset(self, key, value):
+
+        _value = self._val_encode(value)
+
+        result = await super().getset(key, _value)
+
+        if result is not None:
+            result = self._val_decode(result)
+
+        return result
+
+    def _getset(self, key, value, *, encoding=_NOTSET):
+
+        return super().getset(key, value, encoding=encoding)
+
+    async def mget(self, key, *keys):
+
+        result = await super().mget(key, *keys)
+
+        if result is not None:
+            result = [self._val_decode(val) for val in result]
+
+        return result
+
+    def _mget(self, key, *keys, encoding=_NOTSET):
+
+        return super().mget(key, *keys, encoding=encoding)
+
+    async def set(self, key, value, expire=0):
+
+        _value = self._val_encode(value)
+        _expire = expire if expire > 0 else self._expire
+
+        result = await super().set(key, _value, expire=_expire)
+
+        return result
+
+    def _set(self, key, value, *, expire=0, pexpire=0, exist=None):
+
+        return super().set(key, value, expire=expire, pexpire=pexpire, exist=exist)
+
+    async def mset(self, key, value, *pairs):
+
+        _value = self._val_encode(value)
+        _pairs = [item if index % 2 == 0 else self._val_encode(item) for index, item in enumerate(pairs)]
+
+        result = await super().mset(key, _value, *_pairs)
+
+        return result
+
+    def _mset(self, key, value, *pairs):
+
+        return super().mset(key, value, *pairs)
+
+    async def msetnx(self, key, value, *pairs):
+
+        _value = self._val_encode(value)
+        _pairs = [item if index % 2 == 0 else self._val_encode(item) for index, item in enumerate(pairs)]
+
+        result = await super().msetnx(key, _value, *_pairs)
+
+        return result
+
+    def _msetnx(self, key, value, *pairs):
+
+        return super().msetnx(key, value, *pairs)
+
+    async def psetex(self, key, milliseconds, value):
+
+        _value = self._val_encode(value)
+
+        result = await super().psetex(key, milliseconds, _value)
+
+        return result
+
+    def _psetex(self, key, milliseconds, value):
+
+        return super().psetex(key, milliseconds, value)
+
+    async def setex(self, key, seconds, value):
+
+        _value = self._val_encode(value)
+
+        result = await super().setex(key, seconds, _value)
+
+        return result
+
+    def _setex(self, key, seconds, value):
+
+        return super().setex(key, seconds, value)
+
+    async def setnx(self, key, value):
+
+        _value = self._val_encode(value)
+
+        result = await super().setnx(key, _value)
+
+        return result
+
+    def _setnx(self, key, value):
+
+        return super().setnx(key, value)
+
+    # SET COMMANDS
+
+    async def sdiff(self, key, *keys):
+
+        result = await super().sdiff(key, *keys)
+
+        if result is not None:
+            result = [Utils.basestring(val) for val in result]
+
+        return result
+
+    def _sdiff(self, key, *keys):
+
+        return super().sdiff(key, *keys)
+
+    async def sinter(self, key, *keys):
+
+        result = await super().sinter(key, *keys)
+
+        if result is not None:
+            result = [Utils.basestring(val) for val in result]
+
+        return result
+
+    def _sinter(self, key, *keys):
+
+        return super().sinter(key, *keys)
+
+    async def smembers(self, key):
+
+        result = await super().smembers(key)
+
+        if result is not None:
+            result = [Utils.basestring(val) for val in result]
+
+        return result
+
+    def _smembers(self, key, *, encoding=_NOTSET):
+
+        return super().smembers(key, encoding=encoding)
+
+    async def spop(self, key):
+
+        result = await super().spop(key)
+
+        if result is not None:
+            result = Utils.basestring(result)
+
+        return result
+
+    def _spop(self, key, *, encoding=_NOTSET):
+
+        return super().spop(key, encoding=encoding)
+
+    async def srandmember(self, key, count=1):
+
+        result = await super().srandmember(key, count)
+
+        if result is not None:
+            result = [Utils.basestring(val) for val in result]
+
+        return result
+
+    def _srandmember(self, key, count=None):
+
+        return super().srandmember(key, count)
+
+    async def sunion(self, key, *keys):
+
+        result = await super().sunion(key, *keys)
+
+        if result is not None:
+            result = [Utils.basestring(val) for val in result]
+
+        return result
+
+    def _sunion(self, key, *keys):
+
+        return super().sunion(key, *keys)
+
+    async def sscan(self, key, cursor=0, match=None, count=None):
+
+        result = await super().sscan(key, cursor, match, count)
+
+        if result is not None:
+            result = (result[0], [Utils.basestring(val) for val in result[1]])
+
+        return result
+
+    def _sscan(self, key, cursor=0, match=None, count=None):
+
+        return super().sscan(key, cursor, match, count)
+
+    async def sscan_iter(self, key, match=None, count=None):
+
+        cursor = 0
+
+        while True:
+
+            cursor, members = await self.sscan(key, cursor, match, count)
+
+            for member in members:
+                yield member
+
+            if cursor == 0:
+                break
+
+    # HASH COMMANDS
+
+    async def hget(self, key, field):
+
+        result = await super().hget(key, field)
+
+        if result is not None:
+            result = self._val_decode(result)
+
+        return result
+
+    def _hget(self, key, field, *, encoding=_NOTSET):
+
+        return super().hget(key, field, encoding=encoding)
+
+    async def hgetall(self, key):
+
+        result = await super().hgetall(key)
+
+        if result is not None:
+            result = {Utils.basestring(key): self._val_decode(val) for key, val in result.items()}
+
+        return result
+
+    def _hgetall(self, key, *, encoding=_NOTSET):
+
+        return super().hgetall(key, encoding=encoding)
+
+    async def hkeys(self, key):
+
+        result = await super().hkeys(key)
+
+        if result is not None:
+            result = [Utils.basestring(key) for key in result]
+
+        return result
+
+    def _hkeys(self, key, *, encoding=_NOTSET):
+
+        return super().hkeys(key, encoding=encoding)
+
+    async def hmget(self, key, field, *fields):
+
+        result = await super().hmget(key, field, *fields)
+
+        if result is not None:
+            result = [self._val_decode(val) for val in result]
+
+        return result
+
+    def _hmget(self, key, field, *fields, encoding=_NOTSET):
+
+        return super().hmget(key, field, *fields, encoding=encoding)
+
+    async def hmset(self, key, field, value, *pairs):
+
+        _value = self._val_encode(value)
+        _pairs = [item if index % 2 == 0 else self._val_encode(item) for index, item in enumerate(pairs)]
+
+        result = await super().hmset(key, field, _value, *_pairs)
+
+        return result
+
+    def _hmset(self, key, field, value, *pairs):
+
+        return super().hmset(key, field, value, *pairs)
+
+    async def hmset_dict(self, key, *args, **kwargs):
+
+        for _arg in args:
+            if isinstance(_arg, dict):
+                kwargs.update({key: self._val_encode(val) for key, val in _arg.items()})
+
+        return await super().hmset_dict(key, kwargs)
+
+    def _hmset_dict(self, key, *args, **kwargs):
+
+        return super().hmset_dict(key, *args, **kwargs)
+
+    async def hset(self, key, field, value):
+
+        _value = self._val_encode(value)
+
+        result = await super().hset(key, field, _value)
+
+        return result
+
+    def _hset(self, key, field, value):
+
+        return super().hset(key, field, value)
+
+    async def hsetnx(self, key, field, value):
+
+        _value = self._val_encode(value)
+
+        result = await super().hsetnx(key, field, _value)
+
+        return result
+
+    def _hsetnx(self, key, field, value):
+
+        return super().hsetnx(key, field, value)
+
+    async def hvals(self, key):
+
+        result = await super().hvals(key)
+
+        if result is not None:
+            result = [self._val_decode(val) for val in result]
+
+        return result
+
+    def _hvals(self, key, *, encoding=_NOTSET):
+
+        return super().hvals(key, encoding=encoding)
+
+    async def hscan(self, key, cursor=0, match=None, count=None):
+
+        result = await super().hscan(key, cursor, match, count)
+
+        if result is not None:
+            result = (result[0], [(Utils.basestring(key), self._val_decode(val), ) for key, val in result[1]])
+
+        return result
+
+    def _hscan(self, key, cursor=0, match=None, count=None):
+
+        return super().hscan(key, cursor, match, count)
+
+    async def hscan_iter(self, key, match=None, count=None):
+
+        cursor = 0
+
+        while True:
+
+            cursor, items = await self.hscan(key, cursor, match, count)
+
+            for item in items:
+                yield item
+
+            if cursor == 0:
+                break
+
+    # LIST COMMANDS
+
+    async def blpop(self, key, *, timeout=0):
+
+        result = await super().blpop(key, timeout=timeout)
+
+        if result is not None:
+            result = self._val_decode(result[1])
+
+        return result
+
+    def _blpop(self, key, *keys, timeout=0, encoding=_NOTSET):
+
+        return super().blpop(key, *keys, timeout=timeout, encoding=encoding)
+
+    async def brpop(self, key, *, timeout=0):
+
+        result = await super().brpop(key, timeout=timeout)
+
+        if result is not None:
+            result = self._val_decode(result[1])
+
+        return result
+
+    def _brpop(self, key, *keys, timeout=0, encoding=_NOTSET):
+
+        return super().brpop(key, *keys, timeout=timeout, encoding=encoding)
+
+    async def brpoplpush(self, sourcekey, destkey, timeout=0):
+
+        result = await super().brpoplpush(sourcekey, destkey, timeout)
+
+        if result is not None:
+            result = self._val_decode(result)
+
+        return result
+
+    def _brpoplpush(self, sourcekey, destkey, timeout=0, encoding=_NOTSET):
+
+        return super().brpoplpush(sourcekey, destkey, timeout, encoding)
+
+    async def lindex(self, key, index):
+
+        result = await super().lindex(key, index, encoding=encoding)
+
+        if result is not None:
+            result = self._val_decode(result)
+
+        return result
+
+    def _lindex(self, key, index, *, encoding=_NOTSET):
+
+        return super().lindex(key, index, encoding=encoding)
+
+    async def linsert(self, key, pivot, value, before=False):
+
+        _pivot = self._val_encode(pivot)
         _value = self._val_encode(value)
 
-        result = await super().psetex(key, milliseconds, _value)
+        result = await super().linsert(key, _pivot, _value, before=before)
+
+        return result
+
+    def _linsert(self, key, pivot, value, before=False):
+
+        return super().linsert(key, pivot, value, before=before)
+
+    async def lpop(self, key):
+
+        result = await super().lpop(key)
+
+        if result is not None:
+            result = self._val_decode(result)
+
+        return result
+
+    def _lpop(self, key, *, encoding=_NOTSET):
+
+        return super().lpop(key, encoding=encoding)
+
+    async def lpush(self, key, value, *values):
+
+        _value = self._val_encode(value)
+        _values = [self._val_encode(val) for val in values]
+
+        result = await super().lpush(key, _value, *_values)
+
+        return result
+
+    def _lpush(self, key, value, *values):
+
+        return super().lpush(key, value, *values)
+
+    async def lpushx(self, key, value):
+
+        _value = self._val_encode(value)
+
+        result = await super().lpushx(key, _value)
+
+        return result
+
+    def _lpushx(self, key, value):
+
+        return super().lpushx(key, value)
+
+    async def lrange(self, key, start, stop):
+
+        result = await super().lrange(key, start, stop)
+
+        if result is not None:
+            result = [self._val_decode(val) for val in result]
+
+        return result
+
+    def _lrange(self, key, start, stop, *, encoding=_NOTSET):
+
+        return super().lrange(key, start, stop, encoding=encoding)
+
+    async def lrem(self, key, count, value):
+
+        _value = self._val_encode(value)
+
+        result = await super().lrem(key, count, _value)
+
+        return result
+
+    def _lrem(self, key, count, value):
+
+        return super().lrem(key, count, value)
+
+    async def lset(self, key, index, value):
+
+        _value = self._val_encode(value)
+
+        result = await super().lset(key, index, _value)
+
+        return result
+
+    def _lset(self, key, index, value):
+
+        return super().lset(key, index, value)
+
+    async def rpop(self, key):
+
+        result = await super().rpop(key)
+
+        if result is not None:
+            result = self._val_decode(result)
+
+        return result
+
+    def _rpop(self, key, *, encoding=_NOTSET):
+
+        return super().rpop(self, key, encoding=encoding)
+
+    async def rpoplpush(self, sourcekey, destkey):
+
+        result = await super().rpoplpush(sourcekey, destkey)
+
+        if result is not None:
+            result = self._val_decode(result)
+
+        return result
+
+    def _rpoplpush(self, sourcekey, destkey, *, encoding=_NOTSET):
+
+        return super().rpoplpush(sourcekey, destkey, encoding=encoding)
+
+    async def rpush(self, key, value, *values):
+
+        _value = self._val_encode(value)
+        _values = [self._val_encode(val) for val in values]
+
+        result = await super().rpush(key, _value, *_values)
+
+        return result
+
+    def _rpush(self, key, value, *values):
+
+        return super().rpush(key, value, *values)
+
+    async def rpushx(self, key, value):
+
+        _value = self._val_encode(value)
+
+        result = await super().rpushx(key, _value)
+
+        return result
+
+    def _rpushx(self, key, value):
+
+        return super().rpushx(key, value)
+
+
+class ShardedCacheClient(CacheClient):
+    """分片Redis客户端对象，使用with进行上下文管理
+
+    单键命令以第一个参数作为键路由到对应分片，无键命令发送到第一个分片
+    mget/mset/delete/exists等多键命令按分片拆分后并发执行，结果按原始顺序合并
+    sinter/rename/blpop/zunionstore等其它多键命令要求所有键位于同一分片，否则抛出CrossShardError
+    事务、管道、watch、msetnx和模式订阅要求所有键位于同一分片(可使用{...}hash tag)，否则抛出CrossShardError
+
+    """
+
+    KEYLESS_COMMANDS = {
+        r'SCAN', r'KEYS', r'SCRIPT', r'INFO', r'CONFIG', r'PING', r'ECHO', r'TIME',
+        r'DBSIZE', r'RANDOMKEY', r'FLUSHDB', r'FLUSHALL', r'CLIENT', r'SELECT', r'AUTH',
+    }
+
+    MULTI_KEY_COMMANDS = {
+        r'DEL', r'EXISTS', r'UNLINK', r'TOUCH', r'MGET', r'WATCH', r'PFCOUNT', r'PFMERGE',
+        r'SDIFF', r'SINTER', r'SUNION', r'SDIFFSTORE', r'SINTERSTORE', r'SUNIONSTORE',
+    }
+
+    PAIR_KEY_COMMANDS = {r'MSET', r'MSETNX'}
+
+    TWO_KEY_COMMANDS = {r'RENAME', r'RENAMENX', r'RPOPLPUSH', r'BRPOPLPUSH', r'SMOVE', r'LMOVE', r'BLMOVE'}
+
+    BLOCKING_COMMANDS = {r'BLPOP', r'BRPOP', r'BZPOPMIN', r'BZPOPMAX'}
+
+    NUMKEYS_COMMANDS = {r'ZUNIONSTORE', r'ZINTERSTORE'}
+
+    def __init__(self, sharded_pool):
+
+        shard = sharded_pool.shards[0]
+
+        super().__init__(None, shard.expire, shard.key_prefix, shard.codec)
+
+        self._sharded_pool = sharded_pool
+
+        self._shard_clients = {}
+
+        self._watch_index = None
+
+    def _get_shard_client(self, index):
+
+        client = self._shard_clients.get(index)
+
+        if client is None:
+            client = self._shard_clients[index] = self._sharded_pool.shards[index].get_client()
+
+        return client
+
+    def _get_key_client(self, key):
+
+        return self._get_shard_client(0 if key is None else self._sharded_pool.get_shard_index(key))
+
+    def _get_all_clients(self):
+
+        return [self._get_shard_client(index) for index in range(len(self._sharded_pool.shards))]
+
+    def _group_by_shard(self, keys):
+
+        groups = {}
+
+        for position, key in enumerate(keys):
+            groups.setdefault(self._sharded_pool.get_shard_index(key), []).append(position)
+
+        return groups
+
+    def _get_single_shard(self, keys, index=None):
+
+        for key in keys:
+
+            _index = self._sharded_pool.get_shard_index(key)
+
+            if index is None:
+                index = _index
+            elif index != _index:
+                raise CrossShardError(key)
+
+        return index
+
+    def _get_command_keys(self, command, args):
+
+        command = Utils.basestring(command).upper()
+
+        if command in (r'EVAL', r'EVALSHA'):
+            return list(args[2:2 + int(args[1])]) if len(args) > 1 else []
+        elif command in self.KEYLESS_COMMANDS or len(args) == 0:
+            return []
+        elif command in self.MULTI_KEY_COMMANDS:
+            return list(args)
+        elif command in self.PAIR_KEY_COMMANDS:
+            return list(args[::2])
+        elif command in self.TWO_KEY_COMMANDS:
+            return list(args[:2])
+        elif command in self.BLOCKING_COMMANDS:
+            # 最后一个参数为超时时间
+            return list(args[:-1])
+        elif command in self.NUMKEYS_COMMANDS:
+            return [args[0]] + list(args[2:2 + int(args[1])])
+        elif command == r'BITOP':
+            return list(args[1:])
+        else:
+            return list(args[:1])
+
+    async def _close_conn(self, discard=False):
+
+        self._watch_index = None
+
+        clients, self._shard_clients = self._shard_clients, {}
+
+        for client in clients.values():
+            await client._close_conn(discard)
+
+    async def execute(self, command, *args, **kwargs):
+
+        # 多键命令的所有键必须位于同一分片，否则抛出CrossShardError
+        index = self._get_single_shard(self._get_command_keys(command, args))
+
+        return await self._get_shard_client(0 if index is None else index).execute(command, *args, **kwargs)
+
+    def clone(self):
+
+        return type(self)(self._sharded_pool)
+
+    def allocate_lock(self, key, expire=60, *, fair=False, auto_renew=False):
+
+        shard = self._sharded_pool.get_shard(MLock.gen_lock_tag(key))
+
+        return MLock(self, key, expire, event_dispatcher=shard.lock_dispatcher, fair=fair, auto_renew=auto_renew)
+
+    async def run_script(self, script, keys=[], args=[]):
+
+        index = self._get_single_shard(keys)
+
+        return await self._get_shard_client(0 if index is None else index).run_script(script, keys, args)
+
+    async def run_script_many(self, script, params):
+
+        result = [None] * len(params)
+
+        groups = {}
+
+        for position, (keys, _) in enumerate(params):
+            index = self._get_single_shard(keys)
+            groups.setdefault(0 if index is None else index, []).append(position)
+
+        tasks = MultiTasks()
+
+        for index, positions in groups.items():
+            tasks.append(
+                self._get_shard_client(index).run_script_many(script, [params[position] for position in positions])
+            )
+
+        await tasks
+
+        for positions, values in zip(groups.values(), tasks):
+            for position, value in zip(positions, values):
+                result[position] = value
+
+        return result
+
+    # TRANSACTION COMMANDS
+
+    async def unwatch(self):
+
+        if self._watch_index is None:
+            return True
+
+        index, self._watch_index = self._watch_index, None
+
+        return await self._get_shard_client(index).unwatch()
+
+    async def watch(self, key, *keys):
+
+        index = self._get_single_shard([key, *keys], self._watch_index)
+
+        result = await self._get_shard_client(index).watch(key, *keys)
+
+        self._watch_index = index
+
+        return result
+
+    def multi_exec(self):
+
+        return _ShardedPipeline(self, True, self._watch_index)
+
+    def pipeline(self):
+
+        return _ShardedPipeline(self, False)
+
+    # PUB/SUB COMMANDS
+
+    async def subscribe(self, channel, *channels):
+
+        index = self._get_single_shard([channel, *channels])
+
+        return await self._get_shard_client(index).subscribe(channel, *channels)
+
+    async def unsubscribe(self, channel, *channels):
+
+        index = self._get_single_shard([channel, *channels])
+
+        return await self._get_shard_client(index).unsubscribe(channel, *channels)
+
+    async def psubscribe(self, pattern, *patterns):
+
+        index = self._get_single_shard([pattern, *patterns])
+
+        return await self._get_shard_client(index).psubscribe(pattern, *patterns)
+
+    async def punsubscribe(self, pattern, *patterns):
+
+        index = self._get_single_shard([pattern, *patterns])
+
+        return await self._get_shard_client(index).punsubscribe(pattern, *patterns)
+
+    # GENERIC COMMANDS
+
+    async def delete(self, *keys):
+
+        result = 0
+
+        _keys = []
+
+        for key in keys:
+
+            if key.find(r'*') < 0:
+                _keys.append(key)
+            else:
+                async for deleted in self.delete_pattern(key):
+                    result += deleted
+
+        if len(_keys) > 0:
+
+            groups = self._group_by_shard(_keys)
+
+            tasks = MultiTasks()
+
+            for index, positions in groups.items():
+                tasks.append(self._get_shard_client(index).delete(*[_keys[position] for position in positions]))
+
+            result += sum(await tasks)
 
         return result
 
-    def _psetex(self, key, milliseconds, value):
+    async def delete_pattern(self, pattern, count=REDIS_SCAN_COUNT, batch_size=REDIS_SCAN_COUNT):
 
-        return super().psetex(key, milliseconds, value)
+        for client in self._get_all_clients():
+            async for deleted in client.delete_pattern(pattern, count, batch_size):
+                yield deleted
 
-    async def setex(self, key, seconds, value):
+    async def exists(self, key, *keys):
 
-        _value = self._val_encode(value)
+        _keys = [key, *keys]
 
-        result = await super().setex(key, seconds, _value)
+        groups = self._group_by_shard(_keys)
 
-        return result
+        tasks = MultiTasks()
 
-    def _setex(self, key, seconds, value):
+        for index, positions in groups.items():
+            tasks.append(self._get_shard_client(index).exists(*[_keys[position] for position in positions]))
 
-        return super().setex(key, seconds, value)
+        return sum(await tasks)
 
-    async def setnx(self, key, value):
+    async def keys(self, pattern):
 
-        _value = self._val_encode(value)
+        result = []
 
-        result = await super().setnx(key, _value)
+        for client in self._get_all_clients():
+            result.extend(await client.keys(pattern))
 
         return result
 
-    def _setnx(self, key, value):
+    async def scan(self, cursor=0, match=None, count=None):
+        """跨分片扫描
 
-        return super().setnx(key, value)
+        游标编码为 分片游标 * 分片数 + 分片序号，当前分片扫描完成后切换到下一个分片，全部完成时返回0
 
-    # SET COMMANDS
+        """
 
-    async def sdiff(self, key, *keys):
+        shard_num = len(self._sharded_pool.shards)
 
-        result = await super().sdiff(key, *keys)
+        index, shard_cursor = cursor % shard_num, cursor // shard_num
 
-        if result is not None:
-            result = [Utils.basestring(val) for val in result]
+        shard_cursor, keys = await self._get_shard_client(index).scan(shard_cursor, match, count)
 
-        return result
+        if shard_cursor == 0:
+            index += 1
+            cursor = index if index < shard_num else 0
+        else:
+            cursor = shard_cursor * shard_num + index
 
-    def _sdiff(self, key, *keys):
+        return cursor, keys
 
-        return super().sdiff(key, *keys)
+    async def scan_iter(self, match=None, count=None):
 
-    async def sinter(self, key, *keys):
+        for client in self._get_all_clients():
+            async for key in client.scan_iter(match, count):
+                yield key
 
-        result = await super().sinter(key, *keys)
+    # STRING COMMANDS
 
-        if result is not None:
-            result = [Utils.basestring(val) for val in result]
+    async def mget(self, key, *keys):
 
-        return result
+        _keys = [key, *keys]
 
-    def _sinter(self, key, *keys):
+        result = [None] * len(_keys)
 
-        return super().sinter(key, *keys)
+        groups = self._group_by_shard(_keys)
 
-    async def smembers(self, key):
+        tasks = MultiTasks()
 
-        result = await super().smembers(key)
+        for index, positions in groups.items():
+            tasks.append(self._get_shard_client(index).mget(*[_keys[position] for position in positions]))
 
-        if result is not None:
-            result = [Utils.basestring(val) for val in result]
+        await tasks
+
+        for positions, values in zip(groups.values(), tasks):
+            for position, value in zip(positions, values):
+                result[position] = value
 
         return result
 
-    def _smembers(self, key, *, encoding=_NOTSET):
+    async def mset(self, key, value, *pairs):
 
-        return super().smembers(key, encoding=encoding)
+        _keys = [key, *pairs[::2]]
+        _values = [value, *pairs[1::2]]
 
-    async def spop(self, key):
+        groups = self._group_by_shard(_keys)
 
-        result = await super().spop(key)
+        tasks = MultiTasks()
 
-        if result is not None:
-            result = Utils.basestring(result)
+        for index, positions in groups.items():
 
-        return result
+            _pairs = []
 
-    def _spop(self, key, *, encoding=_NOTSET):
+            for position in positions:
+                _pairs.extend((_keys[position], _values[position],))
 
-        return super().spop(key, encoding=encoding)
+            tasks.append(self._get_shard_client(index).mset(*_pairs))
 
-    async def srandmember(self, key, count=1):
+        return all(await tasks)
 
-        result = await super().srandmember(key, count)
+    async def msetnx(self, key, value, *pairs):
 
-        if result is not None:
-            result = [Utils.basestring(val) for val in result]
+        index = self._get_single_shard([key, *pairs[::2]])
 
-        return result
+        return await self._get_shard_client(index).msetnx(key, value, *pairs)
 
-    def _srandmember(self, key, count=None):
 
-        return super().srandmember(key, count)
+class _ShardedPipeline:
+    """分片管道
 
-    async def sunion(self, key, *keys):
+    命令先在本地记录，执行时根据所有命令的键确定目标分片，键跨分片时抛出CrossShardError且不发送任何命令
 
-        result = await super().sunion(key, *keys)
+    """
 
-        if result is not None:
-            result = [Utils.basestring(val) for val in result]
+    KEYLESS_METHODS = {
+        r'ping', r'echo', r'time', r'info', r'dbsize', r'randomkey', r'flushdb', r'flushall',
+        r'script_load', r'script_exists', r'script_flush', r'unwatch',
+    }
 
-        return result
+    MULTI_KEY_METHODS = {
+        r'delete', r'exists', r'unlink', r'touch', r'mget', r'watch', r'pfcount', r'pfmerge',
+        r'sdiff', r'sinter', r'sunion', r'sdiffstore', r'sinterstore', r'sunionstore', r'blpop', r'brpop',
+    }
 
-    def _sunion(self, key, *keys):
+    PAIR_KEY_METHODS = {r'mset', r'msetnx'}
 
-        return super().sunion(key, *keys)
+    TWO_KEY_METHODS = {r'rename', r'renamenx', r'rpoplpush', r'brpoplpush', r'smove'}
 
-    async def sscan(self, key, cursor=0, match=None, count=None):
+    SCRIPT_METHODS = {r'eval', r'evalsha'}
 
-        result = await super().sscan(key, cursor, match, count)
+    def __init__(self, client, transaction, shard_index=None):
 
-        if result is not None:
-            result = (result[0], [Utils.basestring(val) for val in result[1]])
+        self._client = client
+        self._transaction = transaction
+        self._shard_index = shard_index
 
-        return result
+        self._commands = []
 
-    def _sscan(self, key, cursor=0, match=None, count=None):
+    @classmethod
+    def get_method_keys(cls, name, args, kwargs):
 
-        return super().sscan(key, cursor, match, count)
+        if name in cls.KEYLESS_METHODS:
+            return []
+        elif name in cls.MULTI_KEY_METHODS:
+            return list(args)
+        elif name in cls.PAIR_KEY_METHODS:
+            return list(args[::2])
+        elif name in cls.TWO_KEY_METHODS:
+            return list(args[:2])
+        elif name in cls.SCRIPT_METHODS:
+            return list(kwargs.get(r'keys', args[1] if len(args) > 1 else []))
+        else:
+            return list(args[:1])
 
-    # HASH COMMANDS
+    def __getattr__(self, name):
 
-    async def hget(self, key, field):
+        def _command(*args, **kwargs):
 
-        result = await super().hget(key, field)
+            future = asyncio.Future()
 
-        if result is not None:
-            result = self._val_decode(result)
+            self._commands.append((name, args, kwargs, future))
 
-        return result
+            return future
 
-    def _hget(self, key, field, *, encoding=_NOTSET):
+        return _command
 
-        return super().hget(key, field, encoding=encoding)
+    async def execute(self, *, return_exceptions=False):
 
-    async def hgetall(self, key):
+        commands, self._commands = self._commands, []
 
-        result = await super().hgetall(key)
+        try:
 
-        if result is not None:
-            result = {Utils.basestring(key): self._val_decode(val) for key, val in result.items()}
+            index = self._shard_index
 
-        return result
+            for name, args, kwargs, _ in commands:
+                index = self._client._get_single_shard(self.get_method_keys(name, args, kwargs), index)
 
-    def _hgetall(self, key, *, encoding=_NOTSET):
+        except CrossShardError:
 
-        return super().hgetall(key, encoding=encoding)
+            for _, _, _, future in commands:
+                future.cancel()
 
-    async def hkeys(self, key):
+            raise
 
-        result = await super().hkeys(key)
+        client = self._client._get_shard_client(0 if index is None else index)
 
-        if result is not None:
-            result = [Utils.basestring(key) for key in result]
+        pipeline = client.multi_exec() if self._transaction else client.pipeline()
 
-        return result
+        for name, args, kwargs, future in commands:
+            getattr(pipeline, name)(*args, **kwargs).add_done_callback(
+                Utils.func_partial(AutoPipeline._reply_callback, future)
+            )
 
-    def _hkeys(self, key, *, encoding=_NOTSET):
+        return await pipeline.execute(return_exceptions=return_exceptions)
 
-        return super().hkeys(key, encoding=encoding)
 
-    async def hmget(self, key, field, *fields):
+class MLock(AsyncContextManager):
+    """基于Redis实现的分布式锁，使用with进行上下文管理
 
-        result = await super().hmget(key, field, *fields)
+    连接池开启lock_notify后，等待方通过订阅释放通知被唤醒，不再轮询Redis
+    fair为True时使用FIFO票据队列保证公平性，auto_renew为True时持有锁期间会在后台自动续期
 
-        if result is not None:
-            result = [self._val_decode(val) for val in result]
+    """
 
-        return result
+    # 公平锁票据有效期(毫秒)，等待方需要在有效期内刷新票据，否则会被移出队列
+    FAIR_TICKET_TTL = 10000
 
-    def _hmget(self, key, field, *fields, encoding=_NOTSET):
+    _renew_script = RedisScript('''
+if redis.call("get",KEYS[1]) == ARGV[1] and redis.call("ttl",KEYS[1]) > 0 then
+    return redis.call("expire",KEYS[1],ARGV[2])
+else
+    return 0
+end
+''')
 
-        return super().hmget(key, field, *fields, encoding=encoding)
+    _unlock_script = RedisScript('''
+if redis.call("get",KEYS[1]) == ARGV[1] then
+    return redis.call("del",KEYS[1])
+else
+    return 0
+end
+''')
 
-    async def hmset(self, key, field, value, *pairs):
+    _lock_script = RedisScript('''
+if redis.call("set",KEYS[1],ARGV[1],"NX","EX",ARGV[2]) then
+    return {1,0}
+else
+    return {0,redis.call("pttl",KEYS[1])}
+end
+''')
+
+    _fair_lock_script = RedisScript('''
+local now = tonumber(ARGV[3])
+local ticket_ttl = tonumber(ARGV[4])
+local expired = redis.call("zrangebyscore",KEYS[3],"-inf",now)
+for index = 1, #expired do
+    redis.call("zrem",KEYS[2],expired[index])
+    redis.call("zrem",KEYS[3],expired[index])
+end
+if redis.call("zscore",KEYS[2],ARGV[1]) == false then
+    redis.call("zadd",KEYS[2],now,ARGV[1])
+end
+redis.call("zadd",KEYS[3],now+ticket_ttl,ARGV[1])
+if redis.call("zrange",KEYS[2],0,0)[1] == ARGV[1] and redis.call("set",KEYS[1],ARGV[1],"NX","EX",ARGV[2]) then
+    redis.call("zrem",KEYS[2],ARGV[1])
+    redis.call("zrem",KEYS[3],ARGV[1])
+    return {1,0}
+end
+redis.call("pexpire",KEYS[2],ticket_ttl+ARGV[2]*1000)
+redis.call("pexpire",KEYS[3],ticket_ttl+ARGV[2]*1000)
+return {0,redis.call("pttl",KEYS[1])}
+''')
 
-        _value = self._val_encode(value)
-        _pairs = [item if index % 2 == 0 else self._val_encode(item) for index, item in enumerate(pairs)]
+    _dequeue_script = RedisScript('''
+redis.call("zrem",KEYS[1],ARGV[1])
+return redis.call("zrem",KEYS[2],ARGV[1])
+''')
 
-        result = await super().hmset(key, field, _value, *_pairs)
+    def __init__(self, cache, key, expire, *, event_dispatcher=None, fair=False, auto_renew=False):
 
-        return result
+        self._cache = cache
+        self._expire = expire
 
-    def _hmset(self, key, field, value, *pairs):
+        self._lock_tag = self.gen_lock_tag(key)
+        self._lock_val = Utils.uuid1().encode()
 
-        return super().hmset(key, field, value, *pairs)
+        # 使用锁标识路由时实际生效的hash tag，保证分片环境下队列与锁位于同一节点
+        hash_tag = ConsistentHash.hash_tag(self._lock_tag)
 
-    async def hmset_dict(self, key, *args, **kwargs):
+        self._queue_tag = f'{{{hash_tag}}}_queue'
+        self._timeout_tag = f'{{{hash_tag}}}_timeout'
 
-        for _arg in args:
-            if isinstance(_arg, dict):
-                kwargs.update({key: self._val_encode(val) for key, val in _arg.items()})
+        self._event_dispatcher = event_dispatcher
 
-        return await super().hmset_dict(key, kwargs)
+        self._fair = fair
+        self._auto_renew = auto_renew
+        self._renew_task = None
 
-    def _hmset_dict(self, key, *args, **kwargs):
+        self._locked = False
 
-        return super().hmset_dict(key, *args, **kwargs)
+    @staticmethod
+    def gen_lock_tag(key):
+        """生成锁标识，键中包含花括号时以其摘要作为hash tag，避免键中的花括号干扰分片路由
+        """
 
-    async def hset(self, key, field, value):
+        key = Utils.basestring(key)
 
-        _value = self._val_encode(value)
+        if key.find(r'{') < 0 and key.find(r'}') < 0:
+            return f'process_lock_{key}'
+        else:
+            return f'process_lock_{{{Utils.md5(key)}}}'
 
-        result = await super().hset(key, field, _value)
+    @property
+    def locked(self):
 
-        return result
+        return self._locked
 
-    def _hset(self, key, field, value):
+    async def _context_release(self):
 
-        return super().hset(key, field, value)
+        await self.release()
 
-    async def hsetnx(self, key, field, value):
+    async def exists(self):
 
-        _value = self._val_encode(value)
+        if await self._cache.exists(self._lock_tag):
+            return True
+        else:
+            return False
 
-        result = await super().hsetnx(key, field, _value)
+    async def _try_acquire(self):
 
-        return result
+        if self._fair:
+            locked, pttl = await self._cache.run_script(
+                self._fair_lock_script,
+                [self._lock_tag, self._queue_tag, self._timeout_tag],
+                [self._lock_val, self._expire, Utils.timestamp(True), self.FAIR_TICKET_TTL]
+            )
+        else:
+            locked, pttl = await self._cache.run_script(
+                self._lock_script, [self._lock_tag], [self._lock_val, self._expire]
+            )
 
-    def _hsetnx(self, key, field, value):
+        return locked == 1, pttl
 
-        return super().hsetnx(key, field, value)
+    def _gen_waiter(self, expire_time):
 
-    async def hvals(self, key):
+        if self._event_dispatcher is None:
+            return None
 
-        result = await super().hvals(key)
+        # 等待时间不超过锁的有效期，持有方异常退出时依靠锁过期兜底；公平锁还需要在票据过期前刷新
+        delay = self._expire
 
-        if result is not None:
-            result = [self._val_decode(val) for val in result]
+        if self._fair:
+            delay = min(delay, self.FAIR_TICKET_TTL / 3000)
 
-        return result
+        if expire_time > 0:
+            delay = min(delay, max(0, expire_time - Utils.loop_time()))
 
-    def _hvals(self, key, *, encoding=_NOTSET):
+        return self._event_dispatcher.gen_event_waiter(self._lock_tag, delay)
 
-        return super().hvals(key, encoding=encoding)
+    async def _wait_waiter(self, waiter):
 
-    async def hscan(self, key, cursor=0, match=None, count=None):
+        if waiter is None:
+            await Utils.wait_frame(0xff)
+        else:
+            await waiter
 
-        result = await super().hscan(key, cursor, match, count)
+    @staticmethod
+    def _clear_waiter(waiter):
 
-        if result is not None:
-            result = (result[0], [(Utils.basestring(key), self._val_decode(val), ) for key, val in result[1]])
+        if waiter is not None:
+            waiter.set_result(None)
 
-        return result
+    async def acquire(self, timeout=0):
 
-    def _hscan(self, key, cursor=0, match=None, count=None):
+        if self._locked:
 
-        return super().hscan(key, cursor, match, count)
+            await self.renew()
 
-    # LIST COMMANDS
+        else:
 
-    async def blpop(self, key, *, timeout=0):
+            expire_time = (Utils.loop_time() + timeout) if timeout > 0 else 0
 
-        result = await super().blpop(key, timeout=timeout)
+            while True:
 
-        if result is not None:
-            result = self._val_decode(result[1])
+                # 先注册等待器再尝试加锁，避免错过两者之间发出的释放通知
+                waiter = self._gen_waiter(expire_time) if timeout > 0 else None
 
-        return result
+                locked, _ = await self._try_acquire()
 
-    def _blpop(self, key, *keys, timeout=0, encoding=_NOTSET):
+                if locked:
+                    self._locked = True
+                    self._clear_waiter(waiter)
+                    break
 
-        return super().blpop(key, *keys, timeout=timeout, encoding=encoding)
+                if timeout == 0 or expire_time <= Utils.loop_time():
+                    self._clear_waiter(waiter)
+                    break
 
-    async def brpop(self, key, *, timeout=0):
+                await self._wait_waiter(waiter)
 
-        result = await super().brpop(key, timeout=timeout)
+            if self._locked:
+                self._start_auto_renew()
+            elif self._fair:
+                await self._cache.run_script(
+                    self._dequeue_script, [self._queue_tag, self._timeout_tag], [self._lock_val]
+                )
 
-        if result is not None:
-            result = self._val_decode(result[1])
+        return self._locked
 
-        return result
+    async def wait(self, timeout=0):
 
-    def _brpop(self, key, *keys, timeout=0, encoding=_NOTSET):
+        expire_time = (Utils.loop_time() + timeout) if timeout > 0 else 0
 
-        return super().brpop(key, *keys, timeout=timeout, encoding=encoding)
+        while True:
 
-    async def brpoplpush(self, sourcekey, destkey, timeout=0):
+            waiter = self._gen_waiter(expire_time)
 
-        result = await super().brpoplpush(sourcekey, destkey, timeout)
+            if not await self.exists():
+                self._clear_waiter(waiter)
+                return True
 
-        if result is not None:
-            result = self._val_decode(result)
+            if expire_time > 0 and expire_time <= Utils.loop_time():
+                self._clear_waiter(waiter)
+                return False
 
-        return result
+            await self._wait_waiter(waiter)
 
-    def _brpoplpush(self, sourcekey, destkey, timeout=0, encoding=_NOTSET):
+    def _start_auto_renew(self):
 
-        return super().brpoplpush(sourcekey, destkey, timeout, encoding)
+        if self._auto_renew and self._renew_task is None:
+            self._renew_task = IntervalTask.create(max(1, self._expire / 3), False, self._do_auto_renew)
 
-    async def lindex(self, key, index):
+    def _stop_auto_renew(self):
 
-        result = await super().lindex(key, index, encoding=encoding)
+        if self._renew_task is not None:
+            self._renew_task.stop()
+            self._renew_task = None
 
-        if result is not None:
-            result = self._val_decode(result)
+    async def _do_auto_renew(self):
 
-        return result
+        # 后台续期使用独立的客户端，避免与持有锁的协程争用同一个连接
+        async with self._cache.clone() as cache:
+            if not await cache.run_script(self._renew_script, [self._lock_tag], [self._lock_val, self._expire]):
+                self._locked = False
 
-    def _lindex(self, key, index, *, encoding=_NOTSET):
+        if not self._locked:
+            self._stop_auto_renew()
 
-        return super().lindex(key, index, encoding=encoding)
+    async def renew(self):
 
-    async def linsert(self, key, pivot, value, before=False):
+        if self._locked:
 
-        _pivot = self._val_encode(pivot)
-        _value = self._val_encode(value)
+            if await self._cache.run_script(self._renew_script, [self._lock_tag], [self._lock_val, self._expire]):
+                self._locked = True
+            else:
+                self._locked = False
+                self._stop_auto_renew()
 
-        result = await super().linsert(key, _pivot, _value, before=before)
+        return self._locked
 
-        return result
+    async def release(self):
 
-    def _linsert(self, key, pivot, value, before=False):
+        self._stop_auto_renew()
 
-        return super().linsert(key, pivot, value, before=before)
+        if self._locked:
 
-    async def lpop(self, key):
+            self._locked = False
+
+            released = await self._cache.run_script(self._unlock_script, [self._lock_tag], [self._lock_val])
+
+            if released and self._event_dispatcher is not None:
+                await self._event_dispatcher.dispatch(self._lock_tag)
+
+
+class ShareCache(AsyncContextManager):
+    """共享缓存，使用with进行上下文管理
+
+    基于分布式锁实现的一个缓存共享逻辑，保证在分布式环境下，同一时刻业务逻辑只执行一次，其运行结果会通过缓存被共享
+
+    stale_expire大于0时开启stale-while-revalidate：数据过期后的stale_expire秒内仍返回旧值，只由一个持有者负责刷新
+    beta大于0时开启XFetch概率性提前刷新：依据上次计算耗时，在过期前随机提前触发刷新，beta越大越倾向于提前
+
+    """
+
+    ENVELOPE_MARK = r'__share_cache__'
+
+    def __init__(self, cache, ckey, *, stale_expire=0, beta=0):
+
+        self._cache = cache
+        self._ckey = ckey
+
+        self._stale_expire = stale_expire
+        self._beta = beta
+
+        self._locker = None
+        self._locked = False
 
-        result = await super().lpop(key)
+        self._begin_time = 0
 
-        if result is not None:
-            result = self._val_decode(result)
+        self.result = None
 
-        return result
+    async def _context_release(self):
 
-    def _lpop(self, key, *, encoding=_NOTSET):
+        await self.release()
 
-        return super().lpop(key, encoding=encoding)
+    @property
+    def _envelope_enabled(self):
 
-    async def lpush(self, key, value, *values):
+        return self._stale_expire > 0 or self._beta > 0
 
-        _value = self._val_encode(value)
-        _values = [self._val_encode(val) for val in values]
+    @staticmethod
+    def _now():
 
-        result = await super().lpush(key, _value, *_values)
+        return Utils.timestamp(True) / 1000
 
-        return result
+    def _unpack(self, data):
 
-    def _lpush(self, key, value, *values):
+        if isinstance(data, dict) and data.get(self.ENVELOPE_MARK):
+            return data[r'value'], data[r'expire'], data[r'delta']
+        else:
+            return data, None, 0
 
-        return super().lpush(key, value, *values)
+    def _need_refresh(self, soft_expire, delta):
 
-    async def lpushx(self, key, value):
+        if soft_expire is None:
+            return False
 
-        _value = self._val_encode(value)
+        now = self._now()
 
-        result = await super().lpushx(key, _value)
+        if self._beta > 0 and delta > 0:
+            now -= delta * self._beta * Utils.math.log(1 - Utils.random.random())
 
-        return result
+        return now >= soft_expire
 
-    def _lpushx(self, key, value):
+    async def _store(self, cache, value, expire, begin_time):
 
-        return super().lpushx(key, value)
+        if not self._envelope_enabled:
+            return await cache.set(self._ckey, value, expire)
 
-    async def lrange(self, key, start, stop):
+        _expire = expire if expire > 0 else cache.expire
 
-        result = await super().lrange(key, start, stop)
+        if _expire <= 0:
+            return await cache.set(self._ckey, value, expire)
 
-        if result is not None:
-            result = [self._val_decode(val) for val in result]
+        now = self._now()
 
-        return result
+        data = {
+            self.ENVELOPE_MARK: 1,
+            r'value': value,
+            r'expire': now + _expire,
+            r'delta': (now - begin_time) if begin_time > 0 else 0,
+        }
 
-    def _lrange(self, key, start, stop, *, encoding=_NOTSET):
+        return await cache.set(self._ckey, data, _expire + self._stale_expire)
 
-        return super().lrange(key, start, stop, encoding=encoding)
+    async def get(self):
 
-    async def lrem(self, key, count, value):
+        result = await self._cache.get(self._ckey)
 
-        _value = self._val_encode(value)
+        if result is not None:
 
-        result = await super().lrem(key, count, _value)
+            result, soft_expire, delta = self._unpack(result)
 
-        return result
+            if self._need_refresh(soft_expire, delta):
 
-    def _lrem(self, key, count, value):
+                self._locker = self._cache.allocate_lock(self._ckey)
+                self._locked = await self._locker.acquire()
 
-        return super().lrem(key, count, value)
+                # 持有者返回None负责刷新，其余读者继续使用旧值
+                if self._locked:
+                    self._begin_time = self._now()
+                    result = None
 
-    async def lset(self, key, index, value):
+        else:
 
-        _value = self._val_encode(value)
+            self._locker = self._cache.allocate_lock(self._ckey)
+            self._locked = await self._locker.acquire()
 
-        result = await super().lset(key, index, _value)
+            if self._locked:
+                self._begin_time = self._now()
+            else:
+                await self._locker.wait()
+                result, _, _ = self._unpack(await self._cache.get(self._ckey))
 
         return result
 
-    def _lset(self, key, index, value):
+    async def set(self, value, expire=0):
 
-        return super().lset(key, index, value)
+        result = await self._store(self._cache, value, expire, self._begin_time)
 
-    async def rpop(self, key):
+        return result
 
-        result = await super().rpop(key)
+    async def fetch(self, func, *args, expire=0, **kwargs):
+        """获取共享数据，缓存未命中时执行func并写入缓存
 
-        if result is not None:
-            result = self._val_decode(result)
+        开启stale-while-revalidate或XFetch时，需要刷新的数据由抢到锁的协程在后台重新计算，当前调用直接返回旧值
 
-        return result
+        """
 
-    def _rpop(self, key, *, encoding=_NOTSET):
+        result = await self._cache.get(self._ckey)
 
-        return super().rpop(self, key, encoding=encoding)
+        if result is not None:
 
-    async def rpoplpush(self, sourcekey, destkey):
+            result, soft_expire, delta = self._unpack(result)
 
-        result = await super().rpoplpush(sourcekey, destkey)
+            if self._need_refresh(soft_expire, delta):
 
-        if result is not None:
-            result = self._val_decode(result)
+                # 后台刷新使用独立的客户端和锁，生命周期不受当前上下文影响
+                cache = self._cache.clone()
+                locker = cache.allocate_lock(self._ckey)
 
-        return result
+                if await locker.acquire():
+                    Utils.create_task(self._background_refresh(cache, locker, func, args, kwargs, expire))
+                else:
+                    await cache.release()
 
-    def _rpoplpush(self, sourcekey, destkey, *, encoding=_NOTSET):
+            return result
 
-        return super().rpoplpush(sourcekey, destkey, encoding=encoding)
+        result = await self.get()
 
-    async def rpush(self, key, value, *values):
+        if result is None:
 
-        _value = self._val_encode(value)
-        _values = [self._val_encode(val) for val in values]
+            result = await Utils.awaitable_wrapper(func(*args, **kwargs))
 
-        result = await super().rpush(key, _value, *_values)
+            await self.set(result, expire)
 
         return result
 
-    def _rpush(self, key, value, *values):
-
-        return super().rpush(key, value, *values)
+    async def _background_refresh(self, cache, locker, func, args, kwargs, expire):
 
-    async def rpushx(self, key, value):
+        # 后台任务无人等待，异常必须在此记录，刷新失败时缓存中的旧值保持不变
+        try:
 
-        _value = self._val_encode(value)
+            begin_time = self._now()
 
-        result = await super().rpushx(key, _value)
+            try:
 
-        return result
+                result = await Utils.awaitable_wrapper(func(*args, **kwargs))
 
-    def _rpushx(self, key, value):
+                await self._store(cache, result, expire, begin_time)
 
-        return super().rpushx(key, value)
+            finally:
 
+                await locker.release()
 
-class MLock(AsyncContextManager):
-    """基于Redis实现的分布式锁，使用with进行上下文管理
-    """
+        except Exception as err:
 
-    _renew_script = '''
-if redis.call("get",KEYS[1]) == ARGV[1] and redis.call("ttl",KEYS[1]) > 0 then
-    return redis.call("expire",KEYS[1],ARGV[2])
-else
-    return 0
-end
-'''
+            Utils.log.exception(err)
 
-    _unlock_script = '''
-if redis.call("get",KEYS[1]) == ARGV[1] then
-    return redis.call("del",KEYS[1])
-else
-    return 0
-end
-'''
+        finally:
 
-    def __init__(self, cache, key, expire):
+            await cache.release()
 
-        self._cache = cache
-        self._expire = expire
+    async def release(self):
 
-        self._lock_tag = f'process_lock_{key}'
-        self._lock_val = Utils.uuid1().encode()
+        if self._locked:
 
-        self._locked = False
+            self._locked = False
 
-    @property
-    def locked(self):
+            if self._locker:
+                await self._locker.release()
 
-        return self._locked
+        self._cache = self._locker = None
 
-    async def _context_release(self):
 
-        await self.release()
+class NearCache:
+    """近端缓存
 
-    async def exists(self):
+    进程内StackCache作为一级缓存，Redis作为二级缓存
+    通过set/delete写入的数据会经由消息总线广播失效通知，所有进程收到通知后清除一级缓存中的副本
+    delete的键中包含*时按模式匹配清除一级缓存，不再使用时需调用close停止失效通知的监听
 
-        if await self._cache.exists(self._lock_tag):
-            return True
-        else:
-            return False
+    """
 
-    async def acquire(self, timeout=0):
+    def __init__(self, redis_pool, channel_name, *, maxsize=0xff, ttl=60, expire=0, channel_count=1):
 
-        if self._locked:
+        self._redis_pool = redis_pool
 
-            await self.renew()
+        self._maxsize = maxsize
+        self._expire = expire
 
-        else:
+        self._local_cache = StackCache(maxsize, ttl)
 
-            params = {
-                r'key': self._lock_tag,
-                r'value': self._lock_val,
-                r'expire': self._expire,
-                r'exist': StringCommandsMixin.SET_IF_NOT_EXIST,
-            }
+        self._event_type = f'near_cache_invalidate_{channel_name}'
+        self._event_dispatcher = DistributedEvent(redis_pool, f'near_cache_{channel_name}', channel_count)
+        self._event_dispatcher.add_listener(self._event_type, self._invalidate_handler)
 
-            async for _ in AsyncCirculator(timeout):
+        # 失效版本号，用于丢弃回源期间已被失效的数据
+        self._invalidate_version = 0
 
-                if await self._cache._set(**params):
-                    self._locked = True
+        self._hit_count = 0
+        self._miss_count = 0
+        self._invalidate_count = 0
 
-                if self._locked or timeout == 0:
-                    break
+    def _invalidate_handler(self, *keys):
 
-        return self._locked
+        self._invalidate_version += 1
 
-    async def wait(self, timeout=0):
+        for key in keys:
 
-        async for _ in AsyncCirculator(timeout):
+            if key.find(r'*') < 0:
 
-            if not await self.exists():
-                return True
-        else:
+                if self._local_cache.has(key):
+                    self._local_cache.delete(key)
 
-            return False
+            else:
 
-    async def renew(self):
+                for local_key in self._local_cache.keys():
+                    if fnmatch.fnmatchcase(local_key, key) and self._local_cache.has(local_key):
+                        self._local_cache.delete(local_key)
 
-        if self._locked:
+            self._invalidate_count += 1
 
-            if await self._cache.eval(self._renew_script, [self._lock_tag], [self._lock_val, self._expire]):
-                self._locked = True
-            else:
-                self._locked = False
+    async def get(self, key):
 
-        return self._locked
+        if self._local_cache.has(key):
+            self._hit_count += 1
+            return self._local_cache.get(key)
 
-    async def release(self):
+        self._miss_count += 1
 
-        if self._locked:
-            await self._cache.eval(self._unlock_script, [self._lock_tag], [self._lock_val])
-            self._locked = False
+        result = None
 
+        invalidate_version = self._invalidate_version
 
-class ShareCache(AsyncContextManager):
-    """共享缓存，使用with进行上下文管理
+        async with self._redis_pool.get_client() as cache:
+            result = await cache.get(key)
 
-    基于分布式锁实现的一个缓存共享逻辑，保证在分布式环境下，同一时刻业务逻辑只执行一次，其运行结果会通过缓存被共享
+        if result is not None and invalidate_version == self._invalidate_version:
+            self._local_cache.set(key, result)
 
-    """
+        return result
 
-    def __init__(self, cache, ckey):
+    async def set(self, key, value, expire=0):
 
-        self._cache = cache
-        self._ckey = ckey
+        result = None
 
-        self._locker = None
-        self._locked = False
+        async with self._redis_pool.get_client() as cache:
+            result = await cache.set(key, value, expire if expire > 0 else self._expire)
 
-        self.result = None
+        self._invalidate_handler(key)
 
-    async def _context_release(self):
+        await self._event_dispatcher.dispatch(self._event_type, key)
 
-        await self.release()
+        return result
 
-    async def get(self):
+    async def delete(self, key, *keys):
 
-        result = await self._cache.get(self._ckey)
+        result = None
 
-        if result is None:
+        async with self._redis_pool.get_client() as cache:
+            result = await cache.delete(key, *keys)
 
-            self._locker = self._cache.allocate_lock(self._ckey)
-            self._locked = await self._locker.acquire()
+        self._invalidate_handler(key, *keys)
 
-            if not self._locked:
-                await self._locker.wait()
-                result = await self._cache.get(self._ckey)
+        await self._event_dispatcher.dispatch(self._event_type, key, *keys)
 
         return result
 
-    async def set(self, value, expire=0):
+    def clear_local(self):
 
-        result = await self._cache.set(self._ckey, value, expire)
+        self._local_cache.clear()
 
-        return result
+    async def close(self):
 
-    async def release(self):
+        self._event_dispatcher.remove_listener(self._event_type, self._invalidate_handler)
 
-        if self._locked:
+        await self._event_dispatcher.close()
 
-            self._locked = False
+        self._local_cache.clear()
 
-            if self._locker:
-                await self._locker.release()
+    def stats(self):
 
-        self._cache = self._locker = None
+        total = self._hit_count + self._miss_count
+
+        return {
+            r'size': self._local_cache.size(),
+            r'maxsize': self._maxsize,
+            r'hit': self._hit_count,
+            r'miss': self._miss_count,
+            r'invalidate': self._invalidate_count,
+            r'hit_ratio': (self._hit_count / total) if total > 0 else 0,
+        }
 
 
 class PeriodCounter:
 
     MIN_EXPIRE = 60
 
+    _incr_script = RedisScript('''
+local val = redis.call("incrby",KEYS[1],ARGV[1])
+redis.call("expire",KEYS[1],ARGV[2])
+return val
+''')
+
     def __init__(self, cache_pool: RedisPool, time_slice: int, key_prefix: str = r'', ntp_client: NTPClient = None):
 
         self._cache_pool = cache_pool
@@ -1072,10 +2840,9 @@ class PeriodCounter:
         res = None
 
         async with self._cache_pool.get_client() as cache:
-            pipeline = cache.pipeline()
-            pipeline.incrby(key, val)
-            pipeline.expire(key, max(self._time_slice, self.MIN_EXPIRE))
-            res, _ = await pipeline.execute()
+            res = await cache.run_script(
+                self._incr_script, [key], [val, max(self._time_slice, self.MIN_EXPIRE)]
+            )
 
         return res
 
@@ -1084,10 +2851,9 @@ class PeriodCounter:
         res = None
 
         async with self._cache_pool.get_client() as cache:
-            pipeline = cache.pipeline()
-            pipeline.decrby(key, val)
-            pipeline.expire(key, max(self._time_slice, self.MIN_EXPIRE))
-            res, _ = await pipeline.execute()
+            res = await cache.run_script(
+                self._incr_script, [key], [-val, max(self._time_slice, self.MIN_EXPIRE)]
+            )
 
         return res
 
@@ -1134,3 +2900,189 @@ class PeriodCounter:
             trx = None
 
         return res, trx
+
+
+class RateLimitResult:
+    """限流检查结果
+
+    allowed为是否放行，remaining为剩余配额，retry_after为建议的重试等待秒数(-1表示请求量超过上限，永远无法放行)
+
+    """
+
+    __slots__ = [r'allowed', r'remaining', r'retry_after']
+
+    def __init__(self, allowed, remaining, retry_after):
+
+        self.allowed = allowed
+        self.remaining = remaining
+        self.retry_after = retry_after
+
+    def __bool__(self):
+
+        return self.allowed
+
+    def __repr__(self):
+
+        return f'<RateLimitResult allowed={self.allowed} remaining={self.remaining} retry_after={self.retry_after}>'
+
+
+class _DistributedLimiterBase:
+    """分布式限流器基类
+
+    判断与扣减在同一个Lua脚本中完成，单次往返即可得到结果，时间由客户端传入，可通过NTPClient统一各节点时间
+
+    """
+
+    _script = None
+
+    def __init__(self, cache_pool: RedisPool, key_prefix: str = r'', ntp_client: NTPClient = None):
+
+        self._cache_pool = cache_pool
+
+        self._key_prefix = key_prefix
+
+        self._ntp_client = ntp_client
+
+    def _get_key(self, key: str = None) -> str:
+
+        if key is None:
+            return self._key_prefix
+        else:
+            return f'{self._key_prefix}_{key}'
+
+    def _get_timestamp_ms(self) -> int:
+
+        if self._ntp_client is None:
+            return Utils.timestamp(True)
+        else:
+            return int(self._ntp_client.timestamp * 1000)
+
+    def _get_script_args(self, now_ms: int, cost: int) -> list:
+
+        raise NotImplementedError()
+
+    @staticmethod
+    def _make_result(res) -> RateLimitResult:
+
+        allowed, remaining, retry_after = res
+
+        return RateLimitResult(
+            allowed == 1, remaining, retry_after / 1000 if retry_after > 0 else retry_after
+        )
+
+    async def check(self, key: str = None, cost: int = 1) -> RateLimitResult:
+
+        res = None
+
+        async with self._cache_pool.get_client() as cache:
+            res = await cache.run_script(
+                self._script, [self._get_key(key)], self._get_script_args(self._get_timestamp_ms(), cost)
+            )
+
+        return self._make_result(res)
+
+    async def check_many(self, keys: list, cost: int = 1) -> list:
+
+        res = None
+
+        now_ms = self._get_timestamp_ms()
+
+        async with self._cache_pool.get_client() as cache:
+            res = await cache.run_script_many(
+                self._script, [([self._get_key(key)], self._get_script_args(now_ms, cost)) for key in keys]
+            )
+
+        return [self._make_result(val) for val in res]
+
+
+class SlidingWindowLimiter(_DistributedLimiterBase):
+    """滑动窗口日志限流器
+
+    任意window秒的区间内放行的请求数不超过limit，不存在固定时间片边界处两倍流量的问题
+
+    """
+
+    _script = RedisScript('''
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local limit = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+redis.call("zremrangebyscore",KEYS[1],"-inf",now-window)
+local count = redis.call("zcard",KEYS[1])
+if count+cost<=limit then
+    for index=1,cost do
+        redis.call("zadd",KEYS[1],now,ARGV[5]..":"..index)
+    end
+    redis.call("pexpire",KEYS[1],window)
+    return {1,limit-count-cost,0}
+elseif cost>limit then
+    return {0,limit-count,-1}
+else
+    local oldest = redis.call("zrange",KEYS[1],count+cost-limit-1,count+cost-limit-1,"withscores")
+    return {0,limit-count,tonumber(oldest[2])+window-now}
+end
+''')
+
+    def __init__(
+            self, cache_pool: RedisPool, limit: int, window: float, key_prefix: str = r'', ntp_client: NTPClient = None
+    ):
+
+        super().__init__(cache_pool, key_prefix, ntp_client)
+
+        self._limit = limit
+        self._window = int(window * 1000)
+
+    def _get_script_args(self, now_ms: int, cost: int) -> list:
+
+        return [now_ms, self._window, self._limit, cost, Utils.uuid1()]
+
+
+class TokenBucketLimiter(_DistributedLimiterBase):
+    """令牌桶限流器
+
+    令牌以每秒rate个的速度补充，桶内最多容纳capacity个令牌，允许不超过capacity的突发流量
+
+    """
+
+    _script = RedisScript('''
+local now = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local capacity = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+local state = redis.call("hmget",KEYS[1],"tokens","timestamp")
+local tokens = tonumber(state[1])
+local timestamp = tonumber(state[2])
+if tokens==nil or timestamp==nil then
+    tokens = capacity
+    timestamp = now
+elseif now>timestamp then
+    tokens = math.min(capacity,tokens+(now-timestamp)*rate/1000)
+    timestamp = now
+end
+local allowed = 0
+local retry_after = 0
+if tokens>=cost then
+    tokens = tokens-cost
+    allowed = 1
+elseif cost>capacity then
+    retry_after = -1
+else
+    retry_after = math.ceil((cost-tokens)*1000/rate)
+end
+redis.call("hmset",KEYS[1],"tokens",tostring(tokens),"timestamp",tostring(timestamp))
+redis.call("pexpire",KEYS[1],math.ceil(capacity*1000/rate)+1000)
+return {allowed,math.floor(tokens),retry_after}
+''')
+
+    def __init__(
+            self, cache_pool: RedisPool, rate: float, capacity: int, key_prefix: str = r'', ntp_client: NTPClient = None
+    ):
+
+        super().__init__(cache_pool, key_prefix, ntp_client)
+
+        self._rate = rate
+        self._capacity = capacity
+
+    def _get_script_args(self, now_ms: int, cost: int) -> list:
+
+        return [now_ms, self._rate, self._capacity, cost]
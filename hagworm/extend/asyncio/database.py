@@ -1,31 +1,124 @@
 # -*- coding: utf-8 -*-
 
+import math
+import time
 import asyncio
 import aiomysql
+import threading
 
+from contextvars import ContextVar
+from cachetools import LRUCache
 from aiomysql.sa import SAConnection, Engine
 from aiomysql.sa.engine import _dialect as dialect
+from aiomysql.sa.result import create_result_proxy
+from aiomysql.sa.connection import _distill_params
 
 from pymysql.err import Warning, DataError, IntegrityError, ProgrammingError
 
+from sqlalchemy.sql import ClauseElement
+from sqlalchemy.sql.util import find_tables
+from sqlalchemy.sql.ddl import DDLElement
 from sqlalchemy.sql.selectable import Select
-from sqlalchemy.sql.dml import Insert, Update, Delete
+from sqlalchemy.sql.dml import UpdateBase, Insert, Update, Delete
+from sqlalchemy.dialects.mysql import insert as mysql_insert
 
+from pymongo import monitoring, InsertOne, UpdateOne, UpdateMany, ReplaceOne, DeleteOne, DeleteMany
+from pymongo.errors import BulkWriteError
 from motor.motor_asyncio import AsyncIOMotorClient
 
-from hagworm.extend.error import MySQLReadOnlyError
+from hagworm.extend.cache import StackCache
+from hagworm.extend.error import MySQLReadOnlyError, PoolOverloadError
+from hagworm.extend.metrics import PoolMetrics, PoolSizer, StatementMetrics
 
-from .base import Utils, WeakContextVar, AsyncContextManager, AsyncCirculator
+from .base import Utils, WeakContextVar, AsyncContextManager
+from .event import DistributedEvent
+from .retry import RetryPolicy, CircuitBreaker
+from .task import IntervalTask
 
 
 MONGO_POLL_WATER_LEVEL_WARNING_LINE = 0x08
+MONGO_BULK_WRITE_SIZE = 0x400
+MONGO_STREAM_BATCH_SIZE = 0x400
+MONGO_BULK_ERROR_LIMIT = 0x400
 
-MYSQL_ERROR_RETRY_COUNT = 0x1f
+MYSQL_ERROR_RETRY_COUNT = 0x05
 MYSQL_POLL_WATER_LEVEL_WARNING_LINE = 0x08
+MYSQL_STREAM_BATCH_SIZE = 0x400
+MYSQL_BULK_CHUNK_SIZE = 0x1000
+MYSQL_PACKET_RESERVED_SIZE = 0x400
+MYSQL_COMPILED_CACHE_SIZE = 0x400
+
+
+class _MongoMonitor(monitoring.ConnectionPoolListener, monitoring.CommandListener):
+    """Mongo连接池与命令事件监听
+
+    事件在驱动的工作线程中同步触发，获取连接的开始时间按线程记录
+
+    """
+
+    def __init__(self, metrics):
+
+        self._metrics = metrics
+
+        self._local = threading.local()
+
+    def pool_created(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+
+        self._metrics.incr_conn_created()
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+
+        self._local.begin_time = time.perf_counter()
+
+    def connection_check_out_failed(self, event):
+
+        if event.reason == monitoring.ConnectionCheckOutFailedReason.TIMEOUT:
+            self._metrics.incr_acquire_timeout()
+
+    def connection_checked_out(self, event):
+
+        begin_time = getattr(self._local, r'begin_time', None)
+
+        if begin_time is not None:
+            self._metrics.observe_acquire(time.perf_counter() - begin_time)
+            self._local.begin_time = None
+
+    def connection_checked_in(self, event):
+        pass
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+
+        self._metrics.observe_command(event.duration_micros / 1000000)
+
+    def failed(self, event):
+
+        self._metrics.observe_command(event.duration_micros / 1000000)
 
 
 class MongoPool:
     """Mongo连接管理
+
+    连接池的容量由驱动管理，通过事件监听采集指标
+    驱动会在后台维持最小连接数并回收空闲超时的连接，启动时可调用warm_up提前建立连接
+
     """
 
     def __init__(
@@ -37,6 +130,12 @@ class MongoPool:
 
         self._name = name if name is not None else Utils.uuid1()[:8]
 
+        self._metrics = PoolMetrics(self._name)
+
+        self._warmup_time = 0
+
+        settings[r'event_listeners'] = [*settings.get(r'event_listeners', []), _MongoMonitor(self._metrics)]
+
         settings[r'host'] = host
         settings[r'minPoolSize'] = min_pool_size
         settings[r'maxPoolSize'] = max_pool_size
@@ -63,6 +162,45 @@ class MongoPool:
 
         return self._pool.delegate._topology._servers
 
+    @property
+    def metrics(self):
+
+        return self._metrics
+
+    def get_metrics(self):
+
+        free = used = 0
+
+        for server in self._servers.values():
+            free += len(server.pool.sockets)
+            used += server.pool.active_sockets
+
+        result = self._metrics.snapshot(
+            size=free + used, free=free, used=used,
+            minsize=self._pool.min_pool_size, maxsize=self._pool.max_pool_size
+        )
+
+        result[r'warmup_time'] = round(self._warmup_time, 3)
+
+        return result
+
+    async def warm_up(self):
+        """预热连接池
+
+        并发执行min_pool_size个ping命令，促使驱动同时检出多个连接并完成握手与认证，返回预热耗时(秒)
+
+        """
+
+        begin_time = Utils.loop_time()
+
+        await asyncio.gather(*(self._pool.admin.command(r'ping') for _ in range(max(1, self._pool.min_pool_size))))
+
+        self._warmup_time = Utils.loop_time() - begin_time
+
+        Utils.log.info(f'Mongo connection pool warmed up ({self._name}) in {self._warmup_time:.3f}s')
+
+        return self._warmup_time
+
     def _echo_pool_info(self):
 
         global MONGO_POLL_WATER_LEVEL_WARNING_LINE
@@ -107,6 +245,166 @@ class MongoPool:
         return result
 
 
+class MongoBulkWriter(AsyncContextManager):
+    """Mongo批量写入，使用with进行上下文管理
+
+    写操作先进入缓冲区，缓冲的操作数达到max_size或首个操作缓冲超过flush_interval秒时合并为一次bulk_write
+    ordered为False时服务端会继续执行出错操作之后的写入，为True时在首个错误处停止，本批次剩余操作被丢弃
+    写入错误不会抛出，按在全部操作中的序号汇总到errors中(最多保留MONGO_BULK_ERROR_LIMIT条)，网络等其它异常直接抛出
+
+    async with delegate.get_mongo_bulk_writer(db_name, collection) as writer:
+        await writer.insert_one(document)
+
+    """
+
+    def __init__(self, collection, *, ordered=False, max_size=MONGO_BULK_WRITE_SIZE, flush_interval=1):
+
+        self._collection = collection
+
+        self._ordered = ordered
+        self._max_size = max_size
+        self._flush_interval = flush_interval
+
+        self._lock = asyncio.Lock()
+
+        self._operations = []
+        self._offset = 0
+
+        self._flush_timer = None
+
+        self._errors = []
+
+        self._stats = {
+            r'flush': 0,
+            r'inserted': 0,
+            r'matched': 0,
+            r'modified': 0,
+            r'deleted': 0,
+            r'upserted': 0,
+            r'error': 0,
+        }
+
+    @property
+    def errors(self):
+
+        return self._errors
+
+    @property
+    def stats(self):
+
+        return dict(self._stats)
+
+    @property
+    def pending(self):
+
+        return len(self._operations)
+
+    async def _context_release(self):
+
+        await self.close()
+
+    async def _append(self, operation):
+
+        self._operations.append(operation)
+
+        if len(self._operations) >= self._max_size:
+            await self.flush()
+        elif self._flush_timer is None and self._flush_interval > 0:
+            self._flush_timer = Utils.call_later(self._flush_interval, self._flush_on_timer)
+
+    async def insert_one(self, document):
+
+        await self._append(InsertOne(document))
+
+    async def update_one(self, _filter, update, upsert=False):
+
+        await self._append(UpdateOne(_filter, update, upsert))
+
+    async def update_many(self, _filter, update, upsert=False):
+
+        await self._append(UpdateMany(_filter, update, upsert))
+
+    async def replace_one(self, _filter, replacement, upsert=False):
+
+        await self._append(ReplaceOne(_filter, replacement, upsert))
+
+    async def delete_one(self, _filter):
+
+        await self._append(DeleteOne(_filter))
+
+    async def delete_many(self, _filter):
+
+        await self._append(DeleteMany(_filter))
+
+    async def _flush_on_timer(self):
+
+        self._flush_timer = None
+
+        try:
+            await self.flush()
+        except Exception as err:
+            Utils.log.exception(err)
+
+    def _record_result(self, result):
+
+        self._stats[r'inserted'] += result.get(r'nInserted', 0)
+        self._stats[r'matched'] += result.get(r'nMatched', 0)
+        self._stats[r'modified'] += result.get(r'nModified', 0)
+        self._stats[r'deleted'] += result.get(r'nRemoved', 0)
+        self._stats[r'upserted'] += result.get(r'nUpserted', 0)
+
+    async def flush(self):
+        """立即写入缓冲区中的全部操作
+        """
+
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+
+        async with self._lock:
+
+            if not self._operations:
+                return
+
+            operations, self._operations = self._operations, []
+
+            offset, self._offset = self._offset, self._offset + len(operations)
+
+            self._stats[r'flush'] += 1
+
+            try:
+
+                result = await self._collection.bulk_write(operations, ordered=self._ordered)
+
+                self._record_result(result.bulk_api_result)
+
+            except BulkWriteError as err:
+
+                self._record_result(err.details)
+
+                write_errors = err.details.get(r'writeErrors', [])
+
+                self._stats[r'error'] += len(write_errors)
+
+                for error in write_errors[:max(0, MONGO_BULK_ERROR_LIMIT - len(self._errors))]:
+                    self._errors.append(
+                        {
+                            r'index': offset + error[r'index'],
+                            r'code': error.get(r'code'),
+                            r'errmsg': error.get(r'errmsg'),
+                        }
+                    )
+
+                Utils.log.warning(
+                    f'Mongo bulk write ({self._collection.full_name}) {len(write_errors)} errors: '
+                    f'{write_errors[0].get(r"errmsg") if write_errors else None}'
+                )
+
+    async def close(self):
+
+        await self.flush()
+
+
 class MongoDelegate:
     """Mongo功能组件
     """
@@ -135,6 +433,14 @@ class MongoDelegate:
 
         self._mongo_pool.reset()
 
+    async def mongo_warm_up(self):
+
+        return await self._mongo_pool.warm_up()
+
+    def mongo_metrics(self):
+
+        return self._mongo_pool.get_metrics()
+
     def get_mongo_database(self, db_name):
 
         return self._mongo_pool.get_database(db_name)
@@ -143,187 +449,1141 @@ class MongoDelegate:
 
         return self.get_mongo_database(db_name)[collection]
 
+    def get_mongo_bulk_writer(self, db_name, collection, **kwargs):
 
-class MySQLPool:
-    """MySQL连接管理
-    """
+        return MongoBulkWriter(self.get_mongo_collection(db_name, collection), **kwargs)
 
-    class _Connection(SAConnection):
+    async def stream_mongo_find(
+            self, db_name, collection, _filter=None, projection=None,
+            *, batch_size=MONGO_STREAM_BATCH_SIZE, **kwargs
+    ):
+        """流式查询
 
-        def __init__(self, connection, engine, compiled_cache=None):
+        按batch_size分批从服务端拉取并逐批返回，内存中只保留当前批次，迭代提前终止时关闭服务端游标
 
-            super().__init__(connection, engine, compiled_cache)
+        async for documents in delegate.stream_mongo_find(db_name, collection, {r'status': 1}, [r'_id']):
+            ...
 
-            if not hasattr(connection, r'build_time'):
-                setattr(connection, r'build_time', Utils.loop_time())
+        """
 
-        @property
-        def build_time(self):
+        cursor = self.get_mongo_collection(db_name, collection).find(
+            _filter, projection, batch_size=batch_size, **kwargs
+        )
 
-            return getattr(self._connection, r'build_time', 0)
+        try:
 
-        async def destroy(self):
+            documents = []
 
-            if self._connection is None:
-                return
+            async for document in cursor:
 
-            if self._transaction is not None:
-                await self._transaction.rollback()
-                self._transaction = None
+                documents.append(document)
 
-            self._connection.close()
+                if len(documents) >= batch_size:
+                    yield documents
+                    documents = []
 
-            self._engine.release(self)
-            self._connection = None
-            self._engine = None
+            if documents:
+                yield documents
+
+        finally:
+
+            await cursor.close()
+
+
+class QueryCache:
+    """查询结果缓存
+
+    以编译后的SQL与参数为键缓存find/select的结果，只对调用时指定了cache_ttl的查询生效
+    storage为local时使用进程内StackCache，为redis时使用Redis，为both时先查本地再查Redis
+    缓存按涉及的表打标签，通过DBClient对表执行insert/update/delete(事务在提交后)时清除该表的全部缓存
+    清除失败时只记录日志并计入统计，不影响已经完成的写操作
+    提供redis_pool时，本地缓存的失效通知会经由消息总线广播到所有进程
+
+    """
+
+    STORAGE_LOCAL = r'local'
+    STORAGE_REDIS = r'redis'
+    STORAGE_BOTH = r'both'
 
     def __init__(
-            self, host, port, db, user, password,
-            *, name=None, minsize=8, maxsize=32, echo=False, pool_recycle=21600,
-            charset=r'utf8', autocommit=True, cursorclass=aiomysql.DictCursor,
-            readonly=False, conn_life=43200,
-            **settings
+            self, storage=STORAGE_LOCAL, redis_pool=None,
+            *, name=r'default', maxsize=0xffff, max_ttl=3600, tag_expire=86400
     ):
 
-        self._name = name if name is not None else (Utils.uuid1()[:8] + (r'_ro' if readonly else r'_rw'))
-        self._pool = None
-        self._engine = None
-        self._readonly = readonly
-        self._conn_life = conn_life
+        if storage not in (self.STORAGE_LOCAL, self.STORAGE_REDIS, self.STORAGE_BOTH):
+            raise ValueError(f'Unknown query cache storage: {storage}')
 
-        self._settings = settings
+        if storage != self.STORAGE_LOCAL and redis_pool is None:
+            raise ValueError(f'Query cache storage {storage} requires redis_pool')
 
-        self._settings[r'host'] = host
-        self._settings[r'port'] = port
-        self._settings[r'db'] = db
+        self._storage = storage
+        self._redis_pool = redis_pool
 
-        self._settings[r'user'] = user
-        self._settings[r'password'] = password
+        self._key_prefix = f'query_cache_{name}'
 
-        self._settings[r'minsize'] = minsize
-        self._settings[r'maxsize'] = maxsize
+        self._maxsize = maxsize
+        self._tag_expire = tag_expire
 
-        self._settings[r'echo'] = echo
-        self._settings[r'pool_recycle'] = pool_recycle
-        self._settings[r'charset'] = charset
-        self._settings[r'autocommit'] = autocommit
-        self._settings[r'cursorclass'] = cursorclass
+        self._local_cache = StackCache(maxsize, max_ttl) if storage != self.STORAGE_REDIS else None
+        self._local_tags = {}
 
-    @property
-    def name(self):
+        self._event_type = f'query_cache_invalidate_{name}'
+        self._event_dispatcher = None
 
-        return self._name
+        if self._local_cache is not None and redis_pool is not None:
+            self._event_dispatcher = DistributedEvent(redis_pool, f'query_cache_{name}', 1)
+            self._event_dispatcher.add_listener(self._event_type, self._invalidate_local)
 
-    @property
-    def readonly(self):
+        # 失效版本号，用于丢弃查询期间已被失效的数据
+        self._invalidate_version = 0
 
-        return self._readonly
+        self._hit_count = 0
+        self._miss_count = 0
+        self._invalidate_count = 0
+        self._invalidate_error_count = 0
 
-    @property
-    def conn_life(self):
+    @staticmethod
+    def get_tables(clause):
 
-        return self._conn_life
+        if isinstance(clause, UpdateBase):
+            return [clause.table.name]
+        else:
+            return sorted({table.name for table in find_tables(clause)})
 
-    def __await__(self):
+    def gen_key(self, compiled, dp):
 
-        self._pool = yield from aiomysql.create_pool(**self._settings).__await__()
-        self._engine = Engine(dialect, self._pool)
+        params = sorted(compiled.construct_params(dp).items())
 
-        Utils.log.info(
-            f"MySQL {self._settings[r'host']}:{self._settings[r'port']} {self._settings[r'db']}"
-            f" ({self._name}) initialized: {self._pool.size}/{self._pool.maxsize}"
-        )
+        return f'{self._key_prefix}_{Utils.md5(str(compiled) + repr(params))}'
 
-        return self
+    def _gen_tag_key(self, table):
 
-    def _echo_pool_info(self):
+        return f'{self._key_prefix}_tag_{table}'
 
-        global MYSQL_POLL_WATER_LEVEL_WARNING_LINE
+    def _invalidate_local(self, *tables):
 
-        if (self._pool.maxsize - self._pool.size + self._pool.freesize) < MYSQL_POLL_WATER_LEVEL_WARNING_LINE:
-            Utils.log.warning(
-                f'MySQL connection pool not enough ({self._name}): '
-                f'{self._pool.freesize}({self._pool.size}/{self._pool.maxsize})'
-            )
-        else:
-            Utils.log.debug(
-                f'MySQL connection pool info ({self._name}): '
-                f'{self._pool.freesize}({self._pool.size}/{self._pool.maxsize})'
-            )
+        self._invalidate_version += 1
 
-    async def health(self):
+        for table in tables:
 
-        result = False
+            for key in self._local_tags.pop(table, ()):
 
-        async with self.get_client() as client:
+                if self._local_cache.has(key):
+                    self._local_cache.delete(key)
 
-            proxy = await client.execute(r'select version();')
-            await proxy.close()
+    def _set_local(self, key, tables, record):
 
-            result = True
+        self._local_cache.set(key, record)
+
+        for table in tables:
+
+            keys = self._local_tags.setdefault(table, set())
+
+            # 清理已过期或被淘汰的键，防止标签索引无限增长
+            if len(keys) >= self._maxsize:
+                keys.intersection_update(key for key in list(keys) if self._local_cache.has(key))
+
+            keys.add(key)
+
+    async def _get(self, key):
+
+        record = None
+
+        if self._local_cache is not None:
+            record = self._local_cache.get(key)
+
+        if record is None and self._redis_pool is not None and self._storage != self.STORAGE_LOCAL:
+
+            async with self._redis_pool.get_client() as cache:
+                record = await cache.get(key)
+
+        if record is not None and record[0] < Utils.timestamp(True):
+            record = None
+
+        return record
+
+    async def _set(self, key, tables, record, ttl, invalidate_version):
+
+        if self._storage != self.STORAGE_LOCAL:
+
+            async with self._redis_pool.get_client() as cache:
+
+                # redis的expire仅支持整数秒，不足一秒的ttl向上取整
+                await cache.set(key, record, max(1, math.ceil(ttl)))
+
+                for table in tables:
+                    await cache.sadd(self._gen_tag_key(table), key)
+                    await cache.execute(b'EXPIRE', self._gen_tag_key(table), self._tag_expire)
+
+                if invalidate_version != self._invalidate_version:
+                    await cache.delete(key)
+                    return
+
+        if self._local_cache is not None and invalidate_version == self._invalidate_version:
+            self._set_local(key, tables, record)
+
+    async def fetch(self, key, tables, ttl, func, *args, **kwargs):
+        """读取缓存，未命中时调用func获取结果并写入缓存
+        """
+
+        record = await self._get(key)
+
+        if record is not None:
+
+            self._hit_count += 1
+
+            if self._local_cache is not None and not self._local_cache.has(key):
+                self._set_local(key, tables, record)
+
+            return record[1]
+
+        self._miss_count += 1
+
+        invalidate_version = self._invalidate_version
+
+        result = await func(*args, **kwargs)
+
+        await self._set(key, tables, (Utils.timestamp(True) + ttl * 1000, result,), ttl, invalidate_version)
 
         return result
 
-    async def reset(self):
+    async def _invalidate_redis(self, *tables):
 
-        if self._pool is not None:
+        cache = self._redis_pool.get_client()
+
+        try:
+
+            tag_keys = []
+            keys = []
+
+            # 没有缓存记录的表不存在标签集合，跳过删除
+            for table in tables:
+
+                members = await cache.smembers(self._gen_tag_key(table))
+
+                if members:
+                    tag_keys.append(self._gen_tag_key(table))
+                    keys.extend(members)
+
+            if tag_keys:
+                await cache.delete(*tag_keys, *keys)
+
+        finally:
+
+            await cache.release()
+
+    async def invalidate(self, *tables):
+
+        self._invalidate_count += len(tables)
+
+        if self._local_cache is not None:
+            self._invalidate_local(*tables)
+
+        if self._storage != self.STORAGE_LOCAL:
+
+            try:
+                await self._invalidate_redis(*tables)
+            except Exception as err:
+                self._invalidate_error_count += 1
+                Utils.log.exception(err)
+
+        if self._event_dispatcher is not None:
+
+            try:
+                await self._event_dispatcher.dispatch(self._event_type, *tables)
+            except Exception as err:
+                self._invalidate_error_count += 1
+                Utils.log.exception(err)
+
+    def stats(self):
+
+        total = self._hit_count + self._miss_count
+
+        return {
+            r'storage': self._storage,
+            r'size': self._local_cache.size() if self._local_cache is not None else None,
+            r'hit': self._hit_count,
+            r'miss': self._miss_count,
+            r'invalidate': self._invalidate_count,
+            r'invalidate_error': self._invalidate_error_count,
+            r'hit_ratio': (self._hit_count / total) if total > 0 else 0,
+        }
+
+
+class _MySQLConnectionsPool(aiomysql.Pool):
+    """aiomysql连接池
+
+    预热、保活和自适应调节对连接池内部状态的访问都集中在本类中，依赖setup.py中固定的aiomysql版本
+
+    """
+
+    @classmethod
+    async def create(cls, minsize=1, maxsize=10, echo=False, pool_recycle=-1, loop=None, **kwargs):
+
+        if loop is None:
+            loop = asyncio.get_event_loop()
+
+        pool = cls(minsize=minsize, maxsize=maxsize, echo=echo, pool_recycle=pool_recycle, loop=loop, **kwargs)
+
+        if minsize > 0:
+            await pool.fill_free()
+
+        return pool
+
+    @property
+    def closing(self):
+
+        return self._closing
+
+    @property
+    def usedsize(self):
+
+        return len(self._used)
+
+    def set_minsize(self, minsize):
+
+        self._minsize = minsize
+
+    def free_connections(self):
+
+        return list(self._free)
+
+    def take_free(self, conn):
+        """从空闲队列中取出指定连接并计入acquiring，连接已不在空闲队列中时返回False
+        """
+
+        if conn not in self._free:
+            return False
+
+        self._free.remove(conn)
+        self._acquiring += 1
+
+        return True
+
+    def reserve(self, count=1):
+
+        self._acquiring += count
+
+    def unreserve(self, count=1):
+
+        self._acquiring -= count
+
+    async def put_free(self, conn=None):
+
+        async with self._cond:
+
+            if conn is not None:
+                self._free.append(conn)
+
+            self._cond.notify()
+
+    def close_free(self, count):
+
+        while count > 0 and self._free:
+            self._free.pop().close()
+            count -= 1
+
+    async def fill_free(self):
+
+        async with self._cond:
+            await self._fill_free_pool(False)
+
+    async def create_connection(self):
+
+        return await aiomysql.connect(echo=self._echo, loop=self._loop, **self._conn_kwargs)
+
+
+class MySQLPool:
+    """MySQL连接管理
+
+    adaptive为True时，每adaptive_interval秒根据获取连接的等待耗时在minsize与maxsize之间调整连接池的最小连接数
+    warmup为True时，初始化和reset后并发建立最小连接数的连接并逐个ping校验
+    keepalive_interval大于0时，定期ping空闲超过该时长的连接，避免连接因服务端wait_timeout被断开后在请求中重连
+    语句执行失败时按retry_policy退避重试，连续失败时由连接池独立的circuit_breaker熔断
+    获取连接超过acquire_timeout秒，或连接数已满、没有空闲连接且等待数已达到max_waiting(为0时不限)时抛出PoolOverloadError
+    客户端每次execute完成后调用已注册的执行钩子，默认钩子按语句指纹统计耗时并记录超过slow_time秒的慢查询
+    compiled_cache_size大于0时(默认关闭，推荐值为MYSQL_COMPILED_CACHE_SIZE)，语句中使用bindparam占位并在执行时传入参数，
+    可以复用compiled_cache中的编译结果，避免重复编译，收益可通过testing/benchmark_mysql_compile.py评估
+
+    query = select([table]).where(table.c.id == bindparam(r'id'))
+    await client.find(query, id=1)
+
+    """
+
+    class _Connection(SAConnection):
+
+        def __init__(self, connection, engine, compiled_cache=None):
+
+            super().__init__(connection, engine, compiled_cache)
+
+            if not hasattr(connection, r'build_time'):
+                setattr(connection, r'build_time', Utils.loop_time())
+
+            # 获取该连接时的等待耗时，由首个执行的语句计入统计
+            self.acquire_wait = 0
+
+            # 最近执行的语句，可能是字符串、编译结果或语句对象
+            self.last_statement = None
+
+        @property
+        def last_statement_text(self):
+
+            statement = self.last_statement
+
+            if statement is None or isinstance(statement, str):
+                return statement
+            elif isinstance(statement, ClauseElement):
+                return str(statement.compile(dialect=self._dialect))
+            else:
+                return str(statement)
+
+        @property
+        def build_time(self):
+
+            return getattr(self._connection, r'build_time', 0)
+
+        def compile(self, query, dp=None):
+
+            return MySQLPool.compile_query(query, dp, self._compiled_cache)
+
+        async def _execute(self, query, *multiparams, **params):
+
+            dp = _distill_params(multiparams, params)
+
+            self.last_statement = query
+
+            if len(dp) > 1 or not isinstance(query, ClauseElement) or isinstance(query, DDLElement):
+                return await super()._execute(query, *multiparams, **params)
+
+            dp = dp[0] if dp else None
+
+            cursor = await self._connection.cursor()
+
+            compiled = self.last_statement = self.compile(query, dp)
+
+            await cursor.execute(
+                str(compiled), self._base_params(query, dp, compiled, isinstance(query, UpdateBase))
+            )
+
+            result = await create_result_proxy(self, cursor, self._dialect, compiled._result_columns)
+
+            self._weak_results.add(result)
+
+            return result
+
+        async def execute_unbuffered(self, query, dp=None):
+            """使用无缓冲游标执行查询，返回已执行的游标，结果集由调用方分批读取
+            """
+
+            if issubclass(self._connection.cursorclass, aiomysql.DictCursor):
+                cursor = await self._connection.cursor(aiomysql.SSDictCursor)
+            else:
+                cursor = await self._connection.cursor(aiomysql.SSCursor)
+
+            compiled = self.compile(query, dp)
+
+            await cursor.execute(str(compiled), self._base_params(query, dp, compiled, False))
+
+            return cursor
+
+        async def execute_bulk(self, query, rows, max_stmt_length):
+            """批量执行写入语句，返回影响行数
+
+            语句只编译一次，驱动会将多行参数合并为多值语句，并按max_stmt_length拆分成多条发送
+
+            """
+
+            compiled = query.compile(dialect=self._dialect, column_keys=list(rows[0].keys()))
+
+            params = [self._base_params(query, row, compiled, False) for row in rows]
+
+            cursor = await self._connection.cursor()
+            cursor.max_stmt_length = max_stmt_length
+
+            try:
+                await cursor.executemany(str(compiled), params)
+            finally:
+                await cursor.close()
+
+            return cursor.rowcount
+
+        async def destroy(self):
+
+            if self._connection is None:
+                return
+
+            if self._transaction is not None:
+                await self._transaction.rollback()
+                self._transaction = None
+
+            self._connection.close()
+
+            self._engine.release(self)
+            self._connection = None
+            self._engine = None
+
+    def __init__(
+            self, host, port, db, user, password,
+            *, name=None, minsize=8, maxsize=32, echo=False, pool_recycle=21600,
+            charset=r'utf8', autocommit=True, cursorclass=aiomysql.DictCursor,
+            readonly=False, conn_life=43200, adaptive=False, adaptive_interval=10,
+            compiled_cache_size=0, query_cache=None, slow_time=1,
+            retry_policy=None, circuit_breaker=None, warmup=True, keepalive_interval=60,
+            acquire_timeout=10, max_waiting=0,
+            **settings
+    ):
+
+        self._name = name if name is not None else (Utils.uuid1()[:8] + (r'_ro' if readonly else r'_rw'))
+        self._pool = None
+        self._engine = None
+        self._readonly = readonly
+        self._conn_life = conn_life
+
+        self._max_stmt_length = None
+
+        # 以语句对象为键的编译结果缓存，绑定参数在执行时单独传入
+        self._compiled_cache = LRUCache(compiled_cache_size) if compiled_cache_size > 0 else None
+
+        self._query_cache = query_cache
+
+        self._metrics = PoolMetrics(self._name)
+
+        self._statement_metrics = StatementMetrics(self._name, slow_time=slow_time)
+        self._execute_hooks = [self._statement_metrics.observe]
+
+        self._retry_policy = retry_policy if retry_policy is not None else RetryPolicy(MYSQL_ERROR_RETRY_COUNT)
+        self._circuit_breaker = circuit_breaker if circuit_breaker is not None else CircuitBreaker(self._name)
+
+        self._pool_sizer = PoolSizer(minsize, maxsize) if adaptive else None
+        self._adaptive_task = None
+        self._adaptive_interval = adaptive_interval
+
+        self._warmup = warmup
+        self._warmup_time = 0
+
+        self._keepalive_task = None
+        self._keepalive_interval = keepalive_interval
+
+        self._acquire_timeout = acquire_timeout
+        self._max_waiting = max_waiting
+
+        self._waiting = 0
+
+        self._settings = settings
+
+        self._settings[r'host'] = host
+        self._settings[r'port'] = port
+        self._settings[r'db'] = db
+
+        self._settings[r'user'] = user
+        self._settings[r'password'] = password
+
+        self._settings[r'minsize'] = minsize
+        self._settings[r'maxsize'] = maxsize
+
+        self._settings[r'echo'] = echo
+        self._settings[r'pool_recycle'] = pool_recycle
+        self._settings[r'charset'] = charset
+        self._settings[r'autocommit'] = autocommit
+        self._settings[r'cursorclass'] = cursorclass
+
+    @property
+    def name(self):
+
+        return self._name
+
+    @property
+    def readonly(self):
+
+        return self._readonly
+
+    @property
+    def conn_life(self):
+
+        return self._conn_life
+
+    @property
+    def metrics(self):
+
+        return self._metrics
+
+    @property
+    def query_cache(self):
+
+        return self._query_cache
+
+    @property
+    def retry_policy(self):
+
+        return self._retry_policy
+
+    @property
+    def circuit_breaker(self):
+
+        return self._circuit_breaker
+
+    @property
+    def statement_metrics(self):
+
+        return self._statement_metrics
+
+    def add_execute_hook(self, hook):
+        """注册执行钩子
+
+        钩子签名为hook(statement, elapsed, *, rowcount, retries, acquire_wait, error)，耗时单位为秒
+        statement为执行的SQL文本，error为最终抛出的异常，执行成功时为None
+
+        """
+
+        if hook not in self._execute_hooks:
+            self._execute_hooks.append(hook)
+
+    def remove_execute_hook(self, hook):
+
+        if hook in self._execute_hooks:
+            self._execute_hooks.remove(hook)
+
+    def observe_execute(self, statement, elapsed, **kwargs):
+
+        for hook in self._execute_hooks:
+            try:
+                hook(statement, elapsed, **kwargs)
+            except Exception as err:
+                Utils.log.exception(err)
+
+    def get_statement_metrics(self):
+
+        return self._statement_metrics.snapshot()
+
+    def __await__(self):
+
+        if self._warmup:
+            # 连接池从空池创建，最小连接数由预热并发建立
+            self._pool = yield from _MySQLConnectionsPool.create(**dict(self._settings, minsize=0)).__await__()
+            self._pool.set_minsize(self._settings[r'minsize'])
+        else:
+            self._pool = yield from _MySQLConnectionsPool.create(**self._settings).__await__()
+
+        self._engine = Engine(dialect, self._pool)
+
+        for conn in self._pool.free_connections():
+            self._mark_conn(conn)
+
+        if self._warmup:
+            yield from self.warm_up().__await__()
+
+        if self._pool_sizer is not None:
+            self._adaptive_task = IntervalTask.create(self._adaptive_interval, False, self._adjust_pool_size)
+
+        if self._keepalive_interval > 0:
+            self._keepalive_task = IntervalTask.create(self._keepalive_interval, False, self._keep_alive)
+
+        Utils.log.info(
+            f"MySQL {self._settings[r'host']}:{self._settings[r'port']} {self._settings[r'db']}"
+            f" ({self._name}) initialized: {self._pool.size}/{self._pool.maxsize}"
+        )
+
+        return self
+
+    def _echo_pool_info(self):
+
+        global MYSQL_POLL_WATER_LEVEL_WARNING_LINE
+
+        if (self._pool.maxsize - self._pool.size + self._pool.freesize) < MYSQL_POLL_WATER_LEVEL_WARNING_LINE:
+            Utils.log.warning(
+                f'MySQL connection pool not enough ({self._name}): '
+                f'{self._pool.freesize}({self._pool.size}/{self._pool.maxsize})'
+            )
+        else:
+            Utils.log.debug(
+                f'MySQL connection pool info ({self._name}): '
+                f'{self._pool.freesize}({self._pool.size}/{self._pool.maxsize})'
+            )
+
+    def _mark_conn(self, conn):
+
+        if not hasattr(conn, r'build_time'):
+            setattr(conn, r'build_time', Utils.loop_time())
+            self._metrics.incr_conn_created()
+
+    async def _create_conn(self):
+
+        conn = await self._pool.create_connection()
+
+        try:
+            await conn.ping(False)
+        except Exception as err:
+            conn.close()
+            raise err
+
+        return conn
+
+    async def warm_up(self):
+        """预热连接池
+
+        并发建立连接直至达到最小连接数，ping校验通过后放入空闲队列，返回预热耗时(秒)
+        全部连接失败时抛出异常，部分失败时只记录日志，缺少的连接在获取时按需补充
+
+        """
+
+        pool = self._pool
+
+        begin_time = Utils.loop_time()
+
+        count = pool.minsize - pool.size
+
+        if count > 0:
+
+            pool.reserve(count)
+
+            try:
+                results = await asyncio.gather(*(self._create_conn() for _ in range(count)), return_exceptions=True)
+            finally:
+                pool.unreserve(count)
+
+            errors = [result for result in results if isinstance(result, Exception)]
+
+            for result in results:
+                if not isinstance(result, Exception):
+                    self._mark_conn(result)
+                    await pool.put_free(result)
+
+            if len(errors) == count:
+                raise errors[0]
+            elif errors:
+                Utils.log.error(f'MySQL connection pool warm up ({self._name}) failed {len(errors)}: {errors[0]!r}')
+
+        self._warmup_time = Utils.loop_time() - begin_time
+
+        Utils.log.info(
+            f'MySQL connection pool warmed up ({self._name}): '
+            f'{pool.size}/{pool.maxsize} in {self._warmup_time:.3f}s'
+        )
+
+        return self._warmup_time
+
+    async def _keep_alive(self):
+
+        pool = self._pool
+
+        if pool is None or pool.closing:
+            return
+
+        now_time = Utils.loop_time()
+
+        conns = [
+            conn for conn in pool.free_connections() if (now_time - conn.last_usage) >= self._keepalive_interval
+        ]
+
+        for conn in conns:
+
+            # 检测期间从空闲队列中取出，计入acquiring以保持连接池大小不变
+            if not pool.take_free(conn):
+                continue
+
+            try:
+                await conn.ping(False)
+            except Exception as err:
+                conn.close()
+                conn = None
+                Utils.log.warning(f'MySQL connection keep alive ({self._name}) failed: {err!r}')
+            finally:
+                pool.unreserve()
+
+            await pool.put_free(conn)
+
+        if pool.size < pool.minsize:
+            await pool.fill_free()
+
+    async def _adjust_pool_size(self):
+
+        pool = self._pool
+
+        minsize = self._pool_sizer.calculate(pool.minsize, pool.usedsize, self._metrics.recent_acquire_wait)
+
+        self._metrics.recent_acquire_wait.reset()
+
+        if minsize == pool.minsize:
+            return
+
+        Utils.log.info(f'MySQL connection pool resize ({self._name}): minsize {pool.minsize} => {minsize}')
+
+        pool.set_minsize(minsize)
+
+        if pool.size > minsize:
+            pool.close_free(pool.size - minsize)
+        else:
+            await pool.fill_free()
+
+    def get_metrics(self):
+
+        result = None
+
+        if self._pool is not None:
+            result = self._metrics.snapshot(
+                size=self._pool.size, free=self._pool.freesize, used=self._pool.usedsize,
+                minsize=self._pool.minsize, maxsize=self._pool.maxsize
+            )
+
+            result[r'circuit_breaker'] = self._circuit_breaker.snapshot()
+            result[r'warmup_time'] = round(self._warmup_time, 3)
+
+        return result
+
+    @staticmethod
+    def compile_query(query, dp=None, compiled_cache=None):
+        """编译语句，绑定参数与语句分离(通过dp传入)时编译结果缓存在compiled_cache中
+
+        缓存以语句对象为键，语句内嵌的绑定参数值随语句对象固定，执行时传入的参数在construct_params时覆盖
+
+        """
+
+        if compiled_cache is None or not dp:
+            return query.compile(dialect=dialect)
+
+        compiled = compiled_cache.get(query)
+
+        if compiled is None:
+            compiled = compiled_cache[query] = query.compile(dialect=dialect)
+
+        return compiled
+
+    def compile(self, query, dp=None):
+
+        return self.compile_query(query, dp, self._compiled_cache)
+
+    @property
+    def waiting(self):
+
+        return self._waiting
+
+    @property
+    def outstanding(self):
+
+        return self._pool.size - self._pool.freesize if self._pool is not None else 0
+
+    async def get_replication_lag(self):
+        """查询复制延迟秒数，非副本返回0，没有延迟信息(如复制线程未运行)时返回None
+        """
+
+        result = None
+
+        conn = await self.get_sa_conn()
+
+        try:
+
+            cursor = await conn.connection.cursor(aiomysql.DictCursor)
+
+            await cursor.execute(r'show slave status;')
+
+            record = await cursor.fetchone()
+
+            await cursor.close()
+
+            if not record:
+                result = 0
+            elif record.get(r'Seconds_Behind_Master') is not None:
+                result = int(record[r'Seconds_Behind_Master'])
+
+        finally:
+
+            await conn.close()
+
+        return result
+
+    async def get_max_stmt_length(self, conn):
+        """批量写入时单条语句的最大长度，由服务端的max_allowed_packet决定，首次调用时查询
+        """
+
+        global MYSQL_PACKET_RESERVED_SIZE
+
+        if self._max_stmt_length is None:
+
+            try:
+
+                cursor = await conn.connection.cursor(aiomysql.Cursor)
+
+                await cursor.execute(r'select @@max_allowed_packet;')
+
+                record = await cursor.fetchone()
+
+                await cursor.close()
+
+                self._max_stmt_length = int(record[0]) - MYSQL_PACKET_RESERVED_SIZE
+
+            except Exception as err:
+
+                Utils.log.warning(f'MySQL max_allowed_packet query failed ({self._name}): {err}')
+
+                self._max_stmt_length = aiomysql.Cursor.max_stmt_length
+
+        return self._max_stmt_length
+
+    async def health(self):
+
+        result = False
+
+        async with self.get_client() as client:
+
+            proxy = await client.execute(r'select version();')
+            await proxy.close()
+
+            result = True
+
+        return result
+
+    async def reset(self):
+
+        if self._pool is not None:
+
+            await self._pool.clear()
+
+            if self._warmup:
+                await self.warm_up()
+
+            await self.health()
+
+            Utils.log.info(
+                f'MySQL connection pool reset ({self._name}): {self._pool.size}/{self._pool.maxsize}'
+            )
+
+    async def get_sa_conn(self):
+
+        self._echo_pool_info()
+
+        # 连接池未满时可以新建连接，不会排队等待
+        saturated = self._pool.freesize == 0 and self._pool.size >= self._pool.maxsize
+
+        if self._max_waiting > 0 and self._waiting >= self._max_waiting and saturated:
+            self._metrics.incr_acquire_rejected()
+            raise PoolOverloadError(f'MySQL connection pool ({self._name}) waiting queue full: {self._waiting}')
+
+        begin_time = Utils.loop_time()
+
+        self._waiting += 1
+
+        try:
+
+            if self._acquire_timeout > 0:
+                conn = await asyncio.wait_for(self._pool.acquire(), self._acquire_timeout)
+            else:
+                conn = await self._pool.acquire()
+
+        except asyncio.TimeoutError:
+
+            self._metrics.incr_acquire_timeout()
+
+            raise PoolOverloadError(f'MySQL connection pool ({self._name}) acquire timeout: {self._acquire_timeout}s')
+
+        finally:
+
+            self._waiting -= 1
+
+        acquire_wait = Utils.loop_time() - begin_time
+
+        self._metrics.observe_acquire(acquire_wait)
+
+        self._mark_conn(conn)
+
+        result = self._Connection(conn, self._engine, self._compiled_cache)
+        result.acquire_wait = acquire_wait
+
+        return result
+
+    def get_client(self):
+
+        result = None
+
+        try:
+            result = DBClient(self)
+        except Exception as err:
+            Utils.log.exception(err)
+
+        return result
+
+    def get_transaction(self):
+
+        result = None
+
+        if self._readonly:
+            raise MySQLReadOnlyError()
+
+        try:
+            result = DBTransaction(self)
+        except Exception as err:
+            Utils.log.exception(err)
+
+        return result
+
+
+class MySQLReplicaSet:
+    """MySQL只读副本集合
+
+    按加权轮询(weighted)或最少未完成请求(least_outstanding)在副本间分配读请求
+    后台每probe_interval秒并发探测一次复制延迟，延迟超过max_lag秒、无法连接或探测超过probe_timeout秒的副本被暂时剔除，恢复后重新加入
+    没有复制延迟信息(Seconds_Behind_Master为NULL)的副本不剔除，只记录一次日志
+
+    """
+
+    STRATEGY_WEIGHTED = r'weighted'
+    STRATEGY_LEAST_OUTSTANDING = r'least_outstanding'
+
+    def __init__(self, *, strategy=STRATEGY_WEIGHTED, max_lag=10, probe_interval=5, probe_timeout=None):
+
+        if strategy not in (self.STRATEGY_WEIGHTED, self.STRATEGY_LEAST_OUTSTANDING):
+            raise ValueError(f'Unknown replica strategy: {strategy}')
+
+        self._strategy = strategy
+
+        self._max_lag = max_lag
+
+        self._probe_task = None
+        self._probe_interval = probe_interval
+        self._probe_timeout = probe_timeout if probe_timeout is not None else probe_interval
+
+        self._pools = []
+
+        self._weights = {}
+        self._current_weights = {}
+
+        self._lags = {}
+        self._ejected = set()
+        self._lag_unknown = set()
+
+    def __len__(self):
+
+        return len(self._pools)
+
+    @property
+    def pools(self):
+
+        return self._pools
+
+    @property
+    def available_pools(self):
+
+        return [pool for pool in self._pools if pool.name not in self._ejected]
+
+    def add_pool(self, pool, weight=1):
+
+        self._pools.append(pool)
+
+        self._weights[pool.name] = weight
+        self._current_weights[pool.name] = 0
+
+        if self._probe_task is None and self._max_lag > 0:
+            self._probe_task = IntervalTask.create(self._probe_interval, False, self._probe)
+
+    def select(self):
+        """选择一个可用副本，全部副本被剔除时返回None
+        """
+
+        pools = self.available_pools
+
+        if len(pools) == 0:
+            return None
+        elif len(pools) == 1:
+            return pools[0]
+
+        if self._strategy == self.STRATEGY_LEAST_OUTSTANDING:
+            return min(pools, key=lambda x: x.outstanding / self._weights[x.name])
+
+        # 平滑加权轮询
+        total_weight = 0
+        selected = None
+
+        for pool in pools:
+
+            self._current_weights[pool.name] += self._weights[pool.name]
+            total_weight += self._weights[pool.name]
+
+            if selected is None or self._current_weights[pool.name] > self._current_weights[selected.name]:
+                selected = pool
+
+        self._current_weights[selected.name] -= total_weight
+
+        return selected
 
-            await self._pool.clear()
+    def get_lags(self):
 
-            await self.health()
+        return dict(self._lags)
 
-            Utils.log.info(
-                f'MySQL connection pool reset ({self._name}): {self._pool.size}/{self._pool.maxsize}'
-            )
+    async def _probe(self):
 
-    async def get_sa_conn(self):
+        pools = list(self._pools)
 
-        self._echo_pool_info()
+        results = await asyncio.gather(
+            *(asyncio.wait_for(pool.get_replication_lag(), self._probe_timeout) for pool in pools),
+            return_exceptions=True
+        )
 
-        conn = await self._pool.acquire()
+        for pool, result in zip(pools, results):
 
-        return self._Connection(conn, self._engine)
+            failed = isinstance(result, BaseException)
 
-    def get_client(self):
+            if failed:
+                lag = None
+                Utils.log.error(f'MySQL replication lag probe failed ({pool.name}): {result!r}')
+            else:
+                lag = result
 
-        result = None
+            self._lags[pool.name] = lag
 
-        try:
-            result = DBClient(self)
-        except Exception as err:
-            Utils.log.exception(err)
+            if failed or (lag is not None and lag > self._max_lag):
 
-        return result
+                if pool.name not in self._ejected:
+                    self._ejected.add(pool.name)
+                    Utils.log.warning(f'MySQL replica ejected ({pool.name}): lag {lag}')
 
-    def get_transaction(self):
+                continue
 
-        result = None
+            if lag is None:
+                if pool.name not in self._lag_unknown:
+                    self._lag_unknown.add(pool.name)
+                    Utils.log.warning(f'MySQL replication lag unknown ({pool.name}), replica kept')
+            else:
+                self._lag_unknown.discard(pool.name)
 
-        if self._readonly:
-            raise MySQLReadOnlyError()
+            if pool.name in self._ejected:
+                self._ejected.remove(pool.name)
+                Utils.log.info(f'MySQL replica recovered ({pool.name}): lag {lag}')
 
-        try:
-            result = DBTransaction(self)
-        except Exception as err:
-            Utils.log.exception(err)
+    def close(self):
 
-        return result
+        if self._probe_task is not None:
+            self._probe_task.stop()
+            self._probe_task = None
 
 
 class MySQLDelegate:
     """MySQL功能组件
+
+    支持多个只读副本，副本的负载均衡与延迟剔除见MySQLReplicaSet
+    read_your_writes大于0时，上下文中获取过事务对象后的read_your_writes秒内，只读请求也路由到主库
+
     """
 
-    def __init__(self):
+    def __init__(
+            self, *, replica_strategy=MySQLReplicaSet.STRATEGY_WEIGHTED, replica_max_lag=10, replica_probe_interval=5,
+            read_your_writes=0, query_cache=None
+    ):
 
         self._mysql_rw_pool = None
-        self._mysql_ro_pool = None
+        self._mysql_ro_pools = MySQLReplicaSet(
+            strategy=replica_strategy, max_lag=replica_max_lag, probe_interval=replica_probe_interval
+        )
+
+        self._read_your_writes = read_your_writes
+
+        self._mysql_query_cache = query_cache
 
         context_uuid = Utils.uuid1()
 
         self._mysql_rw_client_context = WeakContextVar(f'mysql_rw_client_{context_uuid}')
         self._mysql_ro_client_context = WeakContextVar(f'mysql_ro_client_{context_uuid}')
 
+        self._mysql_sticky_context = ContextVar(f'mysql_sticky_{context_uuid}', default=0)
+
     @property
     def mysql_rw_pool(self):
 
@@ -332,30 +1592,78 @@ class MySQLDelegate:
     @property
     def mysql_ro_pool(self):
 
-        return self._mysql_ro_pool
+        return self._mysql_ro_pools.pools[0] if len(self._mysql_ro_pools) > 0 else None
+
+    @property
+    def mysql_ro_pools(self):
+
+        return self._mysql_ro_pools
+
+    @property
+    def mysql_query_cache(self):
+
+        return self._mysql_query_cache
 
     async def async_init_mysql_rw(self, *args, **kwargs):
 
+        kwargs.setdefault(r'query_cache', self._mysql_query_cache)
+
         self._mysql_rw_pool = await MySQLPool(*args, **kwargs)
 
-    async def async_init_mysql_ro(self, *args, **kwargs):
+    async def async_init_mysql_ro(self, *args, weight=1, **kwargs):
+
+        kwargs.setdefault(r'query_cache', self._mysql_query_cache)
 
-        self._mysql_ro_pool = await MySQLPool(*args, **kwargs)
+        self._mysql_ro_pools.add_pool(await MySQLPool(*args, **kwargs), weight)
 
     async def mysql_health(self):
 
         result = await self._mysql_rw_pool.health() if self._mysql_rw_pool else True
-        result &= await self._mysql_ro_pool.health() if self._mysql_ro_pool else True
+
+        for pool in self._mysql_ro_pools.pools:
+            result &= await pool.health()
 
         return result
 
+    def mysql_metrics(self):
+
+        return {
+            r'rw': self._mysql_rw_pool.get_metrics() if self._mysql_rw_pool else None,
+            r'ro': [pool.get_metrics() for pool in self._mysql_ro_pools.pools],
+            r'ro_lag': self._mysql_ro_pools.get_lags(),
+            r'query_cache': self._mysql_query_cache.stats() if self._mysql_query_cache else None,
+        }
+
+    def mysql_statement_metrics(self):
+
+        return {
+            r'rw': self._mysql_rw_pool.get_statement_metrics() if self._mysql_rw_pool else None,
+            r'ro': [pool.get_statement_metrics() for pool in self._mysql_ro_pools.pools],
+        }
+
     async def reset_mysql_pool(self):
 
         if self._mysql_rw_pool:
             await self._mysql_rw_pool.reset()
 
-        if self._mysql_ro_pool:
-            await self._mysql_ro_pool.reset()
+        for pool in self._mysql_ro_pools.pools:
+            await pool.reset()
+
+    def _is_mysql_sticky(self):
+
+        return self._mysql_sticky_context.get() > Utils.loop_time()
+
+    def _create_ro_client(self):
+
+        pool = None if self._is_mysql_sticky() else self._mysql_ro_pools.select()
+
+        if pool is not None:
+            client = pool.get_client()
+        else:
+            client = self._mysql_rw_pool.get_client()
+            client._readonly = True
+
+        return client
 
     def get_db_client(self, readonly=False, *, alone=False):
 
@@ -364,11 +1672,7 @@ class MySQLDelegate:
         if alone:
 
             if readonly:
-                if self._mysql_ro_pool is not None:
-                    client = self._mysql_ro_pool.get_client()
-                else:
-                    client = self._mysql_rw_pool.get_client()
-                    client._readonly = True
+                client = self._create_ro_client()
             else:
                 client = self._mysql_rw_pool.get_client()
 
@@ -383,14 +1687,13 @@ class MySQLDelegate:
 
                 client = self._mysql_ro_client_context.get()
 
-                if client is None:
-
-                    if self._mysql_ro_pool is not None:
-                        client = self._mysql_ro_pool.get_client()
-                    else:
-                        client = self._mysql_rw_pool.get_client()
-                        client._readonly = True
+                # 写入后的粘滞期内不再使用已绑定到副本的客户端
+                if client is not None and client._pool is not self._mysql_rw_pool and self._is_mysql_sticky():
+                    Utils.create_task(client.release())
+                    client = None
 
+                if client is None:
+                    client = self._create_ro_client()
                     self._mysql_ro_client_context.set(client)
 
             else:
@@ -420,6 +1723,9 @@ class MySQLDelegate:
         if _client is not None:
             Utils.create_task(_client.release())
 
+        if self._read_your_writes > 0:
+            self._mysql_sticky_context.set(Utils.loop_time() + self._read_your_writes)
+
         return self._mysql_rw_pool.get_transaction()
 
 
@@ -459,18 +1765,68 @@ class _ClientBase:
 
         raise NotImplementedError()
 
-    async def execute(self, clause):
+    def _get_query_cache(self):
+
+        return None
+
+    async def _fetch_with_cache(self, func, clause, multiparams, params, cache_ttl):
+
+        query_cache = self._get_query_cache() if cache_ttl > 0 else None
+
+        if query_cache is None:
+            return await func(clause, *multiparams, **params)
+
+        dp = _distill_params(multiparams, params)
+
+        if len(dp) > 1:
+            return await func(clause, *multiparams, **params)
+
+        key = query_cache.gen_key(self._compile(clause, dp[0] if dp else None), dp[0] if dp else None)
+
+        return await query_cache.fetch(
+            key, QueryCache.get_tables(clause), cache_ttl, func, clause, *multiparams, **params
+        )
+
+    def _compile(self, clause, dp):
+
+        return MySQLPool.compile_query(clause, dp)
+
+    async def _on_tables_written(self, *tables):
+
+        query_cache = self._get_query_cache()
+
+        if query_cache is not None:
+            await query_cache.invalidate(*tables)
+
+    async def execute(self, clause, *multiparams, **params):
+
+        raise NotImplementedError()
+
+    async def execute_bulk(self, query, rows):
 
         raise NotImplementedError()
 
-    async def select(self, clause):
+    async def _execute_bulk(self, query, rows, chunk_size, transaction):
 
-        result = []
+        result = 0
+
+        for index in range(0, len(rows), chunk_size):
+            result += await self.execute_bulk(query, rows[index:index + chunk_size])
+
+        return result
+
+    async def select(self, clause, *multiparams, cache_ttl=0, **params):
 
         if not isinstance(clause, Select):
             raise TypeError(r'Not sqlalchemy.sql.selectable.Select object')
 
-        proxy = await self.execute(clause)
+        return await self._fetch_with_cache(self._select, clause, multiparams, params, cache_ttl)
+
+    async def _select(self, clause, *multiparams, **params):
+
+        result = []
+
+        proxy = await self.execute(clause, *multiparams, **params)
 
         if proxy is not None:
 
@@ -484,14 +1840,18 @@ class _ClientBase:
 
         return result
 
-    async def find(self, clause):
-
-        result = None
+    async def find(self, clause, *multiparams, cache_ttl=0, **params):
 
         if not isinstance(clause, Select):
             raise TypeError(r'Not sqlalchemy.sql.selectable.Select object')
 
-        proxy = await self.execute(clause)
+        return await self._fetch_with_cache(self._find, clause, multiparams, params, cache_ttl)
+
+    async def _find(self, clause, *multiparams, **params):
+
+        result = None
+
+        proxy = await self.execute(clause, *multiparams, **params)
 
         if proxy is not None:
 
@@ -505,7 +1865,7 @@ class _ClientBase:
 
         return result
 
-    async def insert(self, clause):
+    async def insert(self, clause, *multiparams, **params):
 
         result = 0
 
@@ -515,7 +1875,7 @@ class _ClientBase:
         if not isinstance(clause, Insert):
             raise TypeError(r'Not sqlalchemy.sql.dml.Insert object')
 
-        proxy = await self.execute(clause)
+        proxy = await self.execute(clause, *multiparams, **params)
 
         if proxy is not None:
 
@@ -524,9 +1884,59 @@ class _ClientBase:
             if not proxy.closed:
                 await proxy.close()
 
+        await self._on_tables_written(clause.table.name)
+
         return result
 
-    async def update(self, clause):
+    async def insert_many(self, table, rows, *, chunk_size=MYSQL_BULK_CHUNK_SIZE, transaction=False):
+        """批量插入
+
+        rows为字段相同的dict列表，每chunk_size行调用一次executemany，transaction为True时在独立事务中执行
+        返回影响行数
+
+        """
+
+        if self._readonly:
+            raise MySQLReadOnlyError()
+
+        if not rows:
+            return 0
+
+        result = await self._execute_bulk(table.insert(), rows, chunk_size, transaction)
+
+        await self._on_tables_written(table.name)
+
+        return result
+
+    async def upsert_many(
+            self, table, rows, update_columns=None, *, chunk_size=MYSQL_BULK_CHUNK_SIZE, transaction=False
+    ):
+        """批量插入或更新(INSERT ... ON DUPLICATE KEY UPDATE)
+
+        update_columns为冲突时需要更新的字段，默认为rows中除主键外的全部字段
+        返回影响行数，按MySQL的约定新插入的行计1，被更新的行计2
+
+        """
+
+        if self._readonly:
+            raise MySQLReadOnlyError()
+
+        if not rows:
+            return 0
+
+        if update_columns is None:
+            update_columns = [key for key in rows[0].keys() if key not in table.primary_key.columns]
+
+        query = mysql_insert(table)
+        query = query.on_duplicate_key_update({key: query.inserted[key] for key in update_columns})
+
+        result = await self._execute_bulk(query, rows, chunk_size, transaction)
+
+        await self._on_tables_written(table.name)
+
+        return result
+
+    async def update(self, clause, *multiparams, **params):
 
         result = 0
 
@@ -536,7 +1946,7 @@ class _ClientBase:
         if not isinstance(clause, Update):
             raise TypeError(r'Not sqlalchemy.sql.dml.Update object')
 
-        proxy = await self.execute(clause)
+        proxy = await self.execute(clause, *multiparams, **params)
 
         if proxy is not None:
 
@@ -545,9 +1955,11 @@ class _ClientBase:
             if not proxy.closed:
                 await proxy.close()
 
+        await self._on_tables_written(clause.table.name)
+
         return result
 
-    async def delete(self, clause):
+    async def delete(self, clause, *multiparams, **params):
 
         result = 0
 
@@ -557,7 +1969,7 @@ class _ClientBase:
         if not isinstance(clause, Delete):
             raise TypeError(r'Not sqlalchemy.sql.dml.Delete object')
 
-        proxy = await self.execute(clause)
+        proxy = await self.execute(clause, *multiparams, **params)
 
         if proxy is not None:
 
@@ -566,9 +1978,58 @@ class _ClientBase:
             if not proxy.closed:
                 await proxy.close()
 
+        await self._on_tables_written(clause.table.name)
+
         return result
 
 
+class _StreamReader:
+    """流式查询结果迭代器
+
+    async for提前退出时生成器不会立即结束，连接锁会一直被占用，使用async with或aclose可立即释放
+    所属客户端释放时也会关闭未结束的流
+
+    """
+
+    def __init__(self, agen):
+
+        self._agen = agen
+
+        self._closed = False
+
+    @property
+    def closed(self):
+
+        return self._closed
+
+    def __aiter__(self):
+
+        return self
+
+    async def __anext__(self):
+
+        # 生成器抛出任何异常(包括StopAsyncIteration)后都已结束
+        try:
+            return await self._agen.__anext__()
+        except BaseException:
+            self._closed = True
+            raise
+
+    async def __aenter__(self):
+
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+
+        await self.aclose()
+
+    async def aclose(self):
+
+        self._closed = True
+
+        await self._agen.aclose()
+
+
 class DBClient(_ClientBase, AsyncContextManager):
     """MySQL客户端对象，使用with进行上下文管理
 
@@ -585,11 +2046,24 @@ class DBClient(_ClientBase, AsyncContextManager):
         self._pool = pool
         self._conn = None
 
+        self._statement = None
+        self._acquire_wait = 0
+
+        self._stream_reader = None
+
     @property
     def insert_id(self):
 
         return self._conn.connection.insert_id()
 
+    def _get_query_cache(self):
+
+        return self._pool.query_cache
+
+    def _compile(self, clause, dp):
+
+        return self._pool.compile(clause, dp)
+
     async def _get_conn(self):
 
         if self._conn is None and self._pool:
@@ -610,50 +2084,193 @@ class DBClient(_ClientBase, AsyncContextManager):
             else:
                 await _conn.close()
 
+    async def _close_stream(self):
+
+        if self._stream_reader is not None:
+            reader, self._stream_reader = self._stream_reader, None
+            await reader.aclose()
+
     async def _context_release(self):
 
+        await self._close_stream()
+
         await self._close_conn(self._lock.locked())
 
-    async def release(self):
+    async def _execute(self, conn, clause, *multiparams, **params):
+
+        begin_time = Utils.loop_time()
+
+        try:
+            return await conn.execute(clause, *multiparams, **params)
+        finally:
+            self._pool.metrics.observe_command(Utils.loop_time() - begin_time)
+            self._statement = conn.last_statement_text
+            self._acquire_wait, conn.acquire_wait = self._acquire_wait + conn.acquire_wait, 0
+
+    def _observe_execute(self, clause, elapsed, result, retries, error):
+
+        statement, self._statement = self._statement, None
+        acquire_wait, self._acquire_wait = self._acquire_wait, 0
+
+        if statement is None:
+            statement = clause if isinstance(clause, str) else str(clause.compile(dialect=dialect))
+
+        self._pool.observe_execute(
+            statement, elapsed,
+            rowcount=result.rowcount if result is not None else 0,
+            retries=retries, acquire_wait=acquire_wait, error=error
+        )
+
+    async def _abort_stream(self, cursor):
+
+        await self._close_conn(True)
+
+    async def _execute_bulk(self, query, rows, chunk_size, transaction):
+
+        if not transaction:
+            return await super()._execute_bulk(query, rows, chunk_size, False)
+
+        result = 0
+
+        async with self._pool.get_transaction() as trx:
+            result = await trx._execute_bulk(query, rows, chunk_size, False)
+            await trx.commit()
+
+        return result
+
+    async def execute_bulk(self, query, rows):
+
+        result = 0
 
         async with self._lock:
 
-            await self._close_conn()
+            try:
 
-    async def execute(self, clause):
+                conn = await self._get_conn()
 
-        global MYSQL_ERROR_RETRY_COUNT
+                max_stmt_length = await self._pool.get_max_stmt_length(conn)
 
-        result = None
+                begin_time = Utils.loop_time()
+
+                result = await conn.execute_bulk(query, rows, max_stmt_length)
+
+                self._pool.metrics.observe_command(Utils.loop_time() - begin_time)
+
+            except Exception as err:
+
+                await self._close_conn(True)
+
+                raise err
+
+        return result
+
+    def stream(self, clause, batch_size=MYSQL_STREAM_BATCH_SIZE, **params):
+        """流式查询
+
+        使用无缓冲游标分批读取结果集，内存占用与结果集大小无关，读取期间独占连接
+        迭代提前终止时直接丢弃连接，不再读取剩余结果，需要提前退出时使用async with立即释放连接
+
+        async with client.stream(clause) as reader:
+            async for rows in reader:
+                ...
+
+        """
+
+        if not isinstance(clause, Select):
+            raise TypeError(r'Not sqlalchemy.sql.selectable.Select object')
+
+        # 未结束的流仍持有连接锁，直接开启新的流会导致之后的操作永久等待
+        if self._stream_reader is not None and not self._stream_reader.closed:
+            raise RuntimeError(r'Previous stream is still open, close it with aclose or async with')
+
+        self._stream_reader = _StreamReader(self._stream(clause, batch_size, params))
+
+        return self._stream_reader
+
+    async def _stream(self, clause, batch_size, params):
 
         async with self._lock:
 
-            async for times in AsyncCirculator(max_times=MYSQL_ERROR_RETRY_COUNT):
+            cursor = None
+            finished = False
+
+            try:
+
+                conn = await self._get_conn()
 
-                try:
+                cursor = await conn.execute_unbuffered(clause, params)
 
-                    conn = await self._get_conn()
+                while True:
 
-                    result = await conn.execute(clause)
+                    rows = await cursor.fetchmany(batch_size)
 
-                except (Warning, DataError, IntegrityError, ProgrammingError) as err:
+                    if not rows:
+                        break
 
-                    await self._close_conn(True)
+                    yield rows
 
-                    raise err
+                finished = True
 
-                except Exception as err:
+                await cursor.close()
 
-                    await self._close_conn(True)
+            finally:
 
-                    if times < MYSQL_ERROR_RETRY_COUNT:
-                        Utils.log.exception(err)
+                if not finished:
+                    if cursor is None:
+                        await self._close_conn(True)
                     else:
-                        raise err
+                        await self._abort_stream(cursor)
+
+    async def release(self):
+
+        await self._close_stream()
+
+        async with self._lock:
+
+            await self._close_conn()
+
+    async def execute(self, clause, *multiparams, **params):
+
+        result = None
+
+        attempts = 0
+
+        async def _execute():
+
+            nonlocal attempts
+
+            attempts += 1
+
+            conn = await self._get_conn()
+
+            return await self._execute(conn, clause, *multiparams, **params)
+
+        async def _on_error(err, retries):
 
-                else:
+            await self._close_conn(True)
 
-                    break
+        async with self._lock:
+
+            begin_time = Utils.loop_time()
+
+            error = None
+
+            try:
+
+                result = await self._pool.retry_policy.execute(
+                    _execute, breaker=self._pool.circuit_breaker,
+                    fatal_errors=(Warning, DataError, IntegrityError, ProgrammingError), on_error=_on_error
+                )
+
+            except Exception as err:
+
+                error = err
+
+                raise err
+
+            finally:
+
+                self._observe_execute(clause, Utils.loop_time() - begin_time, result, max(0, attempts - 1), error)
 
         return result
 
@@ -671,6 +2288,8 @@ class DBTransaction(DBClient):
 
         self._trx = None
 
+        self._written_tables = set()
+
     async def _get_conn(self):
 
         if self._conn is None and self._pool:
@@ -683,11 +2302,30 @@ class DBTransaction(DBClient):
 
         await self.rollback()
 
+    async def _abort_stream(self, cursor):
+
+        # 事务中的连接不能丢弃，读完剩余结果后继续使用
+        await cursor.close()
+
+    async def _execute_bulk(self, query, rows, chunk_size, transaction):
+
+        return await super()._execute_bulk(query, rows, chunk_size, False)
+
+    async def _fetch_with_cache(self, func, clause, multiparams, params, cache_ttl):
+
+        # 事务中的读取需要看到未提交的修改，不使用查询缓存
+        return await func(clause, *multiparams, **params)
+
+    async def _on_tables_written(self, *tables):
+
+        # 提交后再清除缓存，回滚时丢弃
+        self._written_tables.update(tables)
+
     async def release(self):
 
         await self.rollback()
 
-    async def execute(self, clause):
+    async def execute(self, clause, *multiparams, **params):
 
         result = None
 
@@ -696,22 +2334,34 @@ class DBTransaction(DBClient):
 
         async with self._lock:
 
+            begin_time = Utils.loop_time()
+
+            error = None
+
             try:
 
                 conn = await self._get_conn()
 
-                result = await conn.execute(clause)
+                result = await self._execute(conn, clause, *multiparams, **params)
 
             except Exception as err:
 
+                error = err
+
                 await self._close_conn(True)
 
                 raise err
 
+            finally:
+
+                self._observe_execute(clause, Utils.loop_time() - begin_time, result, 0, error)
+
         return result
 
     async def commit(self):
 
+        await self._close_stream()
+
         async with self._lock:
 
             if self._trx:
@@ -721,8 +2371,14 @@ class DBTransaction(DBClient):
 
             await self._close_conn()
 
+        if self._written_tables:
+            tables, self._written_tables = self._written_tables, set()
+            await super()._on_tables_written(*tables)
+
     async def rollback(self):
 
+        await self._close_stream()
+
         async with self._lock:
 
             if self._trx:
@@ -731,3 +2387,5 @@ class DBTransaction(DBClient):
                 await _trx.close()
 
             await self._close_conn()
+
+        self._written_tables.clear()
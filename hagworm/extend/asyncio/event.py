@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+import asyncio
+
 from aioredis.pubsub import Receiver
 
 from hagworm.extend.event import EventDispatcher
@@ -18,14 +20,26 @@ class DistributedEvent(EventDispatcher):
 
         self._channels = [f'event_bus_{Utils.md5_u32(channel_name)}_{index}' for index in range(channel_count)]
 
-        for channel in self._channels:
-            Utils.create_task(self._event_listener(channel))
+        self._closed = False
+
+        self._listener_tasks = [Utils.create_task(self._event_listener(channel)) for channel in self._channels]
+
+    @property
+    def closed(self):
+
+        return self._closed
 
     async def _event_listener(self, channel):
 
         async for _ in AsyncCirculatorForSecond():
 
-            async with self._redis_pool.get_client() as cache:
+            if self._closed:
+                break
+
+            # 不使用with管理客户端，避免取消异常被上下文管理器吞掉导致监听无法停止
+            cache = self._redis_pool.get_client()
+
+            try:
 
                 receiver, = await cache.subscribe(channel)
 
@@ -34,6 +48,32 @@ class DistributedEvent(EventDispatcher):
                 async for message in receiver.iter():
                     await self._event_assigner(channel, message)
 
+            except asyncio.CancelledError as err:
+
+                raise err
+
+            except Exception as err:
+
+                Utils.log.exception(err)
+
+            finally:
+
+                await cache.release()
+
+    async def close(self):
+        """停止所有频道的监听任务
+        """
+
+        if self._closed:
+            return
+
+        self._closed = True
+
+        for task in self._listener_tasks:
+            task.cancel()
+
+        await asyncio.gather(*self._listener_tasks, return_exceptions=True)
+
     async def _event_assigner(self, channel, message):
 
         message = Utils.pickle_loads(message)
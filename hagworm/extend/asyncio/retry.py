@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+
+from hagworm.extend.error import OverloadError, CircuitBreakerError
+
+from .base import Utils
+
+
+class RetryBudget:
+    """重试预算
+
+    限制重试请求占总请求的比例，防止故障期间重试放大流量
+    统计窗口内允许的重试次数为 min_retries + 请求数 * ratio，统计窗口每window秒轮换一次
+
+    """
+
+    def __init__(self, ratio=0.2, min_retries=10, window=10):
+
+        self._ratio = ratio
+        self._min_retries = min_retries
+        self._window = window
+
+        self._window_start = 0
+
+        self._request_count = 0
+        self._retry_count = 0
+
+    def _refresh(self):
+
+        now_time = Utils.loop_time()
+
+        if now_time - self._window_start >= self._window:
+            self._window_start = now_time
+            self._request_count = self._retry_count = 0
+
+    def record_request(self):
+
+        self._refresh()
+
+        self._request_count += 1
+
+    def withdraw(self):
+        """申请一次重试，预算不足时返回False
+        """
+
+        self._refresh()
+
+        if self._retry_count >= self._min_retries + self._request_count * self._ratio:
+            return False
+
+        self._retry_count += 1
+
+        return True
+
+    def snapshot(self):
+
+        return {
+            r'request': self._request_count,
+            r'retry': self._retry_count,
+        }
+
+
+class CircuitBreaker:
+    """熔断器
+
+    连续失败failure_threshold次后熔断，熔断期间的调用直接抛出CircuitBreakerError
+    熔断recovery_time秒后进入半开状态，放行最多half_open_calls个探测调用，成功则恢复，失败则重新熔断
+
+    """
+
+    STATE_CLOSED = r'closed'
+    STATE_OPEN = r'open'
+    STATE_HALF_OPEN = r'half_open'
+
+    def __init__(self, name=None, *, failure_threshold=5, recovery_time=10, half_open_calls=1):
+
+        self._name = name
+
+        self._failure_threshold = failure_threshold
+        self._recovery_time = recovery_time
+        self._half_open_calls = half_open_calls
+
+        self._state = self.STATE_CLOSED
+
+        self._failure_count = 0
+        self._open_time = 0
+        self._half_open_count = 0
+
+        self._open_total = 0
+        self._reject_total = 0
+
+    @property
+    def name(self):
+
+        return self._name
+
+    @property
+    def state(self):
+
+        if self._state == self.STATE_OPEN and Utils.loop_time() - self._open_time >= self._recovery_time:
+            self._state = self.STATE_HALF_OPEN
+            self._half_open_count = 0
+
+        return self._state
+
+    def _open(self):
+
+        if self._state != self.STATE_OPEN:
+            self._open_total += 1
+            Utils.log.warning(f'Circuit breaker ({self._name}) open')
+
+        self._state = self.STATE_OPEN
+        self._open_time = Utils.loop_time()
+
+    def allow(self):
+
+        state = self.state
+
+        if state == self.STATE_CLOSED:
+            return True
+
+        if state == self.STATE_HALF_OPEN and self._half_open_count < self._half_open_calls:
+            self._half_open_count += 1
+            return True
+
+        self._reject_total += 1
+
+        return False
+
+    def check(self):
+        """检查是否允许调用，熔断时抛出CircuitBreakerError
+        """
+
+        if not self.allow():
+            raise CircuitBreakerError(self._name)
+
+    def acquire(self):
+        """同check，返回本次调用是否占用了半开状态的探测名额
+        """
+
+        probe = self.state == self.STATE_HALF_OPEN
+
+        self.check()
+
+        return probe
+
+    def release(self):
+        """归还未记录结果的探测名额，用于调用被取消或因过载提前退出的情况
+        """
+
+        if self._state == self.STATE_HALF_OPEN and self._half_open_count > 0:
+            self._half_open_count -= 1
+
+    def record_success(self):
+
+        if self._state != self.STATE_CLOSED:
+            Utils.log.info(f'Circuit breaker ({self._name}) closed')
+
+        self._state = self.STATE_CLOSED
+        self._failure_count = 0
+
+    def record_failure(self):
+
+        self._failure_count += 1
+
+        if self._state == self.STATE_HALF_OPEN or self._failure_count >= self._failure_threshold:
+            self._open()
+
+    def snapshot(self):
+
+        return {
+            r'name': self._name,
+            r'state': self.state,
+            r'failure': self._failure_count,
+            r'open_total': self._open_total,
+            r'reject_total': self._reject_total,
+        }
+
+
+class RetryPolicy:
+    """重试策略
+
+    失败后按指数退避等待再重试，第n次重试的等待时间上限为 min(max_delay, base_delay * multiplier ** (n - 1))
+    jitter为True时在[0, 上限]之间随机取值(full jitter)，避免多个客户端同时重试
+    重试次数达到max_times、超过整体时限deadline(秒，为0时不限)或重试预算耗尽时不再重试，抛出最后一次的异常
+
+    策略对象可以在多个连接池之间共享，此时重试预算也共享；熔断器由调用方按连接池传入
+
+    """
+
+    def __init__(
+            self, max_times=5, *, base_delay=0.05, max_delay=2, multiplier=2, jitter=True, deadline=10,
+            budget=None
+    ):
+
+        self._max_times = max_times
+
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._multiplier = multiplier
+        self._jitter = jitter
+
+        self._deadline = deadline
+
+        self._budget = budget if budget is not None else RetryBudget()
+
+    @property
+    def max_times(self):
+
+        return self._max_times
+
+    @property
+    def budget(self):
+
+        return self._budget
+
+    def get_delay(self, retries):
+
+        delay = min(self._max_delay, self._base_delay * self._multiplier ** (retries - 1))
+
+        return Utils.random.uniform(0, delay) if self._jitter else delay
+
+    async def execute(self, func, *, breaker=None, fatal_errors=(), failure_errors=(), on_error=None):
+        """执行func(无参协程函数)，失败时按策略重试
+
+        fatal_errors中的异常不重试直接抛出，且不计入熔断器的失败次数
+        failure_errors中的异常同样不重试直接抛出，但计入熔断器的失败次数(如服务端连接数已满)
+        OverloadError(熔断、连接池过载)直接抛出，不调用on_error也不影响熔断器
+        on_error(err, retries)为每次失败后的回调协程函数，retries为已重试的次数
+        占用了半开探测名额但没有记录结果就退出时(如OverloadError)，名额会归还给熔断器
+
+        """
+
+        deadline = Utils.loop_time() + self._deadline if self._deadline > 0 else 0
+
+        self._budget.record_request()
+
+        retries = 0
+
+        probe = False
+
+        if breaker is not None:
+            probe = breaker.acquire()
+
+        try:
+
+            while True:
+
+                try:
+
+                    result = await func()
+
+                except OverloadError as err:
+
+                    raise err
+
+                except failure_errors as err:
+
+                    if on_error is not None:
+                        await on_error(err, retries)
+
+                    if breaker is not None:
+                        breaker.record_failure()
+                        probe = False
+
+                    raise err
+
+                except fatal_errors as err:
+
+                    if on_error is not None:
+                        await on_error(err, retries)
+
+                    if breaker is not None:
+                        breaker.record_success()
+                        probe = False
+
+                    raise err
+
+                except Exception as err:
+
+                    if on_error is not None:
+                        await on_error(err, retries)
+
+                    if breaker is not None:
+                        breaker.record_failure()
+                        probe = False
+
+                    retries += 1
+
+                    delay = self.get_delay(retries)
+
+                    if retries >= self._max_times:
+                        raise err
+
+                    if deadline > 0 and Utils.loop_time() + delay >= deadline:
+                        raise err
+
+                    if not self._budget.withdraw():
+                        raise err
+
+                    # 熔断后不再重试，抛出最后一次的异常
+                    if breaker is not None:
+                        try:
+                            probe = breaker.acquire()
+                        except CircuitBreakerError:
+                            raise err
+
+                    Utils.log.warning(f'retry {retries}/{self._max_times - 1} after {delay:.3f}s: {err!r}')
+
+                    await Utils.sleep(delay)
+
+                else:
+
+                    if breaker is not None:
+                        breaker.record_success()
+                        probe = False
+
+                    return result
+
+        finally:
+
+            if probe:
+                breaker.release()
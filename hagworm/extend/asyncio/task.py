@@ -3,18 +3,278 @@
 import asyncio
 
 from crontab import CronTab
-from collections import OrderedDict
+from contextvars import Context
+from collections import OrderedDict, deque
 
+from hagworm.extend.error import RateLimitTimeoutError
 from hagworm.extend.interface import TaskInterface
+from hagworm.extend.metrics import Histogram, TaskMetrics
 
-from .base import Utils, FutureWithTask
+from .base import Utils, FutureWithTask, async_adapter
+
+
+class _WheelTimer:
+    """时间轮定时器句柄，接口与asyncio.TimerHandle一致
+    """
+
+    __slots__ = [r'_wheel', r'_when', r'_callback', r'_args', r'_context', r'_expire_tick', r'_slot', r'_cancelled']
+
+    def __init__(self, wheel, when, callback, args):
+
+        self._wheel = wheel
+        self._when = when
+        self._callback = callback
+        self._args = args
+        self._context = Context()
+
+        self._expire_tick = 0
+        self._slot = None
+
+        self._cancelled = False
+
+    def when(self):
+
+        return self._when
+
+    def cancelled(self):
+
+        return self._cancelled
+
+    def cancel(self):
+
+        if not self._cancelled:
+            self._cancelled = True
+            self._wheel._remove(self)
+
+
+class TimingWheel:
+    """分层时间轮
+
+    用于大量周期任务的调度，替代每个任务各自持有的loop.call_at句柄，避免事件循环的定时器堆过大
+    每一层有wheel_size(2的幂)个槽，第0层每槽tick秒，上一层每槽为下一层一圈的时长，超出最大范围的定时器放在最高层并在到期前重新挂载
+    添加和取消定时器均为O(1)，事件循环上只保留一个tick定时器(没有定时器时停止)，同一tick内到期的回调批量触发
+    定时精度为tick，回调不会早于指定的时间触发
+
+    wheel = TimingWheel(0.1)
+    task = IntervalTask(func, 60, timing_wheel=wheel, jitter=5)
+    task.start()
+
+    """
+
+    def __init__(self, tick=0.1, wheel_size=64, levels=4):
+
+        if wheel_size < 2 or wheel_size & (wheel_size - 1):
+            raise ValueError(r'wheel_size must be a power of 2')
+
+        self._tick = tick
+
+        self._bits = wheel_size.bit_length() - 1
+        self._mask = wheel_size - 1
+
+        self._levels = levels
+        self._max_ticks = (1 << (self._bits * levels)) - 1
+
+        # 每个槽为有序字典，以定时器为键，取消时直接删除
+        self._wheels = [[{} for _ in range(wheel_size)] for _ in range(levels)]
+
+        self._event_loop = None
+
+        self._start_time = 0
+        self._current_tick = 0
+
+        self._timer_count = 0
+        self._tick_handle = None
+
+        self._fired_count = 0
+
+    @property
+    def tick(self):
+
+        return self._tick
+
+    def __len__(self):
+
+        return self._timer_count
+
+    def _loop_time(self):
+
+        if self._event_loop is None:
+            self._event_loop = asyncio.get_event_loop()
+            self._start_time = self._event_loop.time()
+
+        return self._event_loop.time()
+
+    def _time_to_tick(self, when):
+
+        # 向上取整，保证回调不会早于指定的时间触发
+        return -int((self._start_time - when) // self._tick)
+
+    def call_at(self, when, callback, *args):
+        """在指定的loop时间调用，callback可以是协程函数
+        """
+
+        timer = _WheelTimer(self, when, async_adapter(callback), args)
+
+        now_time = self._loop_time()
+
+        # 空闲期间没有tick推进，所有槽均为空，直接跳到当前tick，避免_on_tick逐个追赶空闲期间错过的tick
+        if self._timer_count == 0:
+            self._current_tick = max(self._current_tick, int((now_time - self._start_time) // self._tick))
+
+        self._add(timer)
+
+        self._timer_count += 1
+
+        self._ensure_ticking()
+
+        return timer
+
+    def call_later(self, delay, callback, *args):
+
+        return self.call_at(self._loop_time() + delay, callback, *args)
+
+    def _add(self, timer, min_tick=None):
+
+        if min_tick is None:
+            min_tick = self._current_tick + 1
+
+        expire_tick = max(self._time_to_tick(timer._when), min_tick)
+
+        delta = min(expire_tick - self._current_tick, self._max_ticks)
+
+        expire_tick = timer._expire_tick = self._current_tick + delta
+
+        level = 0
+
+        while level < self._levels - 1 and delta > (1 << (self._bits * (level + 1))) - 1:
+            level += 1
+
+        timer._slot = self._wheels[level][(expire_tick >> (self._bits * level)) & self._mask]
+        timer._slot[timer] = None
+
+    def _remove(self, timer):
+
+        if timer._slot is not None:
+
+            del timer._slot[timer]
+            timer._slot = None
+
+            self._timer_count -= 1
+
+    def _ensure_ticking(self):
+
+        if self._tick_handle is None and self._timer_count > 0:
+            self._tick_handle = self._event_loop.call_at(
+                self._start_time + (self._current_tick + 1) * self._tick, self._on_tick
+            )
+
+    def _cascade(self, level):
+
+        index = (self._current_tick >> (self._bits * level)) & self._mask
+
+        slot = self._wheels[level][index]
+
+        if slot:
+
+            self._wheels[level][index] = {}
+
+            # 重新挂载到下层，恰好在当前tick到期的定时器进入第0层当前槽，随后即被触发
+            for timer in slot:
+                self._add(timer, self._current_tick)
+
+        return index
+
+    def _on_tick(self):
+
+        self._tick_handle = None
+
+        now_tick = int((self._loop_time() - self._start_time) // self._tick)
+
+        # 事件循环阻塞时逐个tick追赶，wheel空闲期间错过的tick已在call_at中跳过
+        while self._current_tick < now_tick and self._timer_count > 0:
+
+            self._current_tick += 1
+
+            if self._current_tick & self._mask == 0:
+
+                level = 1
+
+                while level < self._levels and self._cascade(level) == 0:
+                    level += 1
+
+            index = self._current_tick & self._mask
+
+            slot = self._wheels[0][index]
+
+            if slot:
+                self._wheels[0][index] = {}
+                self._fire(slot)
+
+        if self._timer_count == 0:
+            self._current_tick = max(self._current_tick, now_tick)
+
+        self._ensure_ticking()
+
+    def _fire(self, slot):
+
+        now_time = self._event_loop.time()
+
+        # 回调中可能取消同一批次中的其它定时器
+        for timer in list(slot):
+
+            if timer._slot is not slot:
+                continue
+
+            timer._slot = None
+
+            # 超出最大范围被提前挂载的定时器
+            if timer._when > now_time:
+                self._add(timer)
+                continue
+
+            self._timer_count -= 1
+            self._fired_count += 1
+
+            try:
+                timer._context.run(timer._callback, *timer._args)
+            except Exception as err:
+                Utils.log.error(err)
+
+    def snapshot(self):
+
+        return {
+            r'tick': self._tick,
+            r'timers': self._timer_count,
+            r'fired': self._fired_count,
+            r'current_tick': self._current_tick,
+        }
 
 
 class _BaseTask(TaskInterface):
     """异步任务基类
+
+    指定timing_wheel时由时间轮调度，否则使用事件循环的call_at
+    jitter大于0时首次调度会随机延后[0, jitter]秒，用于错开大量同时启动的任务
+
+    overrun_policy为None时在执行结束后才调度下一次执行，执行耗时超过周期时记为一次overrun
+    指定overrun_policy时按固定频率调度，到达执行时间而上一次执行尚未结束时记为一次overrun，并按策略处理:
+        OVERRUN_SKIP: 跳过本次执行
+        OVERRUN_QUEUE_ONE: 在上一次执行结束后立即补执行一次，多次overrun只补执行一次
+        OVERRUN_CONCURRENT: 并发执行，并发数达到max_concurrency时跳过本次执行
+    执行统计(耗时、错误、overrun与跳过次数)通过get_stats获取
+
     """
 
-    def __init__(self, _callable):
+    OVERRUN_SKIP = r'skip'
+    OVERRUN_QUEUE_ONE = r'queue_one'
+    OVERRUN_CONCURRENT = r'concurrent'
+
+    def __init__(
+            self, _callable, *, timing_wheel=None, jitter=0, overrun_policy=None, max_concurrency=1, name=None
+    ):
+
+        if overrun_policy not in (None, self.OVERRUN_SKIP, self.OVERRUN_QUEUE_ONE, self.OVERRUN_CONCURRENT):
+            raise ValueError(f'invalid overrun policy: {overrun_policy}')
 
         self._running = False
         self._next_timeout = 0
@@ -24,6 +284,17 @@ class _BaseTask(TaskInterface):
 
         self._callable = _callable
 
+        self._timing_wheel = timing_wheel
+        self._jitter = jitter
+
+        self._overrun_policy = overrun_policy
+        self._max_concurrency = max(1, max_concurrency)
+
+        self._active_count = 0
+        self._pending = False
+
+        self._metrics = TaskMetrics(name if name is not None else getattr(_callable, r'__qualname__', str(_callable)))
+
     def start(self, promptly=False, *, event_loop=None):
 
         if event_loop:
@@ -36,7 +307,7 @@ class _BaseTask(TaskInterface):
         if promptly:
             self._timeout_handle = Utils.call_soon(self._run)
         else:
-            self._schedule_next()
+            self._schedule_next(self._jitter)
 
     def stop(self):
 
@@ -50,29 +321,119 @@ class _BaseTask(TaskInterface):
 
         return self._running
 
+    @property
+    def overrun_policy(self):
+
+        return self._overrun_policy
+
+    @property
+    def active_count(self):
+
+        return self._active_count
+
+    def get_stats(self):
+
+        result = self._metrics.snapshot()
+
+        result[r'active'] = self._active_count
+
+        return result
+
+    def _get_period(self):
+        """执行周期(秒)，无固定周期时返回None
+        """
+
+        return None
+
     async def _run(self):
 
         if not self._running:
             return
 
+        if self._overrun_policy is None:
+
+            try:
+                await self._execute()
+            finally:
+                self._schedule_next()
+
+            return
+
+        self._schedule_next()
+
+        if self._active_count == 0:
+            await self._execute()
+            return
+
+        self._metrics.incr_overrun()
+
+        if self._overrun_policy == self.OVERRUN_CONCURRENT and self._active_count < self._max_concurrency:
+            await self._execute()
+        elif self._overrun_policy == self.OVERRUN_QUEUE_ONE and not self._pending:
+            self._pending = True
+        else:
+            self._metrics.incr_skip()
+            Utils.log.warning(f'task overrun, skip: {self._metrics.name}')
+
+    async def _execute(self):
+
+        self._active_count += 1
+
         try:
 
-            await Utils.awaitable_wrapper(
-                self._callable()
-            )
+            while True:
+
+                error = None
+                start_time = self._event_loop.time()
 
-        except Exception as err:
+                try:
 
-            Utils.log.error(err)
+                    await Utils.awaitable_wrapper(
+                        self._callable()
+                    )
+
+                except Exception as err:
+
+                    error = err
+
+                    Utils.log.error(err)
+
+                duration = self._event_loop.time() - start_time
+
+                self._metrics.observe(duration, error)
+
+                period = self._get_period()
+
+                if self._overrun_policy is None and period is not None and duration > period:
+                    self._metrics.incr_overrun()
+
+                if not self._pending:
+                    break
+
+                self._pending = False
+
+                if not self._running:
+                    break
 
         finally:
 
-            self._schedule_next()
+            self._active_count -= 1
+
+    def _get_jitter(self, jitter):
 
-    def _schedule_next(self):
+        return Utils.random.uniform(0, jitter) if jitter > 0 else 0
 
-        if self._running:
-            self._timeout_handle = Utils.call_at(self._update_next(), self._run)
+    def _schedule_next(self, jitter=0):
+
+        if not self._running:
+            return
+
+        next_timeout = self._update_next() + self._get_jitter(jitter)
+
+        if self._timing_wheel is not None:
+            self._timeout_handle = self._timing_wheel.call_at(next_timeout, self._run)
+        else:
+            self._timeout_handle = Utils.call_at(next_timeout, self._run)
 
     def _update_next(self):
 
@@ -97,12 +458,16 @@ class LoopTask(_BaseTask):
 
         return task
 
-    def __init__(self, _callable, limit_time):
+    def __init__(self, _callable, limit_time, **kwargs):
 
-        super().__init__(_callable)
+        super().__init__(_callable, **kwargs)
 
         self._limit_time = limit_time
 
+    def _get_period(self):
+
+        return self._limit_time
+
     def _update_next(self):
 
         now_time = self._event_loop.time()
@@ -132,12 +497,16 @@ class IntervalTask(_BaseTask):
 
         return task
 
-    def __init__(self, _callable, interval):
+    def __init__(self, _callable, interval, **kwargs):
 
-        super().__init__(_callable)
+        super().__init__(_callable, **kwargs)
 
         self._interval = interval
 
+    def _get_period(self):
+
+        return self._interval
+
     def _update_next(self):
 
         self._next_timeout = self._event_loop.time() + self._interval
@@ -147,6 +516,9 @@ class IntervalTask(_BaseTask):
 
 class CronTask(_BaseTask, CronTab):
     """定时任务类
+
+    定时任务的触发时间对齐在整分等边界上，jitter对每次调度生效
+
     """
 
     @classmethod
@@ -161,9 +533,9 @@ class CronTask(_BaseTask, CronTab):
 
         return task
 
-    def __init__(self, _callable, crontab, default_now=None, default_utc=None):
+    def __init__(self, _callable, crontab, default_now=None, default_utc=None, **kwargs):
 
-        _BaseTask.__init__(self, _callable)
+        _BaseTask.__init__(self, _callable, **kwargs)
         CronTab.__init__(self, crontab)
 
         self._default_now = default_now
@@ -183,14 +555,320 @@ class CronTask(_BaseTask, CronTab):
 
         return self._next_timeout
 
+    def _schedule_next(self, jitter=0):
+
+        super()._schedule_next(self._jitter)
+
+
+class _FairQueue:
+    """按租户轮转出队的等待队列
+
+    每个租户一个先进先出队列，出队时依次轮转有等待任务的租户，入队和出队均为O(1)
+
+    """
+
+    def __init__(self, priority, weight):
+
+        self._priority = priority
+        self._weight = weight
+
+        # 平滑加权轮询的当前权重
+        self.current_weight = 0
+
+        self._tenants = OrderedDict()
+        self._length = 0
+
+        self._wait_time = Histogram()
+
+        self._admitted = 0
+        self._rejected = 0
+        self._expired = 0
+
+    def __len__(self):
+
+        return self._length
+
+    @property
+    def priority(self):
+
+        return self._priority
+
+    @property
+    def weight(self):
+
+        return self._weight
+
+    def get_tenant_length(self, tenant):
+
+        queue = self._tenants.get(tenant)
+
+        return len(queue) if queue is not None else 0
+
+    def push(self, tenant, task):
+
+        queue = self._tenants.get(tenant)
+
+        if queue is None:
+            queue = self._tenants[tenant] = deque()
+
+        queue.append(task)
+
+        self._length += 1
+        self._admitted += 1
+
+    def pop(self):
+
+        tenant, queue = next(iter(self._tenants.items()))
+
+        task = queue.popleft()
+
+        if queue:
+            self._tenants.move_to_end(tenant)
+        else:
+            del self._tenants[tenant]
+
+        self._length -= 1
+
+        self._wait_time.observe((Utils.loop_time() - task.build_time) * 1000)
+
+        return task
+
+    def _discard(self, tenant, last):
+
+        queue = self._tenants[tenant]
+
+        task = queue.pop() if last else queue.popleft()
+
+        if not queue:
+            del self._tenants[tenant]
+
+        self._length -= 1
+
+        return task
+
+    def discard_first(self, tenant):
+        """移除租户最早入队的任务，用于等待超时
+        """
+
+        self._expired += 1
+
+        return self._discard(tenant, False)
+
+    def discard_last(self, tenant):
+        """移除租户最晚入队的任务，用于收缩等待队列
+        """
+
+        return self._discard(tenant, True)
+
+    def incr_rejected(self):
+
+        self._rejected += 1
+
+    def snapshot(self):
+
+        return {
+            r'weight': self._weight,
+            r'waiting': self._length,
+            r'tenants': len(self._tenants),
+            r'admitted': self._admitted,
+            r'rejected': self._rejected,
+            r'expired': self._expired,
+            r'wait_time': self._wait_time.snapshot(),
+        }
+
+
+class _AdaptiveLimit:
+    """自适应并发上限基类，limit始终介于min_limit与max_limit之间
+    """
+
+    def __init__(self, min_limit, max_limit, initial_limit):
+
+        if min_limit < 1 or max_limit < min_limit:
+            raise ValueError(r'adaptive limit requires 1 <= min_limit <= max_limit')
+
+        self._min_limit = min_limit
+        self._max_limit = max_limit
+
+        self._limit = float(min(max_limit, max(min_limit, initial_limit if initial_limit else min_limit)))
+
+        self._sample_count = 0
+        self._error_count = 0
+
+        self._latency = Histogram()
+
+    @property
+    def limit(self):
+
+        return int(self._limit)
+
+    def _clamp(self, val):
+
+        return min(self._max_limit, max(self._min_limit, val))
+
+    def _calculate(self, latency, error, inflight):
+
+        raise NotImplementedError()
+
+    def update(self, latency, error, inflight):
+        """根据一次完成的任务更新并发上限，latency单位为秒，inflight为任务完成时的运行任务数，返回新的并发上限
+        """
+
+        self._sample_count += 1
+
+        if error:
+            self._error_count += 1
+
+        self._latency.observe(latency * 1000)
+
+        self._limit = self._clamp(self._calculate(latency, error, inflight))
+
+        return self.limit
+
+    def snapshot(self):
+
+        return {
+            r'limit': self.limit,
+            r'min_limit': self._min_limit,
+            r'max_limit': self._max_limit,
+            r'samples': self._sample_count,
+            r'errors': self._error_count,
+            r'latency': self._latency.snapshot(),
+        }
+
+
+class AIMDLimit(_AdaptiveLimit):
+    """加性增、乘性减(AIMD)的并发上限
+
+    任务失败或耗时超过latency_threshold秒(为0时不检查耗时)时上限乘以backoff_ratio
+    否则在运行任务数达到上限的一半以上时上限加一，运行任务数较少时说明并发不是瓶颈，上限保持不变
+
+    """
+
+    def __init__(self, min_limit=1, max_limit=200, *, initial_limit=None, backoff_ratio=0.9, latency_threshold=0):
+
+        super().__init__(min_limit, max_limit, initial_limit)
+
+        self._backoff_ratio = backoff_ratio
+        self._latency_threshold = latency_threshold
+
+    def _calculate(self, latency, error, inflight):
+
+        if error or (self._latency_threshold > 0 and latency > self._latency_threshold):
+            return self._limit * self._backoff_ratio
+
+        if inflight * 2 >= self._limit:
+            return self._limit + 1
+
+        return self._limit
+
+
+class GradientLimit(_AdaptiveLimit):
+    """基于耗时梯度的并发上限(Vegas风格)
+
+    以最近两个窗口(每window个样本)内的最小耗时作为无排队时的基准耗时，短期耗时为指数移动平均
+    梯度 = tolerance * 基准耗时 / 短期耗时，取值范围[0.5, 1]，新上限 = 当前上限 * 梯度 + sqrt(当前上限)
+    耗时上升(出现排队)时梯度小于1，上限随之下降，并按smoothing平滑；任务失败时梯度按0.5计算且不计入耗时
+    基准耗时按窗口滚动，后端整体变慢后会在两个窗口内跟随
+
+    """
+
+    def __init__(
+            self, min_limit=1, max_limit=200, *, initial_limit=None, smoothing=0.2, tolerance=1.5,
+            short_window=10, window=500
+    ):
+
+        super().__init__(min_limit, max_limit, initial_limit)
+
+        self._smoothing = smoothing
+        self._tolerance = tolerance
+
+        self._short_factor = 2 / (short_window + 1)
+        self._short_latency = 0
+
+        self._window = window
+        self._window_count = 0
+
+        self._min_latency = 0
+        self._prev_min_latency = 0
+
+    @property
+    def base_latency(self):
+
+        if self._prev_min_latency > 0:
+            return min(self._min_latency, self._prev_min_latency)
+        else:
+            return self._min_latency
+
+    def _calculate(self, latency, error, inflight):
+
+        # 失败的任务耗时不具有参考价值，只按0.5的梯度收缩
+        if error:
+            return self._limit * (1 - self._smoothing) + (self._limit * 0.5) * self._smoothing
+
+        if self._short_latency == 0:
+            self._short_latency = latency
+        else:
+            self._short_latency += (latency - self._short_latency) * self._short_factor
+
+        self._window_count += 1
+
+        if self._window_count > self._window:
+            self._window_count = 1
+            self._prev_min_latency, self._min_latency = self._min_latency, latency
+        elif self._min_latency == 0 or latency < self._min_latency:
+            self._min_latency = latency
+
+        # 运行任务数较少时说明并发不是瓶颈，避免上限无限增长
+        if inflight * 2 < self._limit or self._short_latency <= 0:
+            return self._limit
+
+        gradient = max(0.5, min(1.0, self._tolerance * self.base_latency / self._short_latency))
+
+        new_limit = self._limit * gradient + Utils.math.sqrt(self._limit)
+
+        return self._limit * (1 - self._smoothing) + new_limit * self._smoothing
+
+    def snapshot(self):
+
+        result = super().snapshot()
+
+        result[r'short_latency'] = round(self._short_latency * 1000, 3)
+        result[r'base_latency'] = round(self.base_latency * 1000, 3)
+
+        return result
+
 
 class RateLimiter:
     """流量控制器，用于对计算资源的保护
     添加任务append函数如果成功会返回Future对象，可以通过await该对象等待执行结果
     进入队列的任务，如果触发限流行为会通过在Future上引发CancelledError传递出来
+    timeout大于0时，在等待队列中超过timeout秒的任务会由定时器及时移除，并在Future上引发RateLimitTimeoutError
+
+    priorities为{优先级: 权重}，等待的任务在各优先级之间按权重平滑轮询出队，同一优先级内按租户轮流出队
+    tenant_waiting_limit大于0时限制单个租户在每个优先级中的等待任务数，避免单个租户占满等待队列
+    未指定优先级和租户的任务进入default_priority(默认为priorities中的第一个)的公共租户，此时与先进先出一致
+
+    limiter = RateLimiter(8, 64, priorities={r'interactive': 4, r'batch': 1}, tenant_waiting_limit=16)
+    limiter.append_with_priority(None, r'batch', tenant_id, func, *args)
+
+    adaptive_limit为AIMDLimit或GradientLimit实例时，running_limit根据已完成任务的耗时和失败情况自动调整
+    此时初始的running_limit参数被adaptive_limit的当前上限覆盖
+
+    limiter = RateLimiter(0, 256, adaptive_limit=GradientLimit(4, 128))
+
     """
 
-    def __init__(self, running_limit, waiting_limit=0, timeout=0):
+    DEFAULT_PRIORITY = r'default'
+
+    def __init__(
+            self, running_limit, waiting_limit=0, timeout=0,
+            *, priorities=None, default_priority=None, tenant_waiting_limit=0, adaptive_limit=None
+    ):
+
+        self._adaptive_limit = adaptive_limit
+
+        if adaptive_limit is not None:
+            running_limit = adaptive_limit.limit
 
         self._running_limit = running_limit
         self._waiting_limit = waiting_limit
@@ -198,8 +876,23 @@ class RateLimiter:
         self._timeout = timeout
 
         self._running_tasks = OrderedDict()
+
+        # 任务名 => (任务, 优先级队列, 租户)，按入队顺序排列，两端分别是最早和最晚入队的任务
         self._waiting_tasks = OrderedDict()
 
+        self._expire_timer = None
+
+        if not priorities:
+            priorities = {self.DEFAULT_PRIORITY: 1}
+
+        self._waiting_queues = OrderedDict(
+            (priority, _FairQueue(priority, weight)) for priority, weight in priorities.items()
+        )
+
+        self._default_priority = default_priority if default_priority is not None else next(iter(priorities))
+
+        self._tenant_waiting_limit = tenant_waiting_limit
+
     @property
     def running_tasks(self):
 
@@ -213,7 +906,7 @@ class RateLimiter:
     @property
     def waiting_tasks(self):
 
-        return list(self._waiting_tasks.values())
+        return [item[0] for item in self._waiting_tasks.values()]
 
     @property
     def waiting_length(self):
@@ -235,30 +928,44 @@ class RateLimiter:
 
         return self._append(name, func, *args, **kwargs)
 
+    def append_with_priority(self, name, priority, tenant, func, *args, **kwargs):
+        """按优先级和租户添加任务，name为None时自动生成
+        """
+
+        return self._append_with_priority(name, priority, tenant, func, *args, **kwargs)
+
     def _append(self, name, func, *args, **kwargs):
 
+        return self._append_with_priority(name, None, None, func, *args, **kwargs)
+
+    def _append_with_priority(self, name, priority, tenant, func, *args, **kwargs):
+
         task = None
 
         task_tag = f"{name or r''} {func} {args or r''} {kwargs or r''}"
 
+        queue = self._waiting_queues[self._default_priority if priority is None else priority]
+
         if name is None or ((name not in self._running_tasks) and (name not in self._waiting_tasks)):
 
-            if self._check_running_limit():
+            if self._check_running_limit() and len(self._waiting_tasks) == 0:
 
                 task = self._create_task(name, func, *args, **kwargs)
                 self._add_running_tasks(task)
 
                 Utils.log.debug(f'rate limit add running tasks: {task_tag}')
 
-            elif self._check_waiting_limit():
+            elif self._check_waiting_limit() and self._check_tenant_waiting_limit(queue, tenant):
 
                 task = self._create_task(name, func, *args, **kwargs)
-                self._add_waiting_tasks(task)
+                self._add_waiting_tasks(task, queue, tenant)
 
                 Utils.log.debug(f'rate limit add waiting tasks: {task_tag}')
 
             else:
 
+                queue.incr_rejected()
+
                 Utils.log.warning(
                     f'rate limit: {task_tag}\n'
                     f'running: {self.running_length}/{self.running_limit}\n'
@@ -283,6 +990,11 @@ class RateLimiter:
 
         self._recover_waiting_tasks()
 
+    @property
+    def adaptive_limit(self):
+
+        return self._adaptive_limit
+
     def _check_running_limit(self):
 
         return (self._running_limit <= 0) or (len(self._running_tasks) < self._running_limit)
@@ -297,13 +1009,45 @@ class RateLimiter:
 
         self._waiting_limit = val
 
-        if len(self._waiting_tasks) > self._waiting_limit:
-            self._waiting_tasks = self._waiting_tasks[:self._waiting_limit]
+        if self._waiting_limit <= 0:
+            return
+
+        # 保留最早入队的任务，最晚入队的任务同时也位于其租户队列的末尾，每次移除为O(1)
+        while len(self._waiting_tasks) > self._waiting_limit:
+
+            name, (task, queue, tenant) = self._waiting_tasks.popitem(True)
+
+            queue.discard_last(tenant)
+
+            task.cancel()
+
+            Utils.log.warning(f'rate limit waiting limit shrink: {name}')
 
     def _check_waiting_limit(self):
 
         return (self._waiting_limit <= 0) or (len(self._waiting_tasks) < self._waiting_limit)
 
+    def _check_tenant_waiting_limit(self, queue, tenant):
+
+        return (self._tenant_waiting_limit <= 0) or (queue.get_tenant_length(tenant) < self._tenant_waiting_limit)
+
+    @property
+    def priorities(self):
+
+        return {priority: queue.weight for priority, queue in self._waiting_queues.items()}
+
+    def get_stats(self):
+        """各优先级的等待数、租户数、入队与拒绝次数、等待耗时(毫秒)统计
+        """
+
+        return {
+            r'running': len(self._running_tasks),
+            r'running_limit': self._running_limit,
+            r'waiting': len(self._waiting_tasks),
+            r'adaptive': self._adaptive_limit.snapshot() if self._adaptive_limit is not None else None,
+            r'priorities': {priority: queue.snapshot() for priority, queue in self._waiting_queues.items()},
+        }
+
     @property
     def timeout(self):
 
@@ -314,14 +1058,19 @@ class RateLimiter:
 
         self._timeout = val
 
+        self._expire_waiting_tasks()
+
     def _check_timeout(self, task):
 
         return (self._timeout <= 0) or ((Utils.loop_time() - task.build_time) < self._timeout)
 
     def _add_running_tasks(self, task):
 
-        if not self._check_timeout(task):
-            task.cancel()
+        # 等待期间已被调用方取消的任务不再执行
+        if task.done():
+            Utils.log.debug(f'rate limit skip done task: {task.name}')
+        elif not self._check_timeout(task):
+            task.set_exception(RateLimitTimeoutError(task.name))
             Utils.log.warning(f'rate limit timeout: {task.name} build_time:{task.build_time}')
         elif task.name in self._running_tasks:
             task.cancel()
@@ -330,26 +1079,113 @@ class RateLimiter:
             task.add_done_callback(self._done_callback)
             self._running_tasks[task.name] = task.run()
 
-    def _add_waiting_tasks(self, task):
+    def _add_waiting_tasks(self, task, queue, tenant):
 
         if task.name not in self._waiting_tasks:
-            self._waiting_tasks[task.name] = task
+            self._waiting_tasks[task.name] = (task, queue, tenant)
+            queue.push(tenant, task)
+            self._schedule_expire()
         else:
             task.cancel()
             Utils.log.warning(f'rate limit duplicate: {task.name}')
 
+    def _pop_waiting_task(self):
+
+        selected = None
+        total_weight = 0
+
+        # 平滑加权轮询，在有等待任务的优先级之间按权重分配出队机会
+        for queue in self._waiting_queues.values():
+
+            if len(queue) == 0:
+                continue
+
+            queue.current_weight += queue.weight
+            total_weight += queue.weight
+
+            if selected is None or queue.current_weight > selected.current_weight:
+                selected = queue
+
+        selected.current_weight -= total_weight
+
+        task = selected.pop()
+
+        del self._waiting_tasks[task.name]
+
+        return task
+
+    def _schedule_expire(self):
+
+        if self._timeout <= 0 or self._expire_timer is not None or len(self._waiting_tasks) == 0:
+            return
+
+        task = next(iter(self._waiting_tasks.values()))[0]
+
+        self._expire_timer = Utils.call_at(task.build_time + self._timeout, self._on_expire_timer)
+
+    def _on_expire_timer(self):
+
+        self._expire_timer = None
+
+        self._expire_waiting_tasks()
+
+    def _expire_waiting_tasks(self):
+        """移除等待超时的任务，最早入队的任务同时也位于其租户队列的头部，每次移除为O(1)
+        """
+
+        if self._expire_timer is not None:
+            self._expire_timer.cancel()
+            self._expire_timer = None
+
+        if self._timeout <= 0:
+            return
+
+        while len(self._waiting_tasks) > 0:
+
+            task, queue, tenant = next(iter(self._waiting_tasks.values()))
+
+            if self._check_timeout(task):
+                break
+
+            self._waiting_tasks.popitem(False)
+
+            queue.discard_first(tenant)
+
+            if task.done():
+                continue
+
+            task.set_exception(RateLimitTimeoutError(task.name))
+
+            Utils.log.warning(f'rate limit timeout: {task.name} build_time:{task.build_time}')
+
+        self._schedule_expire()
+
     def _recover_waiting_tasks(self):
 
         for _ in range(len(self._waiting_tasks)):
 
             if self._check_running_limit():
-                item = self._waiting_tasks.popitem(False)
-                self._add_running_tasks(item[1])
+                self._add_running_tasks(self._pop_waiting_task())
             else:
                 break
 
+    def _update_adaptive_limit(self, task):
+
+        error = task.cancelled() or task.exception() is not None
+
+        limit = self._adaptive_limit.update(
+            Utils.loop_time() - task.run_time, error, len(self._running_tasks)
+        )
+
+        if limit != self._running_limit:
+            Utils.log.debug(f'rate limit adaptive running limit: {self._running_limit} => {limit}')
+            self._running_limit = limit
+
     def _done_callback(self, task):
 
+        if self._adaptive_limit is not None and task.run_time is not None:
+            self._update_adaptive_limit(task)
+
         if task.name in self._running_tasks:
             self._running_tasks.pop(task.name)
 
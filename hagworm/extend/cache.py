@@ -49,6 +49,10 @@ class StackCache:
 
         del self._cache[key]
 
+    def keys(self):
+
+        return list(self._cache.keys())
+
     def size(self):
 
         return len(self._cache)
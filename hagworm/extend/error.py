@@ -33,3 +33,31 @@ class ConstError(BaseError):
 # NTP校准异常
 class NTPCalibrateError(BaseError):
     pass
+
+
+# 过载保护异常，调用方应快速失败(如返回503)
+class OverloadError(BaseError):
+    pass
+
+
+# 熔断异常
+class CircuitBreakerError(OverloadError):
+    pass
+
+
+# 连接池过载异常(获取连接超时或等待队列已满)
+class PoolOverloadError(OverloadError):
+    pass
+
+
+# 限流等待超时异常(任务在等待队列中超过timeout未被执行)
+class RateLimitTimeoutError(OverloadError):
+    pass
+
+
+# 跨分片操作异常(事务、管道或多键命令的键不在同一分片)，data为首个落在其它分片上的键
+class CrossShardError(BaseError):
+
+    def __str__(self):
+
+        return f'Key is on a different shard: {self._data}'
@@ -0,0 +1,427 @@
+# -*- coding: utf-8 -*-
+
+import re
+import bisect
+
+from cachetools import LRUCache
+
+from .base import Utils
+
+
+# 单位毫秒
+DEFAULT_LATENCY_BUCKETS = (0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class Histogram:
+    """直方图统计
+
+    按桶累计观测值的分布，分位数按所在桶的上界估算
+
+    """
+
+    def __init__(self, buckets=DEFAULT_LATENCY_BUCKETS):
+
+        self._buckets = tuple(sorted(buckets))
+
+        self._counts = None
+
+        self._count = 0
+        self._sum = 0
+        self._max = 0
+
+        self.reset()
+
+    @property
+    def count(self):
+
+        return self._count
+
+    @property
+    def sum(self):
+
+        return self._sum
+
+    @property
+    def max(self):
+
+        return self._max
+
+    def reset(self):
+
+        self._counts = [0] * (len(self._buckets) + 1)
+
+        self._count = 0
+        self._sum = 0
+        self._max = 0
+
+    def observe(self, val):
+
+        self._counts[bisect.bisect_left(self._buckets, val)] += 1
+
+        self._count += 1
+        self._sum += val
+
+        if val > self._max:
+            self._max = val
+
+    def percentile(self, percent):
+
+        if self._count == 0:
+            return 0
+
+        rank = self._count * percent / 100
+        total = 0
+
+        for index, count in enumerate(self._counts):
+
+            total += count
+
+            if total >= rank:
+                return self._buckets[index] if index < len(self._buckets) else self._max
+
+        return self._max
+
+    def snapshot(self):
+
+        buckets = {}
+        total = 0
+
+        for index, count in enumerate(self._counts):
+            total += count
+            buckets[str(self._buckets[index]) if index < len(self._buckets) else r'+Inf'] = total
+
+        return {
+            r'count': self._count,
+            r'sum': round(self._sum, 3),
+            r'avg': round(self._sum / self._count, 3) if self._count > 0 else 0,
+            r'max': round(self._max, 3),
+            r'p50': self.percentile(50),
+            r'p90': self.percentile(90),
+            r'p99': self.percentile(99),
+            r'buckets': buckets,
+        }
+
+
+class PoolMetrics:
+    """连接池指标
+
+    记录获取连接的等待耗时、命令耗时、获取超时次数、等待队列已满被拒绝次数和新建连接数，耗时单位为毫秒
+    recent_acquire_wait为最近一个调节周期内的等待耗时，由PoolSizer消费后重置
+
+    """
+
+    def __init__(self, name):
+
+        self._name = name
+
+        self._acquire_wait = Histogram()
+        self._recent_acquire_wait = Histogram()
+
+        self._command_latency = Histogram()
+
+        self._acquire_timeout = 0
+        self._acquire_rejected = 0
+        self._conn_created = 0
+
+    @property
+    def name(self):
+
+        return self._name
+
+    @property
+    def acquire_wait(self):
+
+        return self._acquire_wait
+
+    @property
+    def recent_acquire_wait(self):
+
+        return self._recent_acquire_wait
+
+    @property
+    def command_latency(self):
+
+        return self._command_latency
+
+    @property
+    def conn_created(self):
+
+        return self._conn_created
+
+    def observe_acquire(self, wait_time):
+
+        self._acquire_wait.observe(wait_time * 1000)
+        self._recent_acquire_wait.observe(wait_time * 1000)
+
+    def observe_command(self, latency):
+
+        self._command_latency.observe(latency * 1000)
+
+    def incr_acquire_timeout(self):
+
+        self._acquire_timeout += 1
+
+    def incr_acquire_rejected(self):
+
+        self._acquire_rejected += 1
+
+    def incr_conn_created(self, val=1):
+
+        self._conn_created += val
+
+    def snapshot(self, *, size=0, free=0, used=0, minsize=0, maxsize=0):
+
+        return {
+            r'name': self._name,
+            r'size': size,
+            r'free': free,
+            r'used': used,
+            r'minsize': minsize,
+            r'maxsize': maxsize,
+            r'acquire_timeout': self._acquire_timeout,
+            r'acquire_rejected': self._acquire_rejected,
+            r'conn_created': self._conn_created,
+            r'acquire_wait': self._acquire_wait.snapshot(),
+            r'command_latency': self._command_latency.snapshot(),
+        }
+
+
+class TaskMetrics:
+    """周期任务执行指标
+
+    记录每次执行的耗时(毫秒)、错误次数，以及上一次执行未结束时又到了下一次执行时间的超时次数(overrun)和因此跳过的次数
+
+    """
+
+    def __init__(self, name):
+
+        self._name = name
+
+        self._duration = Histogram()
+        self._last_duration = 0
+
+        self._error_count = 0
+        self._overrun_count = 0
+        self._skip_count = 0
+
+    @property
+    def name(self):
+
+        return self._name
+
+    @property
+    def duration(self):
+
+        return self._duration
+
+    @property
+    def overrun_count(self):
+
+        return self._overrun_count
+
+    @property
+    def error_count(self):
+
+        return self._error_count
+
+    def observe(self, duration, error=None):
+        """记录一次执行，耗时单位为秒
+        """
+
+        self._last_duration = duration * 1000
+
+        self._duration.observe(self._last_duration)
+
+        if error is not None:
+            self._error_count += 1
+
+    def incr_overrun(self):
+
+        self._overrun_count += 1
+
+    def incr_skip(self):
+
+        self._skip_count += 1
+
+    def snapshot(self):
+
+        return {
+            r'name': self._name,
+            r'runs': self._duration.count,
+            r'errors': self._error_count,
+            r'overrun': self._overrun_count,
+            r'skipped': self._skip_count,
+            r'last_duration': round(self._last_duration, 3),
+            r'duration': self._duration.snapshot(),
+        }
+
+
+class PoolSizer:
+    """连接池容量自适应调节
+
+    根据最近周期内获取连接的等待耗时(p90)计算新的最小连接数，结果始终介于minsize与maxsize之间
+    等待耗时不低于grow_threshold毫秒时扩容，不高于shrink_threshold毫秒且空闲连接富余时缩容
+
+    """
+
+    def __init__(self, minsize, maxsize, *, grow_threshold=10, shrink_threshold=1, step=2):
+
+        self._minsize = minsize
+        self._maxsize = maxsize
+
+        self._grow_threshold = grow_threshold
+        self._shrink_threshold = shrink_threshold
+
+        self._step = step
+
+    def calculate(self, current, used, wait_histogram):
+
+        wait_time = wait_histogram.percentile(90)
+
+        if wait_histogram.count > 0 and wait_time >= self._grow_threshold:
+            current = min(self._maxsize, current + self._step)
+        elif wait_time <= self._shrink_threshold and (current - used) > self._step:
+            current = max(self._minsize, current - self._step)
+
+        return current
+
+
+class StatementMetrics:
+    """语句级指标
+
+    按语句指纹(去除参数与字面量后的SQL)分别统计耗时直方图、影响行数、重试次数、获取连接的等待耗时和错误次数
+    耗时超过slow_time秒的语句以指纹形式记录慢查询日志，统计的语句指纹数超过max_statements后归入OTHER_STATEMENT
+
+    """
+
+    OTHER_STATEMENT = r'<other>'
+
+    _FINGERPRINT_RULES = (
+        (re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\""), r'?'),
+        (re.compile(r'%\(\w+\)s|%s|\b\d+(?:\.\d+)?\b'), r'?'),
+        (re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)'), r'(...)'),
+        (re.compile(r'\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+'), r'(...)'),
+        (re.compile(r'\s+'), r' '),
+    )
+
+    def __init__(self, name, *, slow_time=1, max_statements=0x400):
+
+        self._name = name
+
+        self._slow_time = slow_time
+        self._max_statements = max_statements
+
+        self._fingerprints = LRUCache(0x1000)
+
+        self._statements = {}
+
+        self._slow_count = 0
+
+    @property
+    def slow_time(self):
+
+        return self._slow_time
+
+    @slow_time.setter
+    def slow_time(self, val):
+
+        self._slow_time = val
+
+    @property
+    def slow_count(self):
+
+        return self._slow_count
+
+    def fingerprint(self, statement):
+
+        result = self._fingerprints.get(statement)
+
+        if result is None:
+
+            result = statement
+
+            for pattern, repl in self._FINGERPRINT_RULES:
+                result = pattern.sub(repl, result)
+
+            result = self._fingerprints[statement] = result.strip()
+
+        return result
+
+    def _get_stats(self, fingerprint):
+
+        stats = self._statements.get(fingerprint)
+
+        if stats is None:
+
+            if len(self._statements) >= self._max_statements:
+                fingerprint = self.OTHER_STATEMENT
+
+            stats = self._statements.get(fingerprint)
+
+            if stats is None:
+                stats = self._statements[fingerprint] = {
+                    r'latency': Histogram(),
+                    r'acquire_wait': Histogram(),
+                    r'rows': 0,
+                    r'retries': 0,
+                    r'errors': 0,
+                    r'slow': 0,
+                }
+
+        return stats
+
+    def observe(self, statement, elapsed, *, rowcount=0, retries=0, acquire_wait=0, error=None):
+        """记录一次语句执行，耗时单位为秒
+        """
+
+        fingerprint = self.fingerprint(statement)
+
+        stats = self._get_stats(fingerprint)
+
+        stats[r'latency'].observe(elapsed * 1000)
+        stats[r'acquire_wait'].observe(acquire_wait * 1000)
+
+        if rowcount > 0:
+            stats[r'rows'] += rowcount
+
+        stats[r'retries'] += retries
+
+        if error is not None:
+            stats[r'errors'] += 1
+
+        if self._slow_time > 0 and elapsed >= self._slow_time:
+
+            stats[r'slow'] += 1
+
+            self._slow_count += 1
+
+            Utils.log.warning(
+                f'Slow statement ({self._name}) {elapsed:.3f}s rows={rowcount} retries={retries} '
+                f'acquire_wait={acquire_wait:.3f}s error={type(error).__name__ if error else None}: {fingerprint}'
+            )
+
+    def reset(self):
+
+        self._statements.clear()
+
+        self._slow_count = 0
+
+    def snapshot(self):
+
+        return {
+            r'name': self._name,
+            r'slow_time': self._slow_time,
+            r'slow_count': self._slow_count,
+            r'statements': {
+                fingerprint: {
+                    r'count': stats[r'latency'].count,
+                    r'rows': stats[r'rows'],
+                    r'retries': stats[r'retries'],
+                    r'errors': stats[r'errors'],
+                    r'slow': stats[r'slow'],
+                    r'latency': stats[r'latency'].snapshot(),
+                    r'acquire_wait': stats[r'acquire_wait'].snapshot(),
+                }
+                for fingerprint, stats in self._statements.items()
+            },
+        }
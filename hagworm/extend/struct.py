@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import re
+import bisect
 import struct
 import threading
 
@@ -461,3 +462,55 @@ class KeyLowerDict(dict):
                 for key, val in _dict.items()
             }
         )
+
+
+class ConsistentHash:
+    """一致性哈希环
+
+    每个节点映射为多个虚拟节点，键中包含{...}时只对hash tag内的内容计算哈希，便于将相关的键路由到同一节点
+
+    """
+
+    def __init__(self, nodes, virtual_nodes=0xa0):
+
+        self._nodes = list(nodes)
+
+        points = sorted(
+            (Utils.md5_u32(f'{node}#{index}'), node_index)
+            for node_index, node in enumerate(self._nodes)
+            for index in range(virtual_nodes)
+        )
+
+        self._ring_hashes = [point[0] for point in points]
+        self._ring_nodes = [point[1] for point in points]
+
+    @property
+    def nodes(self):
+
+        return self._nodes
+
+    @staticmethod
+    def hash_tag(key):
+
+        key = Utils.basestring(key)
+
+        start = key.find(r'{')
+
+        if start >= 0:
+
+            end = key.find(r'}', start + 1)
+
+            if end > start + 1:
+                return key[start + 1:end]
+
+        return key
+
+    def get_node_index(self, key):
+
+        index = bisect.bisect(self._ring_hashes, Utils.md5_u32(self.hash_tag(key)))
+
+        return self._ring_nodes[index % len(self._ring_nodes)]
+
+    def get_node(self, key):
+
+        return self._nodes[self.get_node_index(key)]
@@ -3,11 +3,12 @@
 import os
 import aiohttp
 
-from aiohttp.web_exceptions import HTTPBadGateway
+from aiohttp.web_exceptions import HTTPBadGateway, HTTPServiceUnavailable
 
 from tornado.web import RequestHandler
 from tornado.websocket import WebSocketHandler
 
+from hagworm.extend.error import OverloadError
 from hagworm.extend.struct import Result
 from hagworm.extend.asyncio.base import Utils
 from hagworm.extend.asyncio.net import DownloadBuffer, HTTPClientPool
@@ -364,6 +365,15 @@ class RequestBaseHandler(RequestHandler, _BaseHandlerMixin):
 
         return None
 
+    def _handle_request_exception(self, e):
+
+        # 过载保护异常(熔断、连接池过载)直接返回503，不记录异常堆栈
+        if isinstance(e, OverloadError) and not self._finished:
+            Utils.log.warning(f'{self.request.method} {self.request.uri} overload: {e.data}')
+            self.send_error(HTTPServiceUnavailable.status_code)
+        else:
+            super()._handle_request_exception(e)
+
     def _parse_json_arguments(self):
 
         self.request.json_arguments = {}
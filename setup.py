@@ -24,6 +24,7 @@ setuptools.setup(
     python_requires=r'>= 3.7',
     install_requires=[
         r'aiohttp==3.6.2',
+        # 连接池的预热、保活和自适应调节依赖aiomysql和aioredis的内部状态，升级前需同步修改MySQLPool和_ConnectionsPool
         r'aiomysql==0.0.20',
         r'aioredis==1.3.1',
         r'async-timeout==3.0.1',
@@ -58,6 +59,10 @@ setuptools.setup(
         r'xmltodict==0.12.0',
         r'uvloop==0.14.0 ; sys_platform!="win32"',
     ],
+    extras_require={
+        r'msgpack': [r'msgpack>=1.0.0'],
+        r'lz4': [r'lz4>=3.1.0'],
+    },
     classifiers=[
         r'Programming Language :: Python :: 3.7',
         r'License :: OSI Approved :: Apache Software License',
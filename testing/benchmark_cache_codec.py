@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+
+os.chdir(os.path.dirname(__file__))
+sys.path.insert(0, os.path.abspath(r'../'))
+
+from terminal_table import Table
+
+from hagworm.extend.base import Utils
+from hagworm.extend.asyncio.cache import CacheCodec, LegacyCacheCodec
+
+
+CODECS = (
+    (r'legacy(zlib+pickle)', LegacyCacheCodec()),
+    (r'pickle', CacheCodec()),
+    (r'msgpack', CacheCodec(r'msgpack')),
+    (r'pickle+zlib(>1KB)', CacheCodec(compressor=r'zlib')),
+    (r'pickle+lz4(>1KB)', CacheCodec(compressor=r'lz4')),
+    (r'msgpack+lz4(>1KB)', CacheCodec(r'msgpack', r'lz4')),
+)
+
+VALUES = (
+    (r'int', 0xffff),
+    (r'str(32B)', Utils.uuid1()),
+    (r'dict(~1KB)', {f'key_{index}': Utils.uuid1() for index in range(0x18)}),
+    (r'list(~64KB)', [{r'id': index, r'name': Utils.uuid1()} for index in range(0x400)]),
+)
+
+TIMES = 0x2000
+
+
+def benchmark(codec, val, times):
+
+    stream = codec.encode(val)
+
+    start_time = time.perf_counter()
+
+    for _ in range(times):
+        codec.encode(val)
+
+    encode_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+
+    for _ in range(times):
+        codec.decode(stream)
+
+    decode_time = time.perf_counter() - start_time
+
+    return len(stream), encode_time / times * 1000000, decode_time / times * 1000000
+
+
+if __name__ == r'__main__':
+
+    reports = []
+
+    for val_name, val in VALUES:
+
+        for codec_name, codec in CODECS:
+
+            size, encode_time, decode_time = benchmark(codec, val, TIMES)
+
+            reports.append(
+                (
+                    val_name,
+                    codec_name,
+                    size,
+                    r'{:.2f}us'.format(encode_time),
+                    r'{:.2f}us'.format(decode_time),
+                )
+            )
+
+    print(Table.create(reports, (r'Value', r'Codec', r'Size', r'Encode', r'Decode'), use_ansi=False))
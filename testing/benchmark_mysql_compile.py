@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+
+os.chdir(os.path.dirname(__file__))
+sys.path.insert(0, os.path.abspath(r'../'))
+
+from terminal_table import Table
+
+from cachetools import LRUCache
+
+from sqlalchemy import MetaData, Table as SATable, Column, Integer, String, select, bindparam
+
+from aiomysql.sa import Engine
+from aiomysql.sa.engine import _dialect as dialect
+
+from hagworm.extend.asyncio.database import MySQLPool
+
+
+METADATA = MetaData()
+
+TABLE = SATable(
+    r'user', METADATA,
+    Column(r'id', Integer, primary_key=True),
+    Column(r'name', String(64)),
+    Column(r'email', String(128)),
+    Column(r'state', Integer),
+)
+
+PREPARED_LOOKUP = select([TABLE]).where(TABLE.c.id == bindparam(r'id'))
+PREPARED_FILTER = select([TABLE]).where(
+    (TABLE.c.name == bindparam(r'name')) & (TABLE.c.state == bindparam(r'state'))
+).order_by(TABLE.c.id.desc()).limit(10)
+
+TIMES = 0x2000
+
+
+class _RawConnection:
+    pass
+
+
+def _create_connection(compiled_cache):
+
+    return MySQLPool._Connection(_RawConnection(), Engine(dialect, None), compiled_cache)
+
+
+def benchmark(func, times):
+
+    start_time = time.perf_counter()
+
+    for index in range(times):
+        func(index)
+
+    return (time.perf_counter() - start_time) / times * 1000000
+
+
+if __name__ == r'__main__':
+
+    # 同一个语句对象分别在不开启和开启编译缓存的连接上执行，只比较编译缓存本身的收益
+    uncached = _create_connection(None)
+    cached = _create_connection(LRUCache(0x400))
+
+    def _compile_func(conn, query, params_func):
+
+        def _func(index):
+            params = params_func(index)
+            compiled = conn.compile(query, params)
+            return str(compiled), conn._base_params(query, params, compiled, False)
+
+        return _func
+
+    reports = []
+
+    for name, query, params_func in (
+            (r'select().where(id==?)', PREPARED_LOOKUP, lambda index: {r'id': index}),
+            (
+                r'select().where(name==? & state==?).order_by().limit()',
+                PREPARED_FILTER, lambda index: {r'name': f'name_{index}', r'state': 1}
+            ),
+    ):
+
+        uncached_time = benchmark(_compile_func(uncached, query, params_func), TIMES)
+        cached_time = benchmark(_compile_func(cached, query, params_func), TIMES)
+
+        reports.append(
+            (
+                name,
+                r'{:.2f}us'.format(uncached_time),
+                r'{:.2f}us'.format(cached_time),
+                r'{:.1f}x'.format(uncached_time / cached_time),
+            )
+        )
+
+    print(Table.create(reports, (r'Statement', r'Uncached', r'Cached', r'Speedup'), use_ansi=False))
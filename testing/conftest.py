@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+import time
+import shutil
+import socket
+import pytest
+import threading
+import subprocess
+
+
+def _get_free_port():
+
+    with socket.socket() as sock:
+        sock.bind((r'127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _check_resp2(address, timeout=3):
+    """aioredis 1.x仅支持RESP2协议，新版fakeredis可能以RESP3格式(_\\r\\n)回复空值
+    """
+
+    deadline = time.time() + timeout
+
+    while True:
+
+        try:
+            with socket.create_connection(address, timeout=timeout) as sock:
+                sock.sendall(b'*2\r\n$3\r\nGET\r\n$20\r\n__conftest_missing__\r\n')
+                return sock.recv(16) == b'$-1\r\n'
+        except OSError:
+            if time.time() > deadline:
+                return False
+            time.sleep(0.1)
+
+
+def _start_redis_servers(redis_server):
+
+    processes = []
+
+    for _ in range(2):
+
+        port = _get_free_port()
+
+        processes.append(
+            (
+                (r'127.0.0.1', port),
+                subprocess.Popen(
+                    [
+                        redis_server, r'--port', str(port), r'--bind', r'127.0.0.1',
+                        r'--save', r'', r'--appendonly', r'no',
+                    ],
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+                ),
+            )
+        )
+
+    return processes
+
+
+def _start_fake_servers():
+
+    fakeredis = pytest.importorskip(r'fakeredis')
+
+    if not hasattr(fakeredis, r'TcpFakeServer'):
+        pytest.skip(r'fakeredis TcpFakeServer is not available')
+
+    servers = []
+
+    for _ in range(2):
+
+        # 部分fakeredis版本在python3.11以下会抛出NotImplementedError
+        try:
+            server = fakeredis.TcpFakeServer((r'127.0.0.1', 0))
+        except Exception as err:
+            pytest.skip(f'fakeredis TcpFakeServer is not usable: {err!r}')
+
+        server.daemon_threads = True
+        server.block_on_close = False
+
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        servers.append(server)
+
+    return servers
+
+
+@pytest.fixture(scope=r'session')
+def redis_servers():
+    """启动两个独立的redis服务，返回地址列表
+
+    优先使用本地的redis-server，其次在后台线程中启动fakeredis服务
+    都不可用或协议不兼容时跳过
+
+    """
+
+    redis_server = shutil.which(r'redis-server')
+
+    if redis_server:
+
+        processes = _start_redis_servers(redis_server)
+
+        addresses = [address for address, _ in processes]
+
+        try:
+
+            if not all(_check_resp2(address) for address in addresses):
+                pytest.skip(r'redis-server is not ready')
+
+            yield addresses
+
+        finally:
+
+            for _, process in processes:
+                process.terminate()
+                process.wait()
+
+    else:
+
+        servers = _start_fake_servers()
+
+        addresses = [server.server_address for server in servers]
+
+        try:
+
+            if not all(_check_resp2(address) for address in addresses):
+                pytest.skip(r'fakeredis does not speak RESP2, which aioredis 1.x requires')
+
+            yield addresses
+
+        finally:
+
+            for server in servers:
+                server.shutdown()
+                server.server_close()
+
+
+@pytest.fixture
+def redis_address(redis_servers):
+
+    return redis_servers[0]
@@ -0,0 +1,741 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+import asyncio
+
+from aioredis import ReplyError, PoolClosedError
+
+from hagworm.extend.asyncio.base import Utils, TimeDiff
+from hagworm.extend.error import CrossShardError, PoolOverloadError
+from hagworm.extend.struct import ConsistentHash
+from hagworm.extend.asyncio.cache import CacheCodec, LegacyCacheCodec, RedisPool, ShardedRedisPool
+from hagworm.extend.asyncio.cache import NearCache, MLock, ShareCache, SlidingWindowLimiter, TokenBucketLimiter
+
+
+pytestmark = pytest.mark.asyncio
+# pytest.skip(allow_module_level=True)
+
+
+class TestCacheCodec:
+
+    async def test_codec_round_trip(self):
+
+        small_val = {r'id': 1, r'name': Utils.uuid1()}
+        large_val = {r'data': [Utils.uuid1() for _ in range(0xff)]}
+
+        for codec in (CacheCodec(), CacheCodec(compressor=r'zlib')):
+
+            assert codec.decode(codec.encode(small_val)) == small_val
+            assert codec.decode(codec.encode(large_val)) == large_val
+
+        codec = CacheCodec(compressor=r'zlib', compress_threshold=0x400)
+
+        assert codec.encode(small_val)[0] == CacheCodec.SERIALIZER_PICKLE
+        assert codec.encode(large_val)[0] == CacheCodec.SERIALIZER_PICKLE | CacheCodec.COMPRESSOR_ZLIB
+
+    async def test_codec_optional(self):
+
+        pytest.importorskip(r'msgpack')
+        pytest.importorskip(r'lz4.block')
+
+        small_val = {r'id': 1, r'name': Utils.uuid1()}
+        large_val = {r'data': [Utils.uuid1() for _ in range(0xff)]}
+
+        for codec in (CacheCodec(r'msgpack'), CacheCodec(r'msgpack', r'lz4'), CacheCodec(compressor=r'lz4')):
+
+            assert codec.decode(codec.encode(small_val)) == small_val
+            assert codec.decode(codec.encode(large_val)) == large_val
+
+        codec = CacheCodec(r'msgpack', r'lz4', 0x400)
+
+        assert codec.encode(small_val)[0] == CacheCodec.SERIALIZER_MSGPACK
+        assert codec.encode(large_val)[0] == CacheCodec.SERIALIZER_MSGPACK | CacheCodec.COMPRESSOR_LZ4
+
+        legacy_codec = LegacyCacheCodec()
+
+        codec = CacheCodec(r'msgpack', r'zlib', 0)
+
+        assert codec.decode(legacy_codec.encode(small_val)) == small_val
+        assert legacy_codec.decode(codec.encode(small_val)) == small_val
+
+    async def test_codec_compatible(self):
+
+        val = {r'id': 1, r'name': Utils.uuid1()}
+
+        legacy_codec = LegacyCacheCodec()
+
+        assert legacy_codec.encode(val) == Utils.pickle_dumps(val)
+
+        for codec in (CacheCodec(), CacheCodec(compressor=r'zlib', compress_threshold=0)):
+            assert codec.decode(legacy_codec.encode(val)) == val
+            assert legacy_codec.decode(codec.encode(val)) == val
+
+
+class _FlakyRedisPool(RedisPool):
+
+    def __init__(self, *args, failures=0, **kwargs):
+
+        super().__init__(*args, **kwargs)
+
+        self._failures = failures
+
+    async def _create_conn(self):
+
+        if self._failures > 0:
+            self._failures -= 1
+            raise ConnectionError()
+
+        return await super()._create_conn()
+
+
+class TestRedisPool:
+
+    async def test_warm_up(self, redis_address):
+
+        # 部分连接失败时只记录日志，缺少的连接在获取时按需补充
+        pool = await _FlakyRedisPool(redis_address, minsize=4, maxsize=8, keepalive_interval=0, failures=2)
+
+        metrics = pool.get_metrics()
+
+        assert metrics[r'size'] == 2 and metrics[r'free'] == 2
+
+        async with pool.get_client() as cache:
+            assert await cache.ping() == b'PONG'
+
+        await pool.close()
+
+        with pytest.raises(ConnectionError):
+            await _FlakyRedisPool(redis_address, minsize=2, maxsize=8, keepalive_interval=0, failures=2)
+
+    async def test_keep_alive(self, redis_address):
+
+        pool = await RedisPool(redis_address, minsize=2, maxsize=8, keepalive_interval=0)
+
+        conns_pool = pool._pool
+
+        dead_conn = conns_pool.free_connections()[0]
+
+        dead_conn.close()
+
+        await pool._keep_alive()
+
+        conns = conns_pool.free_connections()
+
+        # 失效的连接被丢弃，并补充到最小连接数
+        assert dead_conn not in conns
+        assert len(conns) == 2 and not any(conn.closed for conn in conns)
+        assert conns_pool.size == 2
+
+        await pool.close()
+
+    async def test_clone(self, redis_address):
+
+        pool = await RedisPool(redis_address, minsize=1, maxsize=4, keepalive_interval=0)
+
+        # 克隆的客户端(锁自动续期、后台刷新)沿用连接池的重试策略和熔断器
+        async with pool.get_client() as cache:
+            clone = cache.clone()
+            assert clone._retry_policy is pool.retry_policy
+            assert clone._circuit_breaker is pool.circuit_breaker
+
+        await pool.close()
+
+    async def test_max_waiting(self, redis_address):
+
+        pool = await RedisPool(redis_address, minsize=1, maxsize=3, max_waiting=1, keepalive_interval=0)
+
+        conns_pool = pool._pool
+
+        conns = [await conns_pool.acquire()]
+
+        # 连接池未满时，即使等待数已达到max_waiting也会新建连接
+        conns.extend(await asyncio.gather(conns_pool.acquire(), conns_pool.acquire()))
+
+        assert conns_pool.size == 3 and conns_pool.freesize == 0
+
+        waiter = asyncio.ensure_future(conns_pool.acquire())
+
+        await Utils.sleep(0.1)
+
+        with pytest.raises(PoolOverloadError):
+            await conns_pool.acquire()
+
+        assert pool.get_metrics()[r'acquire_rejected'] == 1
+
+        conns_pool.release(conns.pop())
+
+        conns.append(await waiter)
+
+        for conn in conns:
+            conns_pool.release(conn)
+
+        await pool.close()
+
+
+class TestAutoPipeline:
+
+    async def test_batching(self, redis_address):
+
+        pool = await RedisPool(redis_address, minsize=2, maxsize=4, auto_pipeline=True, keepalive_interval=0)
+
+        key = Utils.uuid1()
+
+        async with pool.get_client() as cache:
+
+            result = await asyncio.gather(*(cache.incr(key) for _ in range(50)))
+
+            assert sorted(result) == list(range(1, 51))
+            assert pool._auto_pipeline.flush_count == 1
+
+            assert await cache.set(key + r'_str', r'value') is True
+
+        await pool.close()
+
+    async def test_error_fan_out(self, redis_address):
+
+        pool = await RedisPool(redis_address, minsize=2, maxsize=4, auto_pipeline=True, keepalive_interval=0)
+
+        key = Utils.uuid1()
+
+        async with pool.get_client() as cache:
+
+            await cache.execute(b'SET', key, b'text')
+
+            result = await asyncio.gather(
+                cache.execute(b'INCR', key), cache.execute(b'GET', key), cache.execute(b'INCR', key + r'_int'),
+                return_exceptions=True
+            )
+
+            assert isinstance(result[0], ReplyError)
+            assert result[1] == b'text'
+            assert result[2] == 1
+
+        await pool.close()
+
+        assert pool._auto_pipeline.closed
+
+        with pytest.raises(PoolClosedError):
+            await pool._auto_pipeline.execute(b'GET', key)
+
+
+class TestNearCache:
+
+    async def test_near_cache(self, redis_address):
+
+        pool = await RedisPool(redis_address, minsize=2, maxsize=8, keepalive_interval=0)
+
+        channel = Utils.uuid1()
+
+        # 两个实例模拟两个进程
+        near_cache1 = NearCache(pool, channel)
+        near_cache2 = NearCache(pool, channel)
+
+        # 失效处理完成后收到通知，替代固定时长的等待
+        queues = []
+
+        for near_cache in (near_cache1, near_cache2,):
+            queue = asyncio.Queue()
+            near_cache._event_dispatcher.add_listener(near_cache._event_type, queue.put_nowait)
+            queues.append(queue)
+
+        async def _wait_invalidated():
+            for _queue in queues:
+                await asyncio.wait_for(_queue.get(), 5)
+
+        # 等待两个实例都完成订阅
+        bus_channel = near_cache1._event_dispatcher._channels[0]
+
+        async with pool.get_client() as cache:
+            for _ in range(500):
+                if (await cache.pubsub_numsub(bus_channel)).get(bus_channel.encode()) == 2:
+                    break
+                await Utils.sleep(0.01)
+
+        key = Utils.uuid1()
+
+        await near_cache1.set(key, 1)
+        await _wait_invalidated()
+
+        assert await near_cache2.get(key) == 1
+        assert await near_cache2.get(key) == 1
+
+        stats = near_cache2.stats()
+
+        assert stats[r'hit'] == 1 and stats[r'miss'] == 1 and stats[r'size'] == 1
+
+        await near_cache1.set(key, 2)
+        await _wait_invalidated()
+
+        assert near_cache2.stats()[r'size'] == 0
+        assert await near_cache2.get(key) == 2
+
+        await near_cache1.set(key + r'_other', 3)
+        await _wait_invalidated()
+
+        assert await near_cache1.get(key) == 2
+        assert await near_cache1.get(key + r'_other') == 3
+        assert near_cache1.stats()[r'size'] == 2
+
+        await near_cache2.delete(key + r'*')
+        await _wait_invalidated()
+
+        assert near_cache1.stats()[r'size'] == 0
+        assert await near_cache1.get(key + r'_other') is None
+
+        await near_cache1.close()
+        await near_cache2.close()
+
+        assert near_cache1._event_dispatcher.closed
+
+        await pool.close()
+
+
+class TestMLock:
+
+    async def test_lock_tag(self):
+
+        for key in (r'order', r'order{1}', r'a}b', r'{x}{y}'):
+
+            lock = MLock(None, key, 10)
+
+            tag = ConsistentHash.hash_tag(lock._lock_tag)
+
+            assert ConsistentHash.hash_tag(lock._queue_tag) == tag
+            assert ConsistentHash.hash_tag(lock._timeout_tag) == tag
+
+        assert MLock.gen_lock_tag(r'order') == r'process_lock_order'
+
+    async def test_lock(self, redis_address):
+
+        pytest.importorskip(r'lupa')
+
+        pool = await RedisPool(redis_address, minsize=2, maxsize=8, lock_notify=True, keepalive_interval=0)
+
+        await Utils.sleep(0.1)
+
+        key = Utils.uuid1()
+
+        async with pool.get_client() as cache1, pool.get_client() as cache2:
+
+            lock1 = cache1.allocate_lock(key, 10)
+            lock2 = cache2.allocate_lock(key, 10)
+
+            assert await lock1.acquire() is True
+            assert await lock2.acquire() is False
+
+            async def _release():
+                await Utils.sleep(0.2)
+                await lock1.release()
+
+            Utils.create_task(_release())
+
+            # 释放通知唤醒等待方，无需等到超时
+            time_diff = TimeDiff()
+
+            assert await lock2.acquire(5) is True
+            assert time_diff.check()[0] < 1
+
+            await lock2.release()
+
+            assert await lock2.exists() is False
+
+        await pool.close()
+
+    async def test_fair_lock(self, redis_address):
+
+        pytest.importorskip(r'lupa')
+
+        pool = await RedisPool(redis_address, minsize=2, maxsize=8, lock_notify=True, keepalive_interval=0)
+
+        await Utils.sleep(0.1)
+
+        key = Utils.uuid1()
+
+        result = []
+
+        async def _worker(name, delay):
+
+            await Utils.sleep(delay)
+
+            async with pool.get_client() as cache:
+
+                lock = cache.allocate_lock(key, 10, fair=True)
+
+                if await lock.acquire(5):
+                    result.append(name)
+                    await Utils.sleep(0.1)
+                    await lock.release()
+
+        await asyncio.gather(*(_worker(index, index * 0.02) for index in range(4)))
+
+        assert result == [0, 1, 2, 3]
+
+        await pool.close()
+
+    async def test_auto_renew(self, redis_address):
+
+        pytest.importorskip(r'lupa')
+
+        pool = await RedisPool(redis_address, minsize=2, maxsize=8, keepalive_interval=0)
+
+        key = Utils.uuid1()
+
+        async with pool.get_client() as cache:
+
+            lock = cache.allocate_lock(key, 2, auto_renew=True)
+
+            assert await lock.acquire() is True
+
+            await Utils.sleep(2.5)
+
+            assert lock.locked is True
+            assert await lock.exists() is True
+
+            await lock.release()
+
+            assert lock._renew_task is None
+            assert await lock.exists() is False
+
+        await pool.close()
+
+
+class _ShareCache(ShareCache):
+    """注入时钟，后台刷新结束时设置refreshed事件
+    """
+
+    clock = 1000.0
+    refreshed = None
+
+    @classmethod
+    def _now(cls):
+
+        return cls.clock
+
+    async def _background_refresh(self, *args):
+
+        try:
+            await super()._background_refresh(*args)
+        finally:
+            self.refreshed.set()
+
+
+class TestShareCache:
+
+    async def test_need_refresh(self):
+
+        now = ShareCache._now()
+
+        assert ShareCache(None, None)._need_refresh(None, 1) is False
+        assert ShareCache(None, None)._need_refresh(now + 60, 1) is False
+        assert ShareCache(None, None)._need_refresh(now - 1, 0) is True
+
+        # 耗时越长、beta越大越倾向于提前刷新
+        assert ShareCache(None, None, beta=1e9)._need_refresh(now + 60, 1) is True
+        assert ShareCache(None, None, beta=1)._need_refresh(now + 60, 0) is False
+
+    async def test_stale_while_revalidate(self, redis_address):
+
+        pytest.importorskip(r'lupa')
+
+        pool = await RedisPool(redis_address, minsize=2, maxsize=8, keepalive_interval=0)
+
+        key = Utils.uuid1()
+
+        values = [r'v1', r'v2']
+
+        _ShareCache.refreshed = asyncio.Event()
+
+        async def _load():
+            return values.pop(0)
+
+        async def _fetch(**kwargs):
+            async with pool.get_client() as cache:
+                async with _ShareCache(cache, key, **kwargs) as share:
+                    return await share.fetch(_load, expire=1)
+
+        assert await _fetch(stale_expire=10) == r'v1'
+        assert await _fetch(stale_expire=10) == r'v1'
+
+        # 超过expire但仍在stale_expire内，返回旧值并由后台刷新
+        _ShareCache.clock += 2
+
+        assert await _fetch(stale_expire=10) == r'v1'
+
+        await asyncio.wait_for(_ShareCache.refreshed.wait(), 5)
+
+        assert await _fetch(stale_expire=10) == r'v2'
+        assert values == []
+
+        await pool.close()
+
+    async def test_early_refresh(self, redis_address):
+
+        pytest.importorskip(r'lupa')
+
+        pool = await RedisPool(redis_address, minsize=2, maxsize=8, keepalive_interval=0)
+
+        key = Utils.uuid1()
+
+        load_count = 0
+
+        _ShareCache.refreshed = asyncio.Event()
+
+        async def _load():
+
+            nonlocal load_count
+
+            load_count += 1
+
+            # 计算耗时作为提前刷新的依据
+            _ShareCache.clock += 0.05
+
+            if load_count > 1:
+                raise ValueError()
+
+            return load_count
+
+        async def _fetch(**kwargs):
+            async with pool.get_client() as cache:
+                async with _ShareCache(cache, key, **kwargs) as share:
+                    return await share.fetch(_load, expire=60)
+
+        assert await _fetch(beta=1) == 1
+
+        # 远未过期时，较大的beta会触发后台提前刷新，刷新失败时继续使用旧值并释放锁
+        assert await _fetch(beta=1e9) == 1
+
+        await asyncio.wait_for(_ShareCache.refreshed.wait(), 5)
+
+        assert load_count == 2
+        assert await _fetch(beta=1) == 1
+
+        async with pool.get_client() as cache:
+            assert await cache.allocate_lock(key).exists() is False
+
+        await pool.close()
+
+
+class TestShardedCacheClient:
+
+    @staticmethod
+    def _shard_keys(pool, prefix):
+
+        keys = {}
+
+        while len(keys) < len(pool.shards):
+            key = f'{prefix}_{Utils.uuid1()}'
+            keys.setdefault(pool.get_shard_index(key), key)
+
+        return [keys[index] for index in range(len(pool.shards))]
+
+    async def test_routing(self, redis_servers):
+
+        pool = await ShardedRedisPool(redis_servers, minsize=1, maxsize=4, keepalive_interval=0)
+
+        key0, key1 = self._shard_keys(pool, r'routing')
+
+        async with pool.get_client() as cache:
+
+            assert await cache.mset(key0, 0, key1, 1) is True
+            assert await cache.mget(key1, r'routing_missing', key0) == [1, None, 0]
+            assert await cache.exists(key0, key1) == 2
+
+        for index, key in enumerate((key0, key1,)):
+            async with pool.shards[index].get_client() as cache:
+                assert await cache.get(key) == index
+            async with pool.shards[1 - index].get_client() as cache:
+                assert await cache.get(key) is None
+
+        async with pool.get_client() as cache:
+            assert await cache.delete(key0, key1) == 2
+            assert await cache.exists(key0, key1) == 0
+
+        await pool.close()
+
+    async def test_hash_tag(self, redis_servers):
+
+        pool = await ShardedRedisPool(redis_servers, minsize=1, maxsize=4, keepalive_interval=0)
+
+        tag0, tag1 = self._shard_keys(pool, r'tag')
+
+        key0, key1, key2 = f'{{{tag0}}}_a', f'{{{tag0}}}_b', f'{{{tag1}}}_c'
+
+        async with pool.get_client() as cache:
+
+            assert pool.get_shard_index(key0) == pool.get_shard_index(key1) != pool.get_shard_index(key2)
+
+            assert await cache.msetnx(key0, 0, key1, 1) == 1
+
+            pipeline = cache.pipeline()
+            future = pipeline.incr(key0)
+            pipeline.mget(key0, key1)
+            assert await pipeline.execute() == [1, [b'1', b'1']]
+            assert await future == 1
+
+            assert await cache.watch(key0, key1) is True
+
+            transaction = cache.multi_exec()
+            transaction.incr(key1)
+            assert await transaction.execute() == [2]
+
+            assert await cache.unwatch() is True
+
+            with pytest.raises(CrossShardError) as err:
+                await cache.msetnx(key0, 0, key2, 2)
+
+            assert key2 in str(err.value)
+
+            with pytest.raises(CrossShardError):
+                await cache.watch(key0, key2)
+
+            with pytest.raises(CrossShardError):
+                await cache.psubscribe(f'{{{tag0}}}_*', f'{{{tag1}}}_*')
+
+            pipeline = cache.pipeline()
+            future = pipeline.incr(key0)
+            pipeline.incr(key2)
+
+            with pytest.raises(CrossShardError):
+                await pipeline.execute()
+
+            assert future.cancelled()
+            assert await cache.exists(key2) == 0
+            assert await cache.mget(key0, key1) == [1, 2]
+
+            # 未拆分的多键命令需检查所有键
+            with pytest.raises(CrossShardError):
+                await cache.sinter(key0, key2)
+
+            with pytest.raises(CrossShardError):
+                await cache.rename(key0, key2)
+
+            with pytest.raises(CrossShardError):
+                await cache.blpop(key0, key2, timeout=1)
+
+            with pytest.raises(CrossShardError):
+                await cache.zunionstore(key0, key1, key2)
+
+            with pytest.raises(CrossShardError):
+                await cache.run_script(r'return 1', [key0, key2])
+
+            assert await cache.rename(key1, f'{{{tag0}}}_d') is True
+            assert await cache.mget(key0, f'{{{tag0}}}_d') == [1, 2]
+
+            await cache.delete(key0, f'{{{tag0}}}_d')
+
+        await pool.close()
+
+    async def test_scan(self, redis_servers):
+
+        pool = await ShardedRedisPool(redis_servers, minsize=1, maxsize=4, keepalive_interval=0)
+
+        prefix = f'scan_{Utils.uuid1()}'
+
+        keys = [f'{prefix}_{index}' for index in range(20)]
+
+        assert len(set(pool.get_shard_index(key) for key in keys)) == 2
+
+        async with pool.get_client() as cache:
+
+            await cache.mset(*[item for key in keys for item in (key, 0,)])
+
+            cursor, result = 0, []
+
+            while True:
+
+                cursor, _keys = await cache.scan(cursor, f'{prefix}_*', 5)
+
+                result.extend(_keys)
+
+                if cursor == 0:
+                    break
+
+            assert sorted(result) == sorted(keys)
+
+            assert await cache.delete(*keys) == len(keys)
+
+        await pool.close()
+
+
+class TestDistributedLimiter:
+
+    @staticmethod
+    def _set_clock(limiter, clock):
+
+        limiter._get_timestamp_ms = lambda: clock[0]
+
+    async def test_sliding_window(self, redis_address):
+
+        pytest.importorskip(r'lupa')
+
+        pool = await RedisPool(redis_address, minsize=1, maxsize=4, keepalive_interval=0)
+
+        # 键的过期时间使用真实时钟，窗口足够大时测试耗时不会影响结果
+        limiter = SlidingWindowLimiter(pool, 3, 60, Utils.uuid1())
+
+        clock = [1000000]
+
+        self._set_clock(limiter, clock)
+
+        assert [(res.allowed, res.remaining) for res in [await limiter.check() for _ in range(3)]] == [
+            (True, 2), (True, 1), (True, 0)
+        ]
+
+        res = await limiter.check()
+        assert res.allowed is False and res.retry_after == 60
+
+        # 窗口边界前1毫秒仍然拒绝，到达边界时最早的记录移出窗口
+        clock[0] += 59999
+
+        res = await limiter.check()
+        assert res.allowed is False and res.retry_after == 0.001
+
+        clock[0] += 1
+
+        res = await limiter.check(cost=3)
+        assert res.allowed is True and res.remaining == 0
+
+        res = await limiter.check(cost=4)
+        assert res.allowed is False and res.retry_after == -1
+
+        res = await limiter.check_many([r'a', r'b', r'a'], 2)
+        assert [val.allowed for val in res] == [True, True, False]
+
+        await pool.close()
+
+    async def test_token_bucket(self, redis_address):
+
+        pytest.importorskip(r'lupa')
+
+        pool = await RedisPool(redis_address, minsize=1, maxsize=4, keepalive_interval=0)
+
+        # 键的过期时间使用真实时钟，补充速度足够慢时测试耗时不会影响结果
+        limiter = TokenBucketLimiter(pool, 0.1, 5, Utils.uuid1())
+
+        clock = [1000000]
+
+        self._set_clock(limiter, clock)
+
+        for key in (r'a', r'b',):
+
+            res = await limiter.check(key, 5)
+            assert res.allowed is True and res.remaining == 0
+
+            res = await limiter.check(key)
+            assert res.allowed is False and res.retry_after == 10
+
+        # 补充满一个令牌前拒绝，恰好补满时放行
+        clock[0] += 9999
+
+        res = await limiter.check(r'a')
+        assert res.allowed is False and 0 < res.retry_after <= 0.002
+
+        clock[0] += 1
+
+        res = await limiter.check(r'b')
+        assert res.allowed is True and res.remaining == 0
+
+        res = await limiter.check(r'c', 6)
+        assert res.allowed is False and res.retry_after == -1
+
+        await pool.close()
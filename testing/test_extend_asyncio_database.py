@@ -0,0 +1,614 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from pymongo.errors import BulkWriteError
+from pymongo.results import BulkWriteResult
+
+from sqlalchemy import MetaData, Table, Column, Integer, String, select
+from sqlalchemy.dialects import mysql
+
+from hagworm.extend.metrics import PoolMetrics
+from hagworm.extend.asyncio.base import Utils
+from hagworm.extend.asyncio.base import TimeDiff
+from hagworm.extend.asyncio.cache import RedisPool
+from hagworm.extend.asyncio import database
+from hagworm.extend.asyncio.database import DBClient, DBTransaction, MySQLPool, MySQLReplicaSet, QueryCache
+from hagworm.extend.asyncio.database import MongoBulkWriter, MongoDelegate
+
+
+pytestmark = pytest.mark.asyncio
+# pytest.skip(allow_module_level=True)
+
+
+TABLE = Table(
+    r'test_table', MetaData(),
+    Column(r'id', Integer, primary_key=True),
+    Column(r'name', String(32)),
+)
+
+
+class _StubCursor:
+
+    def __init__(self, rows):
+
+        self._rows = list(rows)
+
+        self.closed = False
+
+    async def fetchmany(self, size):
+
+        rows, self._rows = self._rows[:size], self._rows[size:]
+
+        return rows
+
+    async def close(self):
+
+        self.closed = True
+
+
+class _StubTrx:
+
+    def __init__(self, conn):
+
+        self._conn = conn
+
+    async def commit(self):
+
+        self._conn.committed = True
+
+    async def rollback(self):
+
+        pass
+
+    async def close(self):
+
+        pass
+
+
+class _StubConnection:
+
+    def __init__(self, rows):
+
+        self.build_time = Utils.loop_time()
+
+        self.rows = rows
+        self.cursor = None
+
+        self.bulk_calls = []
+
+        self.closed = False
+        self.destroyed = False
+        self.committed = False
+
+    async def execute_unbuffered(self, query, dp=None):
+
+        self.cursor = _StubCursor(self.rows)
+
+        return self.cursor
+
+    async def execute_bulk(self, query, rows, max_stmt_length):
+
+        self.bulk_calls.append((query, len(rows),))
+
+        return len(rows)
+
+    async def begin(self):
+
+        return _StubTrx(self)
+
+    async def close(self):
+
+        self.closed = True
+
+    async def destroy(self):
+
+        self.destroyed = True
+
+
+class _StubPool:
+
+    readonly = False
+    query_cache = None
+    conn_life = 3600
+
+    def __init__(self, rows=()):
+
+        self.metrics = PoolMetrics(r'stub')
+
+        self.rows = list(rows)
+
+        self.conns = []
+
+    async def get_sa_conn(self):
+
+        conn = _StubConnection(self.rows)
+
+        self.conns.append(conn)
+
+        return conn
+
+    async def get_max_stmt_length(self, conn):
+
+        return 0
+
+    def get_transaction(self):
+
+        return DBTransaction(self)
+
+
+class _StubRawConnection:
+
+    def __init__(self, alive=True):
+
+        self.alive = alive
+        self.last_usage = Utils.loop_time() - 3600
+
+        self.closed = False
+
+    async def ping(self, reconnect=True):
+
+        if not self.alive:
+            raise ConnectionError()
+
+    def close(self):
+
+        self.closed = True
+
+
+class _StubReplica:
+
+    def __init__(self, name, outstanding=0, lag=0):
+
+        self.name = name
+        self.outstanding = outstanding
+        self.lag = lag
+
+    async def get_replication_lag(self):
+
+        if isinstance(self.lag, Exception):
+            raise self.lag
+
+        if self.lag == r'hang':
+            await Utils.sleep(10)
+
+        return self.lag
+
+
+class _BrokenRedisPool:
+
+    def get_client(self):
+
+        raise ConnectionError()
+
+
+class _StubCollection:
+    """bulk_write按收到操作的全局序号判断失败，失败时与服务端一样抛出BulkWriteError
+    """
+
+    full_name = r'test.stub'
+
+    def __init__(self, failed_indexes=(), documents=()):
+
+        self.failed_indexes = set(failed_indexes)
+        self.documents = list(documents)
+
+        self.batches = []
+
+        self.cursor = None
+
+    async def bulk_write(self, operations, ordered=False):
+
+        offset = sum(len(batch) for batch in self.batches)
+
+        self.batches.append(operations)
+
+        write_errors = [
+            {r'index': index, r'code': 11000, r'errmsg': r'duplicate key'}
+            for index in range(len(operations)) if offset + index in self.failed_indexes
+        ]
+
+        result = {r'nInserted': len(operations) - len(write_errors), r'writeErrors': write_errors}
+
+        if write_errors:
+            raise BulkWriteError(result)
+
+        return BulkWriteResult(result, True)
+
+    def find(self, _filter=None, projection=None, *, batch_size=0, **kwargs):
+
+        self.cursor = _StubMongoCursor(self.documents)
+
+        return self.cursor
+
+
+class _StubMongoCursor:
+
+    def __init__(self, documents):
+
+        self._documents = iter(documents)
+
+        self.closed = False
+
+    def __aiter__(self):
+
+        return self
+
+    async def __anext__(self):
+
+        try:
+            return next(self._documents)
+        except StopIteration:
+            raise StopAsyncIteration()
+
+    async def close(self):
+
+        self.closed = True
+
+
+class _StubMongoDelegate(MongoDelegate):
+
+    def __init__(self, collection):
+
+        self._collection = collection
+
+    def get_mongo_collection(self, db_name, collection):
+
+        return self._collection
+
+
+class TestDBClient:
+
+    async def test_stream(self):
+
+        pool = _StubPool(range(10))
+
+        client = DBClient(pool)
+
+        result = []
+
+        async for rows in client.stream(select([TABLE]), 4):
+            result.append(rows)
+
+        assert result == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+        assert pool.conns[0].cursor.closed is True
+        assert client._lock.locked() is False
+
+        await client.release()
+
+        assert pool.conns[0].closed is True
+
+    async def test_stream_break(self):
+
+        pool = _StubPool(range(10))
+
+        client = DBClient(pool)
+
+        # async with退出时立即结束生成器，释放连接锁并丢弃未读完的连接
+        async with client.stream(select([TABLE]), 4) as reader:
+            async for _ in reader:
+                break
+
+        assert client._lock.locked() is False
+        assert pool.conns[0].destroyed is True
+
+        # 未使用async with时，客户端释放会关闭未结束的流
+        async for _ in client.stream(select([TABLE]), 4):
+            break
+
+        assert client._lock.locked() is True
+
+        # 上一个流未关闭时不能开启新的流
+        with pytest.raises(RuntimeError):
+            client.stream(select([TABLE]), 4)
+
+        await client.release()
+
+        assert client._lock.locked() is False
+        assert pool.conns[1].destroyed is True
+
+        async for rows in client.stream(select([TABLE]), 8):
+            assert len(rows) in (8, 2,)
+
+        await client.release()
+
+        with pytest.raises(TypeError):
+            client.stream(TABLE.insert())
+
+    async def test_insert_many(self):
+
+        pool = _StubPool()
+
+        client = DBClient(pool)
+
+        rows = [{r'id': index, r'name': str(index)} for index in range(10)]
+
+        assert await client.insert_many(TABLE, rows, chunk_size=4) == 10
+        assert [size for _, size in pool.conns[0].bulk_calls] == [4, 4, 2]
+
+        assert await client.insert_many(TABLE, []) == 0
+
+        assert await client.insert_many(TABLE, rows, chunk_size=5, transaction=True) == 10
+        assert [size for _, size in pool.conns[1].bulk_calls] == [5, 5]
+        assert pool.conns[1].committed is True
+
+        await client.release()
+
+    async def test_upsert_many(self):
+
+        pool = _StubPool()
+
+        client = DBClient(pool)
+
+        rows = [{r'id': index, r'name': str(index)} for index in range(7)]
+
+        assert await client.upsert_many(TABLE, rows, chunk_size=3) == 7
+
+        bulk_calls = pool.conns[0].bulk_calls
+
+        assert [size for _, size in bulk_calls] == [3, 3, 1]
+
+        # 默认只更新主键之外的字段
+        statement = str(bulk_calls[0][0].compile(dialect=mysql.dialect()))
+
+        assert r'ON DUPLICATE KEY UPDATE name = VALUES(name)' in statement
+
+        await client.release()
+
+
+class TestMySQLPool:
+
+    async def test_keep_alive(self):
+
+        mysql_pool = MySQLPool(r'127.0.0.1', 3306, r'test', r'test', r'test', minsize=0, keepalive_interval=60)
+
+        pool = mysql_pool._pool = await database._MySQLConnectionsPool.create(minsize=0, maxsize=4)
+
+        alive, dead = _StubRawConnection(), _StubRawConnection(False)
+
+        await pool.put_free(alive)
+        await pool.put_free(dead)
+
+        assert pool.size == 2
+
+        await mysql_pool._keep_alive()
+
+        # 失效连接被关闭，存活连接放回空闲队列
+        assert pool.free_connections() == [alive]
+        assert dead.closed is True and alive.closed is False
+        assert pool.size == 1 and pool.usedsize == 0
+
+        pool.close_free(1)
+
+        assert alive.closed is True and pool.size == 0
+
+
+class TestMySQLReplicaSet:
+
+    async def test_weighted(self):
+
+        replica_set = MySQLReplicaSet(max_lag=0)
+
+        assert replica_set.select() is None
+
+        for name, weight in ((r'a', 5,), (r'b', 1,), (r'c', 1,),):
+            replica_set.add_pool(_StubReplica(name), weight)
+
+        # 平滑加权轮询，一个周期内按权重分配且高权重副本不会连续占满
+        names = r''.join(replica_set.select().name for _ in range(14))
+
+        assert names == r'aabacaa' * 2
+
+    async def test_least_outstanding(self):
+
+        replica_set = MySQLReplicaSet(strategy=MySQLReplicaSet.STRATEGY_LEAST_OUTSTANDING, max_lag=0)
+
+        pools = [_StubReplica(r'a', 3), _StubReplica(r'b', 2), _StubReplica(r'c', 5)]
+
+        for pool, weight in zip(pools, (1, 1, 4,)):
+            replica_set.add_pool(pool, weight)
+
+        assert replica_set.select().name == r'c'
+
+        pools[2].outstanding = 10
+
+        assert replica_set.select().name == r'b'
+
+        with pytest.raises(ValueError):
+            MySQLReplicaSet(strategy=r'random')
+
+    async def test_probe(self):
+
+        replica_set = MySQLReplicaSet(max_lag=5, probe_interval=3600, probe_timeout=0.1)
+
+        pools = [
+            _StubReplica(r'ok', lag=1),
+            _StubReplica(r'lagging', lag=10),
+            _StubReplica(r'failed', lag=ConnectionError()),
+            _StubReplica(r'unknown', lag=None),
+            _StubReplica(r'hang', lag=r'hang'),
+        ]
+
+        for pool in pools:
+            replica_set.add_pool(pool)
+
+        # 探测并发执行，总耗时只受probe_timeout限制
+        time_diff = TimeDiff()
+
+        await replica_set._probe()
+
+        assert time_diff.check()[0] < 0.5
+
+        assert sorted(pool.name for pool in replica_set.available_pools) == [r'ok', r'unknown']
+
+        pools[1].lag = 0
+
+        await replica_set._probe()
+
+        assert sorted(pool.name for pool in replica_set.available_pools) == [r'lagging', r'ok', r'unknown']
+        assert replica_set.get_lags()[r'lagging'] == 0
+
+        replica_set.close()
+
+
+class TestQueryCache:
+
+    async def test_fetch(self):
+
+        query_cache = QueryCache()
+
+        calls = 0
+
+        async def _query(val):
+
+            nonlocal calls
+
+            calls += 1
+
+            return val
+
+        assert await query_cache.fetch(r'key1', [r'user'], 10, _query, 1) == 1
+        assert await query_cache.fetch(r'key1', [r'user'], 10, _query, 2) == 1
+        assert calls == 1
+
+        stats = query_cache.stats()
+
+        assert stats[r'hit'] == 1 and stats[r'miss'] == 1
+
+        # 超过ttl后重新查询
+        assert await query_cache.fetch(r'key2', [r'user'], 0.1, _query, 1) == 1
+
+        await Utils.sleep(0.2)
+
+        assert await query_cache.fetch(r'key2', [r'user'], 0.1, _query, 2) == 2
+        assert calls == 3
+
+    async def test_invalidate(self):
+
+        query_cache = QueryCache()
+
+        async def _query(val):
+            return val
+
+        await query_cache.fetch(r'key1', [r'user'], 10, _query, 1)
+        await query_cache.fetch(r'key2', [r'order', r'user'], 10, _query, 1)
+        await query_cache.fetch(r'key3', [r'order'], 10, _query, 1)
+
+        await query_cache.invalidate(r'user')
+
+        assert await query_cache.fetch(r'key1', [r'user'], 10, _query, 2) == 2
+        assert await query_cache.fetch(r'key2', [r'order', r'user'], 10, _query, 2) == 2
+        assert await query_cache.fetch(r'key3', [r'order'], 10, _query, 2) == 1
+
+        # 没有缓存记录的表
+        await query_cache.invalidate(r'empty')
+
+        assert query_cache.stats()[r'invalidate'] == 2
+
+    async def test_invalidate_redis(self, redis_address):
+
+        redis_pool = await RedisPool(redis_address, minsize=1, maxsize=4, keepalive_interval=0)
+
+        query_cache = QueryCache(QueryCache.STORAGE_REDIS, redis_pool, name=Utils.uuid1())
+
+        async def _query(val):
+            return val
+
+        await query_cache.fetch(r'key1', [r'user'], 10, _query, 1)
+        await query_cache.fetch(r'key2', [r'order'], 10, _query, 1)
+
+        await query_cache.invalidate(r'user', r'empty')
+
+        assert await query_cache.fetch(r'key1', [r'user'], 10, _query, 2) == 2
+        assert await query_cache.fetch(r'key2', [r'order'], 10, _query, 2) == 1
+
+        assert query_cache.stats()[r'invalidate_error'] == 0
+
+        # 小数ttl
+        assert await query_cache.fetch(r'key3', [r'order'], 0.5, _query, 1) == 1
+        assert await query_cache.fetch(r'key3', [r'order'], 0.5, _query, 2) == 1
+
+        await redis_pool.close()
+
+    async def test_invalidate_error(self):
+
+        query_cache = QueryCache(QueryCache.STORAGE_REDIS, _BrokenRedisPool())
+
+        await query_cache.invalidate(r'user', r'order')
+
+        stats = query_cache.stats()
+
+        assert stats[r'invalidate'] == 2
+        assert stats[r'invalidate_error'] == 1
+
+
+class TestMongoBulkWriter:
+
+    async def test_flush(self):
+
+        collection = _StubCollection()
+
+        writer = MongoBulkWriter(collection, max_size=3, flush_interval=0.1)
+
+        # 达到max_size时立即写入
+        for index in range(4):
+            await writer.insert_one({r'index': index})
+
+        assert [len(batch) for batch in collection.batches] == [3]
+        assert writer.pending == 1
+
+        # 剩余的操作由定时器写入
+        await Utils.sleep(0.2)
+
+        assert [len(batch) for batch in collection.batches] == [3, 1]
+        assert writer.pending == 0
+
+        await writer.close()
+
+        stats = writer.stats
+
+        assert stats[r'flush'] == 2 and stats[r'inserted'] == 4 and stats[r'error'] == 0
+
+    async def test_errors(self, monkeypatch):
+
+        monkeypatch.setattr(database, r'MONGO_BULK_ERROR_LIMIT', 3)
+
+        collection = _StubCollection(failed_indexes=(1, 4, 5, 7,))
+
+        async with MongoBulkWriter(collection, max_size=3, flush_interval=0) as writer:
+            for index in range(8):
+                await writer.insert_one({r'index': index})
+
+        # 错误序号为全部操作中的序号，跨批次累加，超过上限的错误只计数不保留
+        assert [error[r'index'] for error in writer.errors] == [1, 4, 5]
+        assert [len(batch) for batch in collection.batches] == [3, 3, 2]
+
+        stats = writer.stats
+
+        assert stats[r'error'] == 4 and stats[r'inserted'] == 4
+
+
+class TestMongoDelegate:
+
+    async def test_stream_mongo_find(self):
+
+        collection = _StubCollection(documents=[{r'index': index} for index in range(5)])
+
+        delegate = _StubMongoDelegate(collection)
+
+        result = []
+
+        async for documents in delegate.stream_mongo_find(r'test', r'stub', batch_size=2):
+            result.append([document[r'index'] for document in documents])
+
+        assert result == [[0, 1], [2, 3], [4]]
+        assert collection.cursor.closed is True
+
+        stream = delegate.stream_mongo_find(r'test', r'stub', batch_size=2)
+
+        async for _ in stream:
+            break
+
+        await stream.aclose()
+
+        assert collection.cursor.closed is True
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+import asyncio
+
+from hagworm.extend.asyncio.base import Utils
+from hagworm.extend.asyncio.retry import RetryBudget, CircuitBreaker, RetryPolicy
+from hagworm.extend.error import CircuitBreakerError, PoolOverloadError
+
+
+pytestmark = pytest.mark.asyncio
+# pytest.skip(allow_module_level=True)
+
+
+class TestRetry:
+
+    async def test_retry_policy(self):
+
+        times = 0
+
+        async def _temp():
+
+            nonlocal times
+
+            times += 1
+
+            if times < 3:
+                raise ConnectionError()
+
+            return True
+
+        policy = RetryPolicy(5, base_delay=0.01)
+
+        assert await policy.execute(_temp) is True
+        assert times == 3
+
+        times = -10
+
+        with pytest.raises(ConnectionError):
+            await policy.execute(_temp)
+
+        assert times == -5
+
+    async def test_fatal_errors(self):
+
+        times = 0
+
+        async def _temp():
+
+            nonlocal times
+
+            times += 1
+
+            raise ValueError()
+
+        breaker = CircuitBreaker(failure_threshold=1)
+
+        with pytest.raises(ValueError):
+            await RetryPolicy(5, base_delay=0.01).execute(_temp, breaker=breaker, fatal_errors=(ValueError,))
+
+        assert times == 1
+        assert breaker.state == CircuitBreaker.STATE_CLOSED
+
+    async def test_retry_budget(self):
+
+        budget = RetryBudget(ratio=0.5, min_retries=1)
+
+        for _ in range(4):
+            budget.record_request()
+
+        assert budget.withdraw() is True
+        assert budget.withdraw() is True
+        assert budget.withdraw() is True
+        assert budget.withdraw() is False
+
+    async def test_circuit_breaker(self):
+
+        async def _temp():
+            raise ConnectionError()
+
+        breaker = CircuitBreaker(failure_threshold=2, recovery_time=0.1)
+
+        policy = RetryPolicy(5, base_delay=0.01)
+
+        with pytest.raises(ConnectionError):
+            await policy.execute(_temp, breaker=breaker)
+
+        assert breaker.state == CircuitBreaker.STATE_OPEN
+
+        with pytest.raises(CircuitBreakerError):
+            await policy.execute(_temp, breaker=breaker)
+
+        await Utils.sleep(0.1)
+
+        assert breaker.state == CircuitBreaker.STATE_HALF_OPEN
+
+        async def _success():
+            return True
+
+        assert await policy.execute(_success, breaker=breaker) is True
+        assert breaker.state == CircuitBreaker.STATE_CLOSED
+
+    async def test_half_open_overload(self):
+
+        async def _failure():
+            raise ConnectionError()
+
+        async def _overload():
+            raise PoolOverloadError()
+
+        breaker = CircuitBreaker(failure_threshold=1, recovery_time=0.1)
+
+        policy = RetryPolicy(1)
+
+        with pytest.raises(ConnectionError):
+            await policy.execute(_failure, breaker=breaker)
+
+        await Utils.sleep(0.1)
+
+        # 过载异常不记录结果，探测名额归还后仍可继续探测
+        with pytest.raises(PoolOverloadError):
+            await policy.execute(_overload, breaker=breaker)
+
+        assert breaker.state == CircuitBreaker.STATE_HALF_OPEN
+        assert breaker.allow() is True
+        assert breaker.allow() is False
+
+    async def test_half_open_cancel(self):
+
+        async def _failure():
+            raise ConnectionError()
+
+        async def _pending():
+            await Utils.sleep(10)
+
+        breaker = CircuitBreaker(failure_threshold=1, recovery_time=0.1)
+
+        policy = RetryPolicy(1)
+
+        with pytest.raises(ConnectionError):
+            await policy.execute(_failure, breaker=breaker)
+
+        await Utils.sleep(0.1)
+
+        task = asyncio.ensure_future(policy.execute(_pending, breaker=breaker))
+
+        await Utils.sleep(0.05)
+
+        assert breaker.allow() is False
+
+        task.cancel()
+
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+        # 被取消的探测调用归还名额
+        assert breaker.state == CircuitBreaker.STATE_HALF_OPEN
+        assert breaker.allow() is True
+
+    async def test_failure_errors(self):
+
+        times = 0
+
+        async def _temp():
+
+            nonlocal times
+
+            times += 1
+
+            raise PermissionError()
+
+        breaker = CircuitBreaker(failure_threshold=1)
+
+        policy = RetryPolicy(5, base_delay=0.01)
+
+        # 不重试，但计入熔断器的失败次数
+        with pytest.raises(PermissionError):
+            await policy.execute(_temp, breaker=breaker, fatal_errors=(OSError,), failure_errors=(PermissionError,))
+
+        assert times == 1
+        assert breaker.state == CircuitBreaker.STATE_OPEN
@@ -1,15 +1,28 @@
 # -*- coding: utf-8 -*-
 
 import pytest
+import asyncio
 
 from hagworm.extend.asyncio.base import Utils, TimeDiff
-from hagworm.extend.asyncio.task import RateLimiter
+from hagworm.extend.asyncio.task import RateLimiter, AIMDLimit, GradientLimit, TimingWheel, IntervalTask
+from hagworm.extend.error import RateLimitTimeoutError
 
 
 pytestmark = pytest.mark.asyncio
 # pytest.skip(allow_module_level=True)
 
 
+async def _wait_until(condition, timeout=5):
+    """轮询等待条件成立，替代固定时长的等待
+    """
+
+    deadline = Utils.loop_time() + timeout
+
+    while not condition():
+        assert Utils.loop_time() < deadline
+        await Utils.sleep(0.01)
+
+
 class TestHTTPClient:
 
     async def test_rate_limiter(self):
@@ -43,3 +56,250 @@ class TestHTTPClient:
             assert False
 
         assert Utils.math.floor(time_diff.check()[0]) == 2
+
+    async def test_rate_limiter_priority(self):
+
+        result = []
+
+        async def _temp(val):
+            result.append(val)
+            await Utils.sleep(0.01)
+
+        limiter = RateLimiter(1, priorities={r'high': 3, r'low': 1}, tenant_waiting_limit=2)
+
+        tasks = [limiter.append(_temp, r'first')]
+
+        for index in range(3):
+            tasks.append(limiter.append_with_priority(None, r'low', r'noisy', _temp, f'low_noisy_{index}'))
+
+        tasks.append(limiter.append_with_priority(None, r'low', r'quiet', _temp, r'low_quiet'))
+
+        for index in range(3):
+            tasks.append(limiter.append_with_priority(None, r'high', index, _temp, f'high_{index}'))
+
+        assert tasks[3] is None
+
+        for task in tasks:
+            if task is not None:
+                await task
+
+        assert result == [
+            r'first', r'high_0', r'high_1', r'low_noisy_0', r'high_2', r'low_quiet', r'low_noisy_1'
+        ]
+
+        stats = limiter.get_stats()[r'priorities']
+
+        assert stats[r'low'][r'admitted'] == 3
+        assert stats[r'low'][r'rejected'] == 1
+        assert stats[r'high'][r'wait_time'][r'count'] == 3
+
+    async def test_rate_limiter_adaptive(self):
+
+        async def _temp():
+            await Utils.sleep(0.01)
+
+        async def _error():
+            raise ValueError()
+
+        limiter = RateLimiter(0, adaptive_limit=AIMDLimit(2, 8, initial_limit=4))
+
+        assert limiter.running_limit == 4
+
+        for task in [limiter.append(_temp) for _ in range(50)]:
+            await task
+
+        assert limiter.running_limit == 8
+
+        for task in [limiter.append(_error) for _ in range(20)]:
+            with pytest.raises(ValueError):
+                await task
+
+        assert limiter.running_limit == 2
+
+        limit = GradientLimit(2, 64, initial_limit=4)
+
+        for _ in range(100):
+            limit.update(0.01, False, limit.limit)
+
+        assert limit.limit == 64
+
+        for _ in range(100):
+            limit.update(0.1, False, limit.limit)
+
+        assert limit.limit < 64
+        assert limit.snapshot()[r'samples'] == 200
+
+    async def test_rate_limiter_waiting(self):
+
+        event = asyncio.Event()
+
+        async def _temp():
+            await event.wait()
+            return True
+
+        limiter = RateLimiter(1, 0, 0.2)
+
+        _f1 = limiter.append(_temp)
+        _f2 = limiter.append(_temp)
+
+        # 排队超时的任务在正在执行的任务结束前就已失败
+        with pytest.raises(RateLimitTimeoutError):
+            await _f2
+
+        assert not _f1.done()
+        assert limiter.waiting_length == 0
+
+        event.set()
+
+        assert await _f1 is True
+
+        limiter = RateLimiter(1, 0)
+
+        tasks = [limiter.append_with_name(f'f{index}', _temp) for index in range(5)]
+
+        limiter.waiting_limit = 2
+
+        assert [task.name for task in limiter.waiting_tasks] == [r'f1', r'f2']
+        assert tasks[3].cancelled() and tasks[4].cancelled()
+        assert limiter.get_stats()[r'priorities'][RateLimiter.DEFAULT_PRIORITY][r'waiting'] == 2
+
+    async def test_rate_limiter_cancel(self):
+
+        calls = []
+
+        async def _temp(index, delay=0.2):
+            await Utils.sleep(delay)
+            calls.append(index)
+            return index
+
+        limiter = RateLimiter(1, 0)
+
+        _f1 = limiter.append(_temp, 1)
+        _f2 = limiter.append(_temp, 2)
+        _f3 = limiter.append(_temp, 3)
+
+        # 等待中被取消的任务出队时直接跳过
+        _f2.cancel()
+
+        assert await _f1 == 1
+        assert await _f3 == 3
+        assert calls == [1, 3]
+
+        _f4 = limiter.append(_temp, 4, 0.5)
+        _f5 = limiter.append(_temp, 5)
+        _f6 = limiter.append(_temp, 6)
+
+        _f5.cancel()
+
+        await Utils.sleep(0.15)
+
+        # 超时清理时跳过已取消的任务
+        limiter.timeout = 0.1
+
+        assert limiter.waiting_length == 0
+
+        with pytest.raises(RateLimitTimeoutError):
+            await _f6
+
+        assert await _f4 == 4
+        assert calls == [1, 3, 4]
+
+    async def test_timing_wheel(self):
+
+        wheel = TimingWheel(0.01, 4, 3)
+
+        result = []
+
+        timers = [wheel.call_later(delay, result.append, delay) for delay in (0.05, 0.2, 0.8, 0.1)]
+
+        timers[3].cancel()
+
+        assert len(wheel) == 3
+
+        await _wait_until(lambda: len(result) == 3)
+
+        assert result == [0.05, 0.2, 0.8]
+        assert len(wheel) == 0
+
+        # 模拟长时间空闲，新的定时器直接从当前tick开始计算，不逐个追赶错过的tick
+        wheel._start_time -= 100
+
+        future = asyncio.Future()
+
+        wheel.call_later(0.05, future.set_result, True)
+
+        assert wheel._current_tick >= 10000
+
+        assert await asyncio.wait_for(future, 1) is True
+
+        count = 0
+
+        async def _temp():
+            nonlocal count
+            count += 1
+
+        task = IntervalTask(_temp, 0.1, timing_wheel=wheel, jitter=0.05)
+        task.start()
+
+        await _wait_until(lambda: count >= 3)
+
+        task.stop()
+        assert len(wheel) == 0
+
+    async def test_task_overrun(self):
+
+        release = asyncio.Event()
+
+        async def _temp():
+            await release.wait()
+
+        async def _error():
+            raise ValueError()
+
+        # (overrun期间的并发数, 释放后至少完成的次数)
+        expected = {
+            IntervalTask.OVERRUN_SKIP: (1, 1),
+            IntervalTask.OVERRUN_QUEUE_ONE: (1, 2),
+            IntervalTask.OVERRUN_CONCURRENT: (2, 2),
+        }
+
+        for policy, (active, runs) in expected.items():
+
+            release.clear()
+
+            task = IntervalTask(_temp, 0.02, overrun_policy=policy, max_concurrency=2)
+            task.start(True)
+
+            # 执行被阻塞，之后的每次调度都是overrun
+            await _wait_until(lambda: task.get_stats()[r'overrun'] >= 3)
+
+            stats = task.get_stats()
+
+            assert stats[r'active'] == active
+            assert stats[r'runs'] == 0
+
+            if policy == IntervalTask.OVERRUN_SKIP:
+                assert stats[r'skipped'] == stats[r'overrun']
+            else:
+                # QUEUE_ONE补执行一次，CONCURRENT并发执行一次，其余均被跳过
+                assert stats[r'skipped'] == stats[r'overrun'] - 1
+
+            release.set()
+
+            await _wait_until(lambda: task.get_stats()[r'runs'] >= runs)
+
+            task.stop()
+
+            await _wait_until(lambda: task.active_count == 0)
+
+        task = IntervalTask(_error, 0.02)
+        task.start(True)
+
+        await _wait_until(lambda: task.get_stats()[r'runs'] >= 2)
+
+        task.stop()
+
+        stats = task.get_stats()
+
+        assert stats[r'errors'] == stats[r'runs']
+        assert stats[r'overrun'] == 0
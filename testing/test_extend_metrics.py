@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from hagworm.extend.metrics import Histogram, PoolMetrics, PoolSizer, StatementMetrics
+
+
+pytestmark = pytest.mark.asyncio
+# pytest.skip(allow_module_level=True)
+
+
+class TestMetrics:
+
+    async def test_histogram(self):
+
+        histogram = Histogram((1, 10, 100))
+
+        for val in range(1, 101):
+            histogram.observe(val)
+
+        assert histogram.count == 100
+        assert histogram.max == 100
+
+        assert histogram.percentile(1) == 1
+        assert histogram.percentile(10) == 10
+        assert histogram.percentile(90) == 100
+
+        snapshot = histogram.snapshot()
+
+        assert snapshot[r'buckets'] == {r'1': 1, r'10': 10, r'100': 100, r'+Inf': 100}
+
+        histogram.observe(1000)
+
+        assert histogram.percentile(100) == 1000
+
+        histogram.reset()
+
+        assert histogram.count == 0
+        assert histogram.percentile(99) == 0
+
+    async def test_pool_metrics(self):
+
+        metrics = PoolMetrics(r'test')
+
+        metrics.incr_conn_created(10)
+        metrics.incr_acquire_timeout()
+
+        metrics.observe_acquire(0.002)
+        metrics.observe_command(0.02)
+
+        snapshot = metrics.snapshot(size=8, free=6, used=2, minsize=4, maxsize=16)
+
+        assert snapshot[r'conn_created'] == 10
+        assert snapshot[r'acquire_timeout'] == 1
+        assert snapshot[r'acquire_wait'][r'count'] == 1
+        assert snapshot[r'command_latency'][r'p50'] == 25
+
+        metrics.recent_acquire_wait.reset()
+
+        assert metrics.acquire_wait.count == 1
+
+    async def test_pool_sizer(self):
+
+        sizer = PoolSizer(4, 16, grow_threshold=10, shrink_threshold=1, step=2)
+
+        histogram = Histogram()
+
+        histogram.observe(50)
+
+        assert sizer.calculate(4, 4, histogram) == 6
+        assert sizer.calculate(16, 16, histogram) == 16
+
+        histogram.reset()
+
+        assert sizer.calculate(10, 2, histogram) == 8
+        assert sizer.calculate(10, 9, histogram) == 10
+        assert sizer.calculate(5, 0, histogram) == 4
+
+    async def test_statement_metrics(self):
+
+        metrics = StatementMetrics(r'test', slow_time=0.1, max_statements=2)
+
+        assert metrics.fingerprint(
+            r"SELECT * FROM t1 WHERE a = %(a_1)s AND b IN (%(b_1)s, %(b_2)s) AND c = 'x' LIMIT 10"
+        ) == r'SELECT * FROM t1 WHERE a = ? AND b IN (...) AND c = ? LIMIT ?'
+
+        metrics.observe(r'SELECT * FROM t1 WHERE a = 1', 0.01, rowcount=1)
+        metrics.observe(r'SELECT * FROM t1 WHERE a = 2', 0.2, rowcount=2, retries=1, acquire_wait=0.005)
+        metrics.observe(r'DELETE FROM t1', 0.01, error=Exception())
+        metrics.observe(r'DELETE FROM t2', 0.01)
+
+        snapshot = metrics.snapshot()
+
+        assert snapshot[r'slow_count'] == 1
+
+        stats = snapshot[r'statements'][r'SELECT * FROM t1 WHERE a = ?']
+
+        assert stats[r'count'] == 2
+        assert stats[r'rows'] == 3
+        assert stats[r'retries'] == 1
+        assert stats[r'slow'] == 1
+        assert stats[r'latency'][r'max'] == 200
+
+        assert snapshot[r'statements'][r'DELETE FROM t1'][r'errors'] == 1
+        assert snapshot[r'statements'][StatementMetrics.OTHER_STATEMENT][r'count'] == 1
+
+        metrics.reset()
+
+        assert metrics.snapshot()[r'statements'] == {}
@@ -3,7 +3,7 @@
 import pytest
 
 from hagworm.extend.asyncio.base import Utils
-from hagworm.extend.struct import KeyLowerDict
+from hagworm.extend.struct import KeyLowerDict, ConsistentHash
 
 
 pytestmark = pytest.mark.asyncio
@@ -95,3 +95,28 @@ class TestStruct:
         temp2 = KeyLowerDict(temp1)
 
         assert r'my_sql1' in temp2 and r'mysql2' in temp2 and r'mysql3' in temp2
+
+    async def test_consistent_hash(self):
+
+        nodes = [f'node_{index}' for index in range(4)]
+
+        hash_ring = ConsistentHash(nodes)
+
+        keys = [Utils.uuid1() for _ in range(0x1000)]
+
+        counts = {node: 0 for node in nodes}
+
+        for key in keys:
+            counts[hash_ring.get_node(key)] += 1
+
+        assert all(count > 0x1000 / len(nodes) / 2 for count in counts.values())
+
+        assert hash_ring.get_node(r'{user_1}_info') == hash_ring.get_node(r'{user_1}_score')
+        assert hash_ring.get_node(r'{user_1}_info') == hash_ring.get_node(r'user_1')
+
+        # 增加节点后，只有部分键会被重新路由
+        new_hash_ring = ConsistentHash(nodes + [r'node_4'])
+
+        moved = sum(1 for key in keys if hash_ring.get_node(key) != new_hash_ring.get_node(key))
+
+        assert moved < len(keys) / 2
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+pytest.importorskip(r'wtforms_tornado')
+
+from tornado.web import Application
+from tornado.httpserver import HTTPServer
+from tornado.httpclient import AsyncHTTPClient
+from tornado.testing import bind_unused_port
+
+from hagworm.extend.error import PoolOverloadError, CircuitBreakerError
+from hagworm.frame.tornado.web import RequestBaseHandler
+
+
+pytestmark = pytest.mark.asyncio
+# pytest.skip(allow_module_level=True)
+
+
+class _PoolOverloadHandler(RequestBaseHandler):
+
+    async def get(self):
+
+        raise PoolOverloadError(r'pool')
+
+
+class _CircuitBreakerHandler(RequestBaseHandler):
+
+    async def get(self):
+
+        raise CircuitBreakerError(r'breaker')
+
+
+class _ErrorHandler(RequestBaseHandler):
+
+    async def get(self):
+
+        raise ValueError()
+
+
+class TestRequestBaseHandler:
+
+    async def test_overload(self):
+
+        sock, port = bind_unused_port()
+
+        server = HTTPServer(
+            Application(
+                [
+                    (r'/pool', _PoolOverloadHandler),
+                    (r'/breaker', _CircuitBreakerHandler),
+                    (r'/error', _ErrorHandler),
+                ]
+            )
+        )
+
+        server.add_sockets([sock])
+
+        client = AsyncHTTPClient()
+
+        try:
+
+            # 过载保护异常返回503，其它异常仍按500处理
+            for path, code in ((r'/pool', 503,), (r'/breaker', 503,), (r'/error', 500,),):
+                response = await client.fetch(f'http://127.0.0.1:{port}{path}', raise_error=False)
+                assert response.code == code
+
+        finally:
+
+            server.stop()